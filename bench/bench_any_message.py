@@ -0,0 +1,119 @@
+"""
+Бенчмарк: сколько обычных сообщений в секунду проходит через any_message.
+
+    python bench/bench_any_message.py                      # текущий weirdo.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_any_message.py --module /tmp/weirdo_before.py
+
+БД каждый раз создаётся заново во временной папке.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from aiogram.types import Chat, Message, User
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# без слов-триггеров: реакции 💩 не меряем
+WORDS = (
+    "привет как дела сегодня завтра код бот дуэль слот токены "
+    "чат кофе работа дедлайн релиз баг фича тест лол кек ок да нет"
+).split()
+
+
+class FakeBot:
+    async def set_message_reaction(self, **kw):
+        return True
+
+
+def load_module(path: Path):
+    spec = importlib.util.spec_from_file_location("weirdo_bench", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def db_ts(mod, dt: datetime):
+    """Время так, как его хранит версия mod: epoch или (до epoch-миграции) isoformat."""
+    return mod.epoch(dt) if hasattr(mod, "epoch") else dt.isoformat()
+
+
+def make_messages(n: int, chats: int, users: int, seed: int = 1):
+    rnd = random.Random(seed)
+    msgs = []
+    for i in range(n):
+        cid = -1000 - rnd.randrange(chats)
+        uid = 1 + rnd.randrange(users)
+        text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 12)))
+        msgs.append(Message(
+            message_id=i + 1,
+            date=datetime.now(),
+            chat=Chat(id=cid, type="supergroup"),
+            from_user=User(id=uid, is_bot=False, first_name=f"u{uid}", username=f"user{uid}"),
+            text=text,
+        ))
+    return msgs
+
+
+async def feed(mod, msg, bot):
+    # с ChatSettingsMiddleware настройки приходят из неё, как в диспетчере
+    if hasattr(mod, "ChatSettingsMiddleware"):
+        data = {"bot": bot}
+        await mod.ChatSettingsMiddleware()(lambda m, d: mod.any_message(m, d["bot"], d["settings"]), msg, data)
+    else:
+        await mod.any_message(msg, bot)
+
+
+async def run(mod, msgs):
+    bot = FakeBot()
+    # прогрев: создаём настройки чатов
+    for m in msgs[:50]:
+        await feed(mod, m, bot)
+    t0 = time.perf_counter()
+    for m in msgs:
+        await feed(mod, m, bot)
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("-n", type=int, default=5000)
+    ap.add_argument("--chats", type=int, default=20)
+    ap.add_argument("--users", type=int, default=200)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        # случайные ответы бота не меряем
+        mod.EASTER_PROB = 0.0
+        mod.AUTO_HYPE_PROB = 0.0
+        mod.init_db()
+
+        msgs = make_messages(args.n, args.chats, args.users)
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed = asyncio.run(run(mod, msgs))
+        if hasattr(mod, "db_stop"):
+            mod.db_stop()
+        elif hasattr(mod, "db_close_all"):
+            mod.db_close_all()
+
+    print(f"module={args.module}")
+    print(f"messages={args.n} chats={args.chats} users={args.users}")
+    print(f"elapsed={elapsed:.3f}s  msg/s={args.n / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
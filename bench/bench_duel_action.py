@@ -0,0 +1,105 @@
+"""
+Бенчмарк: стоимость нажатия кнопки дуэли (duel_apply_action в потоке-писателе).
+
+--duels активных дуэлей, игроки по очереди жмут случайные действия. Меряем
+время на нажатие вместе с периодическим сбросом отложенной записи (если она
+есть в модуле) — то есть всё, что нажатие стоит потоку-писателю.
+
+    python bench/bench_duel_action.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_duel_action.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+ACTIONS = ("shoot", "aim", "dodge", "reload", "heal")
+
+
+def start_round(mod, data, now: datetime, a_id: int, b_id: int, seconds: int):
+    # до слотового DuelState data была dict-ом, а duel_start_round брал id игроков
+    if isinstance(data, dict):
+        data["round_seconds"] = seconds
+        mod.duel_start_round(data, now, a_id, b_id)
+    else:
+        data.round_seconds = seconds
+        mod.duel_start_round(data, now)
+
+
+def seed_duels(mod, duels: int, now: datetime) -> list:
+    out = []
+    for i in range(duels):
+        chat_id = -1000 - (i % 20)
+        a_id, b_id = 1 + 2 * i, 2 + 2 * i
+        mod.ensure_chat(chat_id)
+        duel_id = mod.duel_create(chat_id, a_id, b_id, now)
+        mod.duel_activate(chat_id, duel_id, 10_000 + i)
+        data = mod.duel_new_data(a_id, b_id)
+        start_round(mod, data, now, a_id, b_id, 3600)
+        mod.duel_update_data(chat_id, duel_id, data)
+        out.append([chat_id, duel_id, a_id, b_id, a_id])
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--duels", type=int, default=200)
+    ap.add_argument("-n", type=int, default=20_000, help="нажатий")
+    ap.add_argument("--flush-every", type=int, default=200, help="нажатий между сбросами буфера")
+    args = ap.parse_args()
+
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        now = datetime.now(timezone.utc)
+        live = seed_duels(mod, args.duels, now)
+        buffered = hasattr(mod, "_duels_dirty")
+        if buffered:
+            mod.ingest_write(mod._ingest_new())
+
+        lat = []
+        ok = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(args.n):
+                if not live:
+                    live = seed_duels(mod, args.duels, now)
+                j = rnd.randrange(len(live))
+                chat_id, duel_id, a_id, b_id, turn = live[j]
+                t0 = time.perf_counter()
+                alert, res = mod.duel_apply_action(chat_id, duel_id, turn, rnd.choice(ACTIONS), now)
+                if buffered and i % args.flush_every == args.flush_every - 1:
+                    mod.ingest_write(mod._ingest_new())
+                lat.append((time.perf_counter() - t0) * 1e6)
+                if alert:
+                    live.pop(j)
+                    continue
+                ok += 1
+                if res[2] is None:
+                    live.pop(j)
+                else:
+                    live[j][4] = b_id if turn == a_id else a_id
+        mod.db_close_all()
+
+    q = statistics.quantiles(lat, n=100)
+    print(f"module={args.module}")
+    print(f"duels={args.duels} presses={args.n} accepted={ok}")
+    print(f"per press us: mean={statistics.fmean(lat):.0f} p50={q[49]:.0f} p99={q[98]:.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
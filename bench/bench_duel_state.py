@@ -0,0 +1,127 @@
+"""
+Бенчмарк: состояние дуэли — сериализация, разбор и резолв раунда.
+
+dumps   — состояние -> значение колонки duels.data
+loads   — значение колонки -> состояние
+resolve — duel_resolve_round на случайных ходах (состояние сбрасывается к
+          свежему, как только кто-то падает)
+
+Старый формат (dict + JSON) меряется на старой ревизии через --module;
+в текущем модуле заодно меряется чтение легаси-JSON строк.
+
+    python bench/bench_duel_state.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_duel_state.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+CHAT = -1000
+A, B = 1, 2
+MOVES = ("shoot", "aim", "dodge", "reload", "heal")
+
+
+def timeit(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def played_state(mod, rnd, slotted: bool):
+    # состояние после пары раундов — с логом и эпиком, как в жизни
+    data = mod.duel_new_data(A, B)
+    for _ in range(2):
+        set_moves(data, rnd.choice(MOVES), rnd.choice(MOVES), slotted)
+        mod.duel_resolve_round(CHAT, "bench", A, B, data)
+    if slotted:
+        data.deadline = time.time() + 60
+    else:
+        data["deadline"] = "2030-01-01T00:00:00+00:00"
+    return data
+
+
+def set_moves(data, ma: str, mb: str, slotted: bool):
+    if slotted:
+        data.a.move, data.b.move = ma, mb
+    else:
+        data["moves"][str(A)], data["moves"][str(B)] = ma, mb
+
+
+def alive(data, slotted: bool) -> bool:
+    if slotted:
+        return data.a.hp > 0 and data.b.hp > 0
+    return all(int(p["hp"]) > 0 for p in data["players"].values())
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("-n", type=int, default=50_000)
+    args = ap.parse_args()
+
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        mod.ensure_chat(CHAT)
+        slotted = hasattr(mod, "duel_state_dumps")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            data = played_state(mod, rnd, slotted)
+        if slotted:
+            raw = mod.duel_state_dumps(data)
+            dumps_us = timeit(lambda: mod.duel_state_dumps(data), args.n)
+            loads_us = timeit(lambda: mod.duel_state_loads(raw, A, B), args.n)
+        else:
+            raw = json.dumps(data, ensure_ascii=False)
+            dumps_us = timeit(lambda: json.dumps(data, ensure_ascii=False), args.n)
+            loads_us = timeit(lambda: json.loads(raw), args.n)
+
+        state = {"data": mod.duel_new_data(A, B)}
+
+        def one_round():
+            d = state["data"]
+            set_moves(d, rnd.choice(MOVES), rnd.choice(MOVES), slotted)
+            mod.duel_resolve_round(CHAT, "bench", A, B, d)
+            if not alive(d, slotted):
+                state["data"] = mod.duel_new_data(A, B)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            resolve_us = timeit(one_round, args.n // 5)
+
+        print(f"module={args.module}")
+        print(f"format={'slotted+struct' if slotted else 'dict+json'} size={len(raw)} bytes")
+        print(f"dumps={dumps_us:.2f}us  loads={loads_us:.2f}us  resolve={resolve_us:.2f}us")
+        if slotted:
+            with contextlib.redirect_stdout(io.StringIO()):
+                legacy = played_state(load_module(ROOT / "weirdo.py"), rnd, True)
+            legacy_json = json.dumps({
+                "round": legacy.round, "round_seconds": legacy.round_seconds,
+                "deadline": "2030-01-01T00:00:00+00:00", "turn": str(A),
+                "players": {str(p.uid): {"hp": p.hp, "ammo": p.ammo, "acc": p.acc, "heal_used": p.heal_used,
+                                         "aimed": p.aimed, "crit_bonus": p.crit_bonus}
+                            for p in (legacy.a, legacy.b)},
+                "moves": {str(A): None, str(B): None},
+                "last_round_lines": legacy.last_round_lines, "last_epic": legacy.last_epic,
+            }, ensure_ascii=False)
+            legacy_us = timeit(lambda: mod.duel_state_loads(legacy_json, A, B), args.n // 5)
+            print(f"legacy json loads={legacy_us:.2f}us")
+        mod.db_close_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
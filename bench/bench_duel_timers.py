@@ -0,0 +1,125 @@
+"""
+Бенчмарк: background_duel_watcher — холостая нагрузка и опоздание таймаутов раунда.
+
+1) idle  — --chats включённых чатов без дуэлей, watcher крутится --idle секунд:
+   сколько раз он сходил в БД и сколько CPU съел процесс.
+2) round — --duels активных дуэлей с дедлайнами раунда, разбросанными по
+   ближайшим 3 секундам: насколько позже дедлайна пришла правка арены.
+
+    python bench/bench_duel_timers.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_duel_timers.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+from bench_duel_action import start_round  # noqa: E402
+
+
+class ArenaBot:
+    def __init__(self):
+        self.edits = {}
+
+    async def edit_message_text(self, chat_id, message_id, **kw):
+        self.edits.setdefault((chat_id, message_id), time.time())
+
+
+def count_db_calls(mod) -> dict:
+    calls = {"n": 0}
+    for name in ("db_write", "db_read", "adb_all", "adb_one", "adb_exec"):
+        fn = getattr(mod, name, None)
+        if fn is None:
+            continue
+
+        def wrap(fn=fn):
+            async def counted(*a, **kw):
+                calls["n"] += 1
+                return await fn(*a, **kw)
+            return counted
+        setattr(mod, name, wrap())
+    return calls
+
+
+def seed_duels(mod, chats: int, duels: int, seed: int = 1) -> dict:
+    rnd = random.Random(seed)
+    deadlines = {}
+    now = datetime.now(timezone.utc)
+    for i in range(duels):
+        chat_id = -1000 - (i % chats)
+        a_id, b_id = 1 + 2 * i, 2 + 2 * i
+        duel_id = mod.duel_create(chat_id, a_id, b_id, now)
+        arena_msg_id = 10_000 + i
+        mod.duel_activate(chat_id, duel_id, arena_msg_id)
+        data = mod.duel_new_data(a_id, b_id)
+        start = now + timedelta(seconds=0.5 + rnd.random() * 2.5)
+        start_round(mod, data, start, a_id, b_id, 0)
+        mod.duel_update_data(chat_id, duel_id, data)
+        deadlines[(chat_id, arena_msg_id)] = start.timestamp()
+    return deadlines
+
+
+async def run(mod, args):
+    if hasattr(mod, "db_start"):
+        mod.db_start()
+    for i in range(args.chats):
+        await mod.db_write(None, mod.ensure_chat, -1000 - i)
+    calls = count_db_calls(mod)
+    bot = ArenaBot()
+
+    # 1) холостой ход
+    cpu0 = time.process_time()
+    task = asyncio.create_task(mod.background_duel_watcher(bot))
+    await asyncio.sleep(args.idle)
+    idle_calls, idle_cpu = calls["n"], time.process_time() - cpu0
+    task.cancel()
+
+    # 2) таймауты раунда
+    deadlines = await mod.db_write(None, seed_duels, mod, args.chats, args.duels)
+    task = asyncio.create_task(mod.background_duel_watcher(bot))
+    await asyncio.sleep(5.5)
+    task.cancel()
+    late = [(bot.edits[k] - ts) * 1000.0 for k, ts in deadlines.items() if k in bot.edits]
+    return idle_calls, idle_cpu, late
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--chats", type=int, default=200)
+    ap.add_argument("--duels", type=int, default=50)
+    ap.add_argument("--idle", type=float, default=10.0, help="секунд холостого хода")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        with contextlib.redirect_stdout(io.StringIO()):
+            idle_calls, idle_cpu, late = asyncio.run(run(mod, args))
+        mod.db_stop()
+
+    print(f"module={args.module}")
+    print(f"chats={args.chats} duels={args.duels} idle={args.idle:.0f}s")
+    print(f"idle: db calls={idle_calls}  cpu={idle_cpu * 1000:.0f}ms")
+    if late:
+        q = statistics.quantiles(late, n=100)
+        print(f"round timeout lateness ms: p50={q[49]:.0f} p99={q[98]:.0f} max={max(late):.0f} fired={len(late)}/{args.duels}")
+    else:
+        print(f"round timeout lateness: fired=0/{args.duels}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
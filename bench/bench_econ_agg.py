@@ -0,0 +1,76 @@
+"""
+Бенчмарк: /econ (econ_snapshot) на большом чате и цена записи в кошелёк.
+
+В чате --users кошельков (и столько же в --chats соседних чатах). Меряем
+econ_snapshot — то, что читает /econ, — и одну запись экономики:
+wallet_add + pool_add в транзакции (с econ_agg это ещё и триггеры).
+
+    python bench/bench_econ_agg.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_econ_agg.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+CHAT = -1000
+
+
+def timed(fn, n: int) -> list[float]:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--users", type=int, default=50_000, help="кошельков на чат")
+    ap.add_argument("--chats", type=int, default=4)
+    ap.add_argument("-n", type=int, default=2000, help="замеров")
+    args = ap.parse_args()
+
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        with mod.db_tx():
+            for c in range(args.chats):
+                for uid in range(1, args.users + 1):
+                    mod.wallet_add(CHAT - c, uid, rnd.choice((0, rnd.randint(1, 500))))
+                mod.pool_add(CHAT - c, "treasury", 100)
+
+        snap = timed(lambda: mod.econ_snapshot(CHAT), args.n)
+
+        def one_write():
+            with mod.db_tx():
+                mod.wallet_add(CHAT, 1 + rnd.randrange(args.users), rnd.randint(-5, 5))
+                mod.pool_add(CHAT, "treasury", 1)
+        write = timed(one_write, args.n)
+        ok = "n/a"
+        if hasattr(mod, "econ_agg_check"):
+            ok = "OK" if not mod.econ_agg_check() else "MISMATCH"
+        mod.db_close_all()
+
+    print(f"module={args.module}")
+    print(f"users={args.users}/chat chats={args.chats} econ_agg check={ok}")
+    for name, lat in (("econ_snapshot", snap), ("wallet write", write)):
+        q = statistics.quantiles(lat, n=100)
+        print(f"{name:<14} us: mean={statistics.fmean(lat):.0f} p50={q[49]:.0f} p99={q[98]:.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Бенчмарк: операции экономики (/slot, /pay, /buy, /daily) под конкурентной нагрузкой.
+
+--clients корутин параллельно шлют случайные команды прямо в хендлеры
+(cmd_slot/cmd_pay/cmd_buy/cmd_daily). Меряем операций в секунду и сколько
+коммитов SQLite приходится на операцию: явный COMMIT плюс каждая пишущая
+инструкция вне транзакции (autocommit), и задержку одной команды. В конце
+проверяем, что ни один баланс не ушёл в минус.
+
+--windows — кривая по окну group commit (DB_GROUP_COMMIT_MS); "off" — без
+группировки (DB_GROUP_MAX=1), тот же synchronous, но COMMIT на каждую операцию.
+
+    python bench/bench_economy.py
+    python bench/bench_economy.py --windows off,0,1,2,5,10 --sync FULL
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_economy.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from aiogram.filters import CommandObject
+from aiogram.types import Chat, User
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+WRITES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class FakeMsg:
+    def __init__(self, chat_id: int, uid: int, reply_uid: int | None = None):
+        self.chat = Chat(id=chat_id, type="supergroup")
+        self.from_user = User(id=uid, is_bot=False, first_name=f"u{uid}", username=f"user{uid}")
+        self.reply_to_message = FakeMsg(chat_id, reply_uid) if reply_uid else None
+        self.date = datetime.now()
+        self.text = ""
+        self.caption = None
+
+    async def reply(self, text, **kw):
+        return None
+
+
+def count_commits(mod) -> dict:
+    stat = {"commits": 0}
+    open_ = mod._db_open
+
+    def traced(path):
+        con = open_(path)
+
+        def cb(sql, con=con):
+            head = sql.lstrip()[:8].upper()
+            if head.startswith("COMMIT"):
+                stat["commits"] += 1
+            elif head.startswith(WRITES) and not con.in_transaction:
+                stat["commits"] += 1
+        con.set_trace_callback(cb)
+        return con
+
+    mod._db_open = traced
+    return stat
+
+
+async def one_op(mod, rnd, chats: int, users: int, lat: list):
+    t0 = time.perf_counter()
+    await _one_op(mod, rnd, chats, users)
+    lat.append((time.perf_counter() - t0) * 1000.0)
+
+
+async def _one_op(mod, rnd, chats: int, users: int):
+    chat_id = -1000 - rnd.randrange(chats)
+    uid = 1 + rnd.randrange(users)
+    settings = await mod.chat_settings(chat_id)
+    kind = rnd.random()
+    if kind < 0.6:
+        mode = rnd.choice(("low", "mid", "high"))
+        await mod.cmd_slot(FakeMsg(chat_id, uid), CommandObject(command="slot", args=f"{rnd.randint(1, 50)} {mode}"),
+                           settings=settings)
+    elif kind < 0.85:
+        other = 1 + (uid % users)
+        await mod.cmd_pay(FakeMsg(chat_id, uid, reply_uid=other), CommandObject(command="pay", args=str(rnd.randint(1, 30))),
+                          settings=settings)
+    elif kind < 0.95:
+        item = rnd.choice(("duel_kit", "slot_charm"))
+        await mod.cmd_buy(FakeMsg(chat_id, uid), CommandObject(command="buy", args=item), settings=settings)
+    else:
+        await mod.cmd_daily(FakeMsg(chat_id, uid), settings=settings)
+
+
+async def run(mod, stat, args):
+    mod.db_start()
+    for c in range(args.chats):
+        chat_id = -1000 - c
+        await mod.db_write(None, mod.ensure_chat, chat_id)
+        for uid in range(1, args.users + 1):
+            await mod.db_write(None, mod.wallet_set, chat_id, uid, args.balance)
+    per_client = args.n // args.clients
+    lat = []
+
+    async def client(seed: int):
+        rnd = random.Random(seed)
+        for _ in range(per_client):
+            await one_op(mod, rnd, args.chats, args.users, lat)
+
+    commits0 = stat["commits"]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - t0
+    ops = per_client * args.clients
+    negative = await mod.db_write(None, mod.db_one, "SELECT COUNT(*) FROM wallet WHERE balance < 0")
+    return ops, elapsed, stat["commits"] - commits0, int(negative[0]), lat
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("-n", type=int, default=20_000, help="операций всего")
+    ap.add_argument("--clients", type=int, default=50)
+    ap.add_argument("--chats", type=int, default=5)
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--balance", type=int, default=300, help="стартовый баланс")
+    ap.add_argument("--windows", default=None, help="окна group commit, мс, через запятую (off — без группировки)")
+    ap.add_argument("--sync", default=None, help="DB_GROUP_SYNC (FULL/NORMAL)")
+    args = ap.parse_args()
+
+    print(f"module={args.module}")
+    print(f"ops={args.n} clients={args.clients} chats={args.chats} users={args.users}")
+    for window in (args.windows.split(",") if args.windows else [None]):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+            mod = load_module(Path(args.module))
+            mod.DB_PATH = os.environ["DB_PATH"]
+            mod.SLOT_COOLDOWN_MIN = 0
+            grouped = hasattr(mod, "DB_GROUP_COMMIT_MS")
+            if grouped and args.sync:
+                mod.DB_GROUP_SYNC = args.sync
+            if grouped and window == "off":
+                mod.DB_GROUP_MAX = 1
+            elif grouped and window is not None:
+                mod.DB_GROUP_COMMIT_MS = float(window)
+            stat = count_commits(mod)
+            mod.init_db()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ops, elapsed, commits, negative, lat = asyncio.run(run(mod, stat, args))
+            mod.db_stop()
+
+        q = statistics.quantiles(lat, n=100)
+        label = (f"window={window if window == 'off' else f'{mod.DB_GROUP_COMMIT_MS:g}ms'} "
+                 f"sync={mod.DB_GROUP_SYNC}" if grouped else "no group commit")
+        print(f"{label:<28} ops/s={ops / elapsed:>6.0f}  commits/op={commits / ops:.3f}  "
+              f"latency ms p50={q[49]:.1f} p99={q[98]:.1f}  negative balances={negative}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
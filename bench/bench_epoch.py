@@ -0,0 +1,122 @@
+"""
+Бенчмарк: время в БД — isoformat-текст против целого epoch.
+
+Заливаем --rows строк msg_log (--chats чатов, через ingest_msg/ingest_write,
+как бот) и ещё --ledger проводок журнала, меряем размер msg_log и его индексов
+(dbstat) и скорость диапазонных запросов по ts: COUNT за случайное окно
+--window-min минут и get_user_counts за последние 50 минут (окно целиком в msg_log).
+
+--migrate: после замеров открываем ту же базу текущим weirdo.py (init_db +
+онлайн-перенос пачками, как в background_migrate), меряем перенос и повторяем замеры.
+
+    python bench/bench_epoch.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_epoch.py --module /tmp/weirdo_before.py --migrate
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, db_ts, load_module  # noqa: E402
+
+TABLES = ("msg_log", "idx_msg_log_chat_ts", "idx_msg_log_chat_user_ts", "token_ledger", "idx_ledger_chat_ts")
+
+
+def seed(mod, args, now: datetime, rnd: random.Random):
+    step = args.days * 86400 / args.rows
+    for i in range(args.rows):
+        ts = now - timedelta(seconds=(args.rows - i) * step)
+        mod.ingest_msg(-1000 - rnd.randrange(args.chats), ts, 1 + rnd.randrange(args.users))
+        if (i + 1) % 50_000 == 0:
+            mod.ingest_write(mod.ingest_take())
+    mod.ingest_write(mod.ingest_take() or mod._ingest_new())
+    with mod.db_tx():
+        for i in range(args.ledger):
+            ts = now - timedelta(seconds=(args.ledger - i) * 30)
+            mod.tx_log(-1000 - rnd.randrange(args.chats), ts, None, 1 + rnd.randrange(args.users),
+                       rnd.randint(1, 50), "daily")
+
+
+def measure(mod, args, now: datetime, rnd: random.Random, label: str):
+    sizes = dict(mod.db_all(
+        f"SELECT name, SUM(pgsize) FROM dbstat WHERE name IN ({','.join('?' * len(TABLES))}) GROUP BY name", TABLES))
+    span = args.days * 86400 - args.window_min * 60
+
+    def one_range():
+        a = now - timedelta(seconds=args.window_min * 60 + rnd.random() * span)
+        b = a + timedelta(minutes=args.window_min)
+        mod.db_one("SELECT COUNT(*) FROM msg_log WHERE chat_id=? AND ts>=? AND ts<?",
+                   (-1000 - rnd.randrange(args.chats), db_ts(mod, a), db_ts(mod, b)))
+
+    def one_counts():
+        mod.get_user_counts(-1000 - rnd.randrange(args.chats), now - timedelta(minutes=50))
+
+    print(label)
+    print("  size KB: " + "  ".join(f"{t}={sizes.get(t, 0) / 1024:.0f}" for t in TABLES))
+    for name, fn in ((f"range {args.window_min}m", one_range), ("user_counts 50m", one_counts)):
+        lat = []
+        for _ in range(args.n):
+            t0 = time.perf_counter()
+            fn()
+            lat.append((time.perf_counter() - t0) * 1e6)
+        q = statistics.quantiles(lat, n=100)
+        print(f"  {name:<16} us: mean={statistics.fmean(lat):.0f} p50={q[49]:.0f} p99={q[98]:.0f}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--rows", type=int, default=1_000_000, help="строк msg_log")
+    ap.add_argument("--ledger", type=int, default=200_000, help="проводок журнала")
+    ap.add_argument("--days", type=int, default=7, help="за сколько дней история")
+    ap.add_argument("--chats", type=int, default=10)
+    ap.add_argument("--users", type=int, default=300)
+    ap.add_argument("--window-min", type=int, default=60)
+    ap.add_argument("-n", type=int, default=2000, help="замеров")
+    ap.add_argument("--migrate", action="store_true", help="перевести базу текущим weirdo.py и замерить снова")
+    args = ap.parse_args()
+
+    now = datetime.now(ZoneInfo("Europe/Moscow"))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        t0 = time.perf_counter()
+        seed(mod, args, now, random.Random(1))
+        print(f"module={args.module}")
+        print(f"rows={args.rows} ledger={args.ledger} chats={args.chats} seed={time.perf_counter() - t0:.1f}s")
+        measure(mod, args, now, random.Random(2), "before" if args.migrate else "current")
+        mod.db_close_all()
+
+        if args.migrate:
+            new = load_module(ROOT / "weirdo.py")
+            new.DB_PATH = os.environ["DB_PATH"]
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                new.init_db()
+            t_init = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            moved = 0
+            while n := new.epoch_migrate_backfill():
+                moved += n
+            t_bg = time.perf_counter() - t0
+            print(f"migration: init_db {t_init * 1000:.0f}ms, online {moved} rows in {t_bg:.1f}s "
+                  f"({moved / t_bg:,.0f} rows/s, batch={new.EPOCH_MIGRATE_BATCH})")
+            new.db_exec("VACUUM")
+            measure(new, args, now, random.Random(2), "after (VACUUM)")
+            new.db_close_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Бенчмарк: строк активности в секунду (сообщения + слова + фразы).
+
+per-message — как было: на каждое сообщение свой INSERT в msg_log, executemany
+в word_log, INSERT в phrase_log и UPDATE last_message_at, каждый своей транзакцией.
+buffered    — ingest_msg/ingest_text/ingest_last_message + сброс ingest_write
+каждые --flush-rows строк одной транзакцией (слова/фразы — upsert счётчиков).
+
+    python bench/bench_ingest.py
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, WORDS, db_ts, load_module  # noqa: E402
+
+
+def make_texts(n: int, seed: int = 1):
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 12))) for _ in range(n)]
+
+
+def per_message(mod, texts, chats: int):
+    rows = 0
+    now = datetime.now(timezone.utc)
+    t0 = time.perf_counter()
+    for i, text in enumerate(texts):
+        chat_id = -1000 - i % chats
+        ts = db_ts(mod, now)
+        mod.db_exec("INSERT INTO msg_log(chat_id, ts, user_id) VALUES(?, ?, ?)", (chat_id, ts, i % 200))
+        words = [(chat_id, ts, w) for w in mod.tokenize(text) if len(w) >= 3]
+        if words:
+            mod.db_many("INSERT INTO word_log(chat_id, ts, word) VALUES(?, ?, ?)", words)
+        mod.db_exec("INSERT INTO phrase_log(chat_id, ts, phrase) VALUES(?, ?, ?)", (chat_id, ts, text))
+        mod.db_exec("UPDATE chat_settings SET last_message_at=? WHERE chat_id=?", (ts, chat_id))
+        rows += 2 + len(words)
+    return rows, time.perf_counter() - t0
+
+
+def buffered(mod, texts, chats: int, flush_rows: int):
+    rows = 0
+    now = datetime.now(timezone.utc)
+    mod.INGEST_FLUSH_ROWS = flush_rows
+    t0 = time.perf_counter()
+    for i, text in enumerate(texts):
+        chat_id = -1000 - i % chats
+        mod.ingest_msg(chat_id, now, i % 200)
+        mod.ingest_text(chat_id, now, text)
+        mod.ingest_last_message(chat_id, now)
+        if mod._ingest_rows >= flush_rows:
+            batch = mod.ingest_take()
+            rows += mod.ingest_batch_rows(batch)
+            mod.ingest_write(batch)
+    batch = mod.ingest_take()
+    if batch:
+        rows += mod.ingest_batch_rows(batch)
+        mod.ingest_write(batch)
+    return rows, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=5000, help="сообщений")
+    ap.add_argument("--chats", type=int, default=20)
+    ap.add_argument("--flush-rows", type=int, default=500)
+    args = ap.parse_args()
+
+    texts = make_texts(args.n)
+    for mode in ("per-message", "buffered"):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+            mod = load_module(ROOT / "weirdo.py")
+            mod.DB_PATH = os.environ["DB_PATH"]
+            mod.init_db()
+            for i in range(args.chats):
+                mod.ensure_chat(-1000 - i)
+            if mode == "per-message":
+                rows, elapsed = per_message(mod, texts, args.chats)
+            else:
+                rows, elapsed = buffered(mod, texts, args.chats, args.flush_rows)
+            mod.db_close_all()
+        print(f"{mode:12s} rows={rows} elapsed={elapsed:.3f}s rows/s={rows / elapsed:,.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
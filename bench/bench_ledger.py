@@ -0,0 +1,100 @@
+"""
+Бенчмарк: журнал токенов — стоимость tx_log и ответа /rank (spent_in_shop)
+при длинной истории чата.
+
+История: --rows проводок в одном чате, --users юзеров, виды как в жизни
+(слоты, переводы, daily, покупки). Дальше меряем spent_in_shop по случайным
+юзерам и tx_log (внутри транзакции, как в операциях экономики).
+
+    python bench/bench_ledger.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_ledger.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+CHAT = -1000
+KINDS = (("slot_bet", 40), ("slot_win", 25), ("pay", 15), ("daily", 12), ("buy", 8))
+
+
+def seed(mod, rows: int, users: int, rnd: random.Random):
+    kinds = [k for k, w in KINDS for _ in range(w)]
+    t0 = datetime.now(timezone.utc) - timedelta(days=365)
+    with mod.db_tx():
+        for i in range(rows):
+            ts = t0 + timedelta(seconds=i * 30)
+            log_one(mod, ts, rnd.choice(kinds), rnd, users)
+
+
+def log_one(mod, ts, kind: str, rnd: random.Random, users: int):
+    uid = 1 + rnd.randrange(users)
+    amount = rnd.randint(1, 200)
+    if kind == "buy":
+        mod.tx_log(CHAT, ts, uid, None, amount, kind, meta="item=duel_kit")
+    elif kind == "pay":
+        mod.tx_log(CHAT, ts, uid, 1 + rnd.randrange(users), amount, kind, meta="fee=1")
+    elif kind in ("slot_bet", "slot_win"):
+        src, dst = (uid, None) if kind == "slot_bet" else (None, uid)
+        mod.tx_log(CHAT, ts, src, dst, amount, kind, meta="mode=mid,mult=1.3")
+    else:
+        mod.tx_log(CHAT, ts, None, uid, amount, kind, meta="base=30,bonus=0,streak=1,msg24h=0")
+
+
+def timed(fn, n: int) -> list[float]:
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--rows", type=int, default=200_000, help="проводок в истории чата")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("-n", type=int, default=2000, help="замеров")
+    args = ap.parse_args()
+
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+
+        t0 = time.perf_counter()
+        seed(mod, args.rows, args.users, rnd)
+        seed_s = time.perf_counter() - t0
+
+        rank = timed(lambda: mod.spent_in_shop(CHAT, 1 + rnd.randrange(args.users)), args.n)
+        now = datetime.now(timezone.utc)
+        kinds = [k for k, w in KINDS for _ in range(w)]
+
+        def one_tx():
+            with mod.db_tx():
+                log_one(mod, now, rnd.choice(kinds), rnd, args.users)
+        log = timed(one_tx, args.n)
+        size = os.path.getsize(os.environ["DB_PATH"]) + os.path.getsize(os.environ["DB_PATH"] + "-wal")
+        mod.db_close_all()
+
+    print(f"module={args.module}")
+    print(f"rows={args.rows} users={args.users} seed={seed_s:.1f}s db+wal={size / 1e6:.1f}MB")
+    for name, lat in (("spent_in_shop", rank), ("tx_log", log)):
+        q = statistics.quantiles(lat, n=100)
+        print(f"{name:<14} us: mean={statistics.fmean(lat):.0f} p50={q[49]:.0f} p99={q[98]:.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
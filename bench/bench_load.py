@@ -0,0 +1,342 @@
+"""
+Нагрузочный бенчмарк: синтетические апдейты через настоящий диспетчер (dp.feed_update).
+
+Бот — настоящий aiogram Bot, но с FakeSession: исходящие вызовы API не уходят
+в Telegram, а пишутся в счётчик по методам (и отдают правдоподобный ответ:
+Message на send*, True на остальное). Работают мидлвари, фильтры, хендлеры,
+поток-писатель, сброс буфера логов и сторож дуэлей — всё как в main(), кроме
+поллинга. База — временный файл.
+
+Трафик — смесь --mix (веса через запятую; вес — доля "действий", дуэль —
+это несколько апдейтов подряд):
+    msg       обычное сообщение (any_message)
+    plus      "+" ответом на сообщение другого юзера (rep_by_reply)
+    slot      /slot <ставка> <режим>
+    daily     /daily
+    whereall  /whereall 7d
+    duel      /duel ответом на юзера -> accept от вызванного -> ходы по очереди
+              (--duel-moves) -> сдача, если дуэль ещё идёт; каждый шаг — свой апдейт
+--clients корутин шлют апдейты параллельно (как handle_as_tasks у поллинга).
+
+Меряем задержку feed_update (p50/p95/p99, всего и по видам), апдейтов в
+секунду, SQL-инструкций на апдейт (trace callback на всех соединениях;
+инструкции триггеров не считаем) и пиковый RSS процесса (ru_maxrss: базовый —
+после засева, и пик после нагрузки). Кулдауны /slot и /whereall выключены,
+чтобы мерить их настоящую работу, а не ответ "КД"; --cooldowns — как в проде.
+
+Сетка по чатам/юзерам: каждая ячейка — отдельный процесс (иначе пиковый RSS
+копится между ячейками).
+
+    python bench/bench_load.py
+    python bench/bench_load.py --chats 1,10,100 --users 20,200 -n 20000
+    python bench/bench_load.py --mix msg=1 --clients 1
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_load.py --module /tmp/weirdo_before.py
+
+С METRICS_PORT в окружении включаются метрики (мидлвари хендлеров и API,
+замер SQL) — так меряется их цена; сам HTTP-эндпоинт бенч не поднимает:
+    METRICS_PORT=9108 python bench/bench_load.py --clients 1
+
+--record FILE дописывает поток апдейтов в FILE так же, как RECORD_UPDATES
+(приватность — RECORD_TEXT), — синтетическая запись для `weirdo.py replay`:
+    python bench/bench_load.py -n 5000 --record /tmp/traffic.jsonl.gz
+    python weirdo.py replay /tmp/traffic.jsonl.gz --speed max --profile /tmp/replay.pstats
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, Update, User
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, WORDS, load_module  # noqa: E402
+
+BOT_TOKEN = "123456789:AAbenchbenchbenchbenchbenchbenchbenc"
+BOT_USER = User(id=123456789, is_bot=True, first_name="weirdo", username="weirdo_bot")
+MIX = "msg=70,plus=8,slot=10,daily=4,whereall=3,duel=5"
+
+
+class FakeSession(BaseSession):
+    """Сессия, которая ничего не шлёт: считает вызовы и отдаёт ответ нужного типа."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self._ids = itertools.count(10_000_000)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        if getattr(method, "show_alert", None):
+            name += "(alert)"  # отказ: не твой ход, дуэль не найдена, ...
+        self.calls[name] += 1
+        if method.__returning__ is Message:
+            return Message(
+                message_id=next(self._ids),
+                date=int(time.time()),
+                chat=Chat(id=method.chat_id, type="supergroup"),
+                from_user=BOT_USER,
+                text=getattr(method, "text", None),
+                reply_markup=getattr(method, "reply_markup", None),
+            ).as_(bot)
+        # bool и Union[Message, bool] у edit_* — как для inline-сообщений
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def count_statements(mod) -> dict:
+    stat = {"sql": 0}
+    open_ = mod._db_open
+
+    def traced(path):
+        con = open_(path)
+
+        def cb(sql):
+            if not sql.startswith("--"):  # "-- TRIGGER ..." — тело триггера
+                stat["sql"] += 1
+        con.set_trace_callback(cb)
+        return con
+
+    mod._db_open = traced
+    return stat
+
+
+def parse_mix(s: str) -> tuple[list[str], list[float]]:
+    kinds, weights = [], []
+    for part in s.split(","):
+        k, w = part.split("=")
+        kinds.append(k.strip())
+        weights.append(float(w))
+    return kinds, weights
+
+
+class Traffic:
+    def __init__(self, mod, bot: Bot, args):
+        self.mod = mod
+        self.bot = bot
+        self.args = args
+        self.ids = itertools.count(1)
+        self.lat = defaultdict(list)
+        self.sent = 0
+
+    def user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def message(self, chat_id: int, uid: int, text: str, reply_to: dict | None = None) -> dict:
+        m = {
+            "message_id": next(self.ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": self.user(uid),
+            "text": text,
+        }
+        if reply_to:
+            m["reply_to_message"] = reply_to
+        return m
+
+    async def feed(self, kind: str, payload: dict):
+        upd = Update.model_validate({"update_id": next(self.ids), **payload}, context={"bot": self.bot})
+        t0 = time.perf_counter()
+        await self.mod.dp.feed_update(self.bot, upd)
+        self.lat[kind].append((time.perf_counter() - t0) * 1000.0)
+        self.sent += 1
+
+    async def callback(self, kind: str, chat_id: int, uid: int, data: str, message: Message):
+        msg = message.model_dump(mode="json", exclude_none=True, by_alias=True)
+        msg["chat"] = {"id": chat_id, "type": "supergroup", "title": "bench"}
+        await self.feed(kind, {"callback_query": {
+            "id": str(next(self.ids)), "from": self.user(uid), "chat_instance": "bench",
+            "message": msg, "data": data,
+        }})
+
+    async def duel(self, rnd: random.Random, chat_id: int, a: int, b: int):
+        mod = self.mod
+        target = self.message(chat_id, b, rnd.choice(WORDS))
+        invite = self.message(chat_id, a, f"/duel {rnd.choice((0, 0, 5, 10))}", reply_to=target)
+        await self.feed("duel", {"message": invite})
+        # приглашение, которое только что завёл a против b, — ищем в реестре
+        duel = next((d for d in list(mod._duels.values())
+                     if d.chat_id == chat_id and d.a_id == a and d.b_id == b and d.state == "pending"), None)
+        if duel is None:
+            return  # у b уже висит приглашение или у a не хватило на ставку
+        stub = Message(message_id=invite["message_id"] + 1, date=int(time.time()),
+                       chat=Chat(id=chat_id, type="supergroup"), from_user=BOT_USER, text="duel")
+        await self.callback("duel", chat_id, b, f"duel:accept:{duel.duel_id}", stub)
+        for i in range(self.args.duel_moves):
+            if duel.state != "active":
+                return
+            uid = (a, b)[i % 2]
+            await self.callback("duel", chat_id, uid, f"duel:act:{duel.duel_id}:{rnd.choice(('shoot', 'aim', 'dodge', 'reload'))}", stub)
+        if duel.state == "active":
+            await self.callback("duel", chat_id, duel.data.turn or a, f"duel:act:{duel.duel_id}:surrender", stub)
+
+    async def one(self, rnd: random.Random, kind: str):
+        args = self.args
+        chat_id = -1000 - rnd.randrange(args.chats)
+        uid = 1 + rnd.randrange(args.users)
+        other = 1 + (uid + rnd.randrange(args.users - 1)) % args.users
+        if kind == "msg":
+            text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 12)))
+            await self.feed(kind, {"message": self.message(chat_id, uid, text)})
+        elif kind == "plus":
+            target = self.message(chat_id, other, rnd.choice(WORDS))
+            await self.feed(kind, {"message": self.message(chat_id, uid, "+", reply_to=target)})
+        elif kind == "slot":
+            text = f"/slot {rnd.randint(1, 30)} {rnd.choice(('low', 'mid', 'high'))}"
+            await self.feed(kind, {"message": self.message(chat_id, uid, text)})
+        elif kind == "daily":
+            await self.feed(kind, {"message": self.message(chat_id, uid, "/daily")})
+        elif kind == "whereall":
+            await self.feed(kind, {"message": self.message(chat_id, uid, "/whereall 7d")})
+        elif kind == "duel":
+            await self.duel(rnd, chat_id, uid, other)
+        else:
+            raise SystemExit(f"unknown traffic kind: {kind}")
+
+
+def quantiles(lat: list[float]) -> tuple[float, float, float]:
+    if len(lat) < 2:
+        v = lat[0] if lat else 0.0
+        return v, v, v
+    q = statistics.quantiles(lat, n=100)
+    return q[49], q[94], q[98]
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(mod, args) -> dict:
+    kinds, weights = parse_mix(args.mix)
+    stat = count_statements(mod)
+    mod.db_start()
+    await mod.db_write(None, mod.init_db)
+    await mod.db_write(None, mod.duel_registry_load)
+
+    def seed():
+        with mod.db_tx():
+            for c in range(args.chats):
+                mod.ensure_chat(-1000 - c)
+                for uid in range(1, args.users + 1):
+                    mod.wallet_set(-1000 - c, uid, args.balance)
+    await mod.db_write(None, seed)
+
+    bot = Bot(BOT_TOKEN, session=FakeSession())
+    if args.record:
+        mod.dp.update.outer_middleware(mod.UpdateRecorder())
+    if getattr(mod, "METRICS_PORT", 0):
+        mod.metrics_install(bot)
+    tasks = [asyncio.create_task(mod.background_ingest_flusher()),
+             asyncio.create_task(mod.background_duel_watcher(bot))]
+    traffic = Traffic(mod, bot, args)
+    rss0 = rss_mb()
+    sql0 = stat["sql"]
+
+    async def client(seed_: int):
+        rnd = random.Random(seed_)
+        while traffic.sent < args.n:
+            await traffic.one(rnd, rnd.choices(kinds, weights)[0])
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(args.clients)))
+    elapsed = time.perf_counter() - t0
+    sql = stat["sql"] - sql0
+
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await mod.ingest_flush()
+    if args.record:
+        mod.record_write(args.record, mod.record_take())
+    await bot.session.close()
+    mod.db_stop()
+
+    every = [x for v in traffic.lat.values() for x in v]
+    return {
+        "chats": args.chats, "users": args.users, "updates": traffic.sent,
+        "elapsed": elapsed, "ups": traffic.sent / elapsed, "sql_per_update": sql / traffic.sent,
+        "all": quantiles(every),
+        "kinds": {k: (len(v), *quantiles(v)) for k, v in sorted(traffic.lat.items())},
+        "api": dict(bot.session.calls), "rss0": rss0, "rss": rss_mb(),
+    }
+
+
+def run_cell(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        if not args.cooldowns:
+            mod.SLOT_COOLDOWN_MIN = 0
+            mod.WHEREALL_COOLDOWN_MIN = 0
+        # any_message печатает каждое сообщение — в бенче это только шум
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return asyncio.run(run(mod, args))
+
+
+def report(r: dict, verbose: bool):
+    p50, p95, p99 = r["all"]
+    print(f"chats={r['chats']:<4} users={r['users']:<5} updates={r['updates']:<6} ups={r['ups']:>6.0f}  "
+          f"latency ms p50={p50:.2f} p95={p95:.2f} p99={p99:.2f}  sql/update={r['sql_per_update']:.1f}  "
+          f"rss MB {r['rss0']:.0f} -> {r['rss']:.0f}")
+    if verbose:
+        for kind, (n, k50, k95, k99) in r["kinds"].items():
+            print(f"    {kind:<9} n={n:<6} p50={k50:.2f} p95={k95:.2f} p99={k99:.2f}")
+        print("    api: " + " ".join(f"{k}={v}" for k, v in sorted(r["api"].items())))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("-n", type=int, default=10_000, help="апдейтов на ячейку")
+    ap.add_argument("--clients", type=int, default=20)
+    ap.add_argument("--chats", default="10", help="через запятую — сетка")
+    ap.add_argument("--users", default="50", help="юзеров на чат, через запятую — сетка")
+    ap.add_argument("--mix", default=MIX)
+    ap.add_argument("--duel-moves", type=int, default=6)
+    ap.add_argument("--balance", type=int, default=500, help="стартовый баланс")
+    ap.add_argument("--cooldowns", action="store_true", help="кулдауны /slot и /whereall как в проде")
+    ap.add_argument("--record", metavar="FILE", help="записать апдейты для weirdo.py replay (.jsonl.gz)")
+    ap.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    chats = [int(x) for x in args.chats.split(",")]
+    users = [int(x) for x in args.users.split(",")]
+    if args.json or (len(chats) == 1 and len(users) == 1):
+        args.chats, args.users = chats[0], users[0]
+        r = run_cell(args)
+        if args.json:
+            print(json.dumps(r))
+        else:
+            print(f"module={args.module} mix={args.mix} clients={args.clients}")
+            report(r, verbose=True)
+        return
+
+    print(f"module={args.module} mix={args.mix} clients={args.clients}")
+    base = [a for a in sys.argv[1:]]
+    for c, u in itertools.product(chats, users):
+        out = subprocess.run([sys.executable, __file__, *base, "--chats", str(c), "--users", str(u), "--json"],
+                             check=True, capture_output=True, text=True).stdout
+        report(json.loads(out.strip().splitlines()[-1]), verbose=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Бенчмарк: лаг event loop под нагрузкой any_message.
+
+Параллельно гоняем --concurrency потоков сообщений и каждые 10мс меряем,
+насколько позже просыпается asyncio.sleep(). В один чат заранее
+подкладываем --old строк старше 7 дней, чтобы чистка логов была тяжёлой:
+в старых версиях её делает prune_logs внутри any_message, в новых —
+retention_run_once(), который запускаем рядом с потоком сообщений.
+
+    python bench/bench_loop_lag.py
+    python bench/bench_loop_lag.py --module /tmp/weirdo_before.py
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, FakeBot, db_ts, feed, load_module, make_messages  # noqa: E402
+
+
+def seed_old_rows(mod, path: str, chat_id: int, n: int):
+    ts = db_ts(mod, datetime.now(timezone.utc) - timedelta(days=10))
+    con = sqlite3.connect(path)
+    con.executemany(
+        "INSERT INTO msg_log(chat_id, ts, user_id) VALUES(?, ?, ?)",
+        ((chat_id, ts, i % 100) for i in range(n)),
+    )
+    con.executemany(
+        "INSERT INTO word_log(chat_id, ts, word) VALUES(?, ?, ?)",
+        ((chat_id, ts, f"w{i % 5000}") for i in range(n)),
+    )
+    con.commit()
+    con.close()
+
+
+def pct(xs, p):
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+async def run(mod, msgs, concurrency: int):
+    bot = FakeBot()
+    lags = []
+    stop = False
+
+    async def sampler():
+        loop = asyncio.get_running_loop()
+        while not stop:
+            t0 = loop.time()
+            await asyncio.sleep(0.01)
+            lags.append(max(0.0, (loop.time() - t0 - 0.01) * 1000.0))
+
+    q = asyncio.Queue()
+    for m in msgs:
+        q.put_nowait(m)
+
+    async def worker():
+        while not q.empty():
+            await feed(mod, q.get_nowait(), bot)
+
+    samp = asyncio.create_task(sampler())
+    t0 = time.perf_counter()
+    jobs = [worker() for _ in range(concurrency)]
+    if hasattr(mod, "retention_run_once"):
+        jobs.append(mod.retention_run_once())
+    await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - t0
+    stop = True
+    await samp
+    if hasattr(mod, "retention_stats"):
+        st = mod.retention_stats()
+        print(f"retention: deleted={st['last_deleted']} in {st['last_ms']:.0f}ms", file=sys.stderr)
+    return elapsed, lags
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("-n", type=int, default=3000)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--chats", type=int, default=20)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--old", type=int, default=300_000, help="старых строк для тяжёлого prune")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        os.environ["DB_PATH"] = path
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = path
+        mod.EASTER_PROB = 0.0
+        mod.AUTO_HYPE_PROB = 0.0
+        mod.init_db()
+        mod.ensure_chat(-1000)
+        seed_old_rows(mod, path, -1000, args.old)
+
+        msgs = make_messages(args.n, args.chats, args.users)
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, lags = asyncio.run(run(mod, msgs, args.concurrency))
+        if hasattr(mod, "db_stop"):
+            mod.db_stop()
+        elif hasattr(mod, "db_close_all"):
+            mod.db_close_all()
+
+    print(f"module={args.module}")
+    print(f"messages={args.n} concurrency={args.concurrency} old_rows={args.old}")
+    print(f"msg/s={args.n / elapsed:.1f}")
+    print(
+        f"loop lag ms: p50={pct(lags, 0.50):.1f} p99={pct(lags, 0.99):.1f} "
+        f"max={max(lags) if lags else 0.0:.1f} samples={len(lags)}"
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
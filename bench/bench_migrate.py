@@ -0,0 +1,154 @@
+"""
+Бенчмарк: миграции схемы — цена старта на актуальной базе и апгрейд старой.
+
+1) Старт: init_db на уже актуальной базе, -n раз. Для --module — как он есть
+   (до SCHEMA MIGRATIONS это прогон всех CREATE IF NOT EXISTS и проверок
+   колонок), для текущего weirdo.py — чтение PRAGMA user_version.
+2) Апгрейд: база, заполненная --module (--rows сообщений, --ledger операций
+   экономики), открывается текущим weirdo.py: план --dry-run, сколько init_db
+   держит старт, сколько дожимает фон. С --interrupt перенос рвётся после
+   --interrupt пачек и продолжается со следующего старта.
+
+    python bench/bench_migrate.py
+    git show <rev>:weirdo.py > /tmp/weirdo_before.py
+    python bench/bench_migrate.py --module /tmp/weirdo_before.py --interrupt 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+
+class Interrupted(Exception):
+    pass
+
+
+def seed(mod, args, now: datetime, rnd: random.Random):
+    for i in range(args.rows):
+        mod.ingest_msg(-1000 - rnd.randrange(args.chats), now - timedelta(seconds=(args.rows - i) * 5),
+                       1 + rnd.randrange(args.users))
+        if (i + 1) % 50_000 == 0:
+            mod.ingest_write(mod.ingest_take())
+    mod.ingest_write(mod.ingest_take() or mod._ingest_new())
+    for c in range(args.chats):
+        for uid in range(1, args.users + 1):
+            mod.wallet_add(-1000 - c, uid, 1000)
+    for i in range(args.ledger):
+        mod.econ_slot(-1000 - rnd.randrange(args.chats), 1 + rnd.randrange(args.users), "mid",
+                      rnd.randint(1, 20), now - timedelta(seconds=args.ledger - i))
+
+
+def startup(mod, n: int) -> list[float]:
+    out = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(n):
+            t0 = time.perf_counter()
+            mod.init_db()
+            out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+def interrupt_after(new, batches: int):
+    """Оборвать backfill-и после batches пачек (как kill посреди переноса)."""
+    left = [batches]
+    saved = [(m, m.backfill) for m in new.MIGRATIONS if m.backfill]
+
+    def wrap(fn):
+        def inner(batch):
+            if left[0] <= 0:
+                raise Interrupted
+            left[0] -= 1
+            return fn(batch)
+        return inner
+
+    for m, fn in saved:
+        m.backfill = wrap(fn)
+    return lambda: [setattr(m, "backfill", fn) for m, fn in saved]
+
+
+def upgrade(new) -> tuple[float, float]:
+    """-> (сколько держит старт init_db, сколько дожимает фон — как background_migrate, без потока-писателя)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        new.init_db()
+        t_init = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        while new.migrate_pending():
+            v = new.schema_version()
+            m = new.MIGRATIONS[v]
+            new.migrate_apply(m)
+            while m.backfill and m.backfill(new.MIGRATE_BATCH):
+                pass
+            new.migrate_mark(v + 1)
+        return t_init, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"), help="чем создать и заполнить старую базу")
+    ap.add_argument("--rows", type=int, default=300_000, help="сообщений")
+    ap.add_argument("--ledger", type=int, default=50_000, help="операций /slot")
+    ap.add_argument("--chats", type=int, default=5)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--interrupt", type=int, default=0, help="оборвать перенос после стольких пачек")
+    ap.add_argument("-n", type=int, default=2000, help="замеров старта")
+    args = ap.parse_args()
+
+    now = datetime.now(ZoneInfo("Europe/Moscow"))
+    print(f"module={args.module}")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        old = load_module(Path(args.module))
+        old.DB_PATH = os.environ["DB_PATH"]
+        old.SLOT_COOLDOWN_MIN = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            old.init_db()
+        t0 = time.perf_counter()
+        seed(old, args, now, random.Random(1))
+        print(f"rows={args.rows} ledger={args.ledger} chats={args.chats} seed={time.perf_counter() - t0:.1f}s")
+        lat = startup(old, args.n)
+        old.db_close_all()
+
+        new = load_module(ROOT / "weirdo.py")
+        new.DB_PATH = os.environ["DB_PATH"]
+        print(f"dry-run: v{new.schema_version()} -> v{new.SCHEMA_VERSION}")
+        for v, name, rows in new.migrate_plan():
+            print(f"  v{v} {name}: ~{rows} rows")
+
+        restarts = 0
+        while True:
+            restore = interrupt_after(new, args.interrupt) if args.interrupt and not restarts else None
+            try:
+                t_init, t_bg = upgrade(new)
+            except Interrupted:
+                restarts += 1
+                print(f"  interrupted after {args.interrupt} batches at v{new.schema_version()}, left: "
+                      f"{[(v, rows) for v, _name, rows in new.migrate_plan() if rows]}")
+                continue
+            finally:
+                if restore:
+                    restore()
+            break
+        print(f"upgrade: init_db {t_init * 1000:.0f}ms, background {t_bg * 1000:.0f}ms, restarts={restarts}, "
+              f"now v{new.schema_version()}, integrity={new.db_one('PRAGMA integrity_check')[0]}")
+        cur = startup(new, args.n)
+        new.db_close_all()
+
+    for name, ls in (("init_db (module)", lat), ("init_db (current)", cur)):
+        q = statistics.quantiles(ls, n=100)
+        print(f"{name:<18} us: mean={statistics.fmean(ls):.0f} p50={q[49]:.0f} p99={q[98]:.0f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
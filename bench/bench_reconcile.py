@@ -0,0 +1,163 @@
+"""
+Бенчмарк: сверка журнала токенов (reconcile_all) — скорость и память.
+
+Синтетика: --chats чатов по --rows проводок (слоты, переводы, покупки, daily,
+ставки дуэлей), кошельки/казна/джекпот/ставки записаны ровно так, как их
+оставил бы журнал. Потом портим --drift кошельков в каждом чате и казну
+в первом, гоняем reconcile_all с разным числом процессов и проверяем, что
+найдено ровно испорченное, а после reconcile_fix расхождений нет.
+
+Пиковую память сверки (tracemalloc, один процесс) меряем на --rows и на
+4x --rows: журнал читается кусками, так что она от длины истории не растёт.
+RSS тут не показатель — в нём страницы mmap базы и импорт aiogram.
+Процессов reconcile_all берёт не больше, чем ядер (os.cpu_count()).
+
+    python bench/bench_reconcile.py
+    python bench/bench_reconcile.py --rows 1000000 --workers 1,4
+"""
+import argparse
+import os
+import random
+import tracemalloc
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import weirdo  # noqa: E402  (spawn-воркерам нужен импортируемый модуль, не load_module)
+
+
+def seed(mod, chats: int, rows: int, users: int, rnd: random.Random):
+    k = mod.TX_KIND
+    t0 = datetime.now(timezone.utc) - timedelta(days=365)
+    for c in range(chats):
+        chat_id = -1000 - c
+        wallets = {uid: 0 for uid in range(1, users + 1)}
+        treasury = jackpot = 0
+        bets = []
+        out = []
+        for i in range(rows):
+            ts = mod.epoch(t0 + timedelta(seconds=i * 7))
+            uid = 1 + rnd.randrange(users)
+            r = rnd.random()
+            if r < 0.15 or wallets[uid] < 60:
+                amount = rnd.randint(20, 60)
+                wallets[uid] += amount
+                out.append((chat_id, ts, k["daily"], None, uid, amount, None, 0, 0, 0))
+            elif r < 0.55:
+                bet = rnd.randint(1, 50)
+                tr, jp = bet * mod.TREASURY_PCT // 100, bet * mod.JACKPOT_PCT // 100
+                wallets[uid] -= bet
+                treasury += tr
+                jackpot += jp
+                out.append((chat_id, ts, k["slot_bet"], uid, None, bet, None, 0, tr, jp))
+                win = int(bet * rnd.choice((0, 0, 0.5, 1, 1, 2)))
+                if win:
+                    wallets[uid] += win
+                    out.append((chat_id, ts, k["slot_win"], None, uid, win, None, 0, 0, 0))
+            elif r < 0.75:
+                other = 1 + rnd.randrange(users)
+                amount = rnd.randint(1, 40)
+                fee = max(1, amount * mod.PAY_FEE_PCT // 100)
+                wallets[uid] -= amount + fee
+                wallets[other] += amount
+                treasury += fee
+                out.append((chat_id, ts, k["pay"], uid, other, amount, None, fee, fee, 0))
+            elif r < 0.85:
+                price = rnd.randint(10, 50)
+                wallets[uid] -= price
+                treasury += price
+                out.append((chat_id, ts, k["buy"], uid, None, price, None, 0, price, 0))
+            else:
+                duel = f"d{c}_{i}"
+                bet = rnd.randint(5, 30)
+                wallets[uid] -= bet
+                out.append((chat_id, ts, k["duel_bet_lock"], uid, None, bet, duel, 0, 0, 0))
+                if rnd.random() < 0.1:
+                    bets.append((duel, chat_id, bet))  # висит открытой
+                else:
+                    wallets[uid] += bet
+                    out.append((chat_id, ts, k["duel_bet_refund"], None, uid, bet, duel, 0, 0, 0))
+        with mod.db_tx() as con:
+            con.executemany("""
+            INSERT INTO token_ledger(chat_id, ts, kind, from_user_id, to_user_id, amount, duel_id, fee, treasury, jackpot)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, out)
+            con.executemany("INSERT INTO wallet(chat_id, user_id, balance) VALUES(?, ?, ?)",
+                            [(chat_id, uid, bal) for uid, bal in wallets.items()])
+            con.execute("INSERT INTO treasury(chat_id, amount) VALUES(?, ?)", (chat_id, treasury))
+            con.execute("INSERT INTO jackpot_pool(chat_id, amount) VALUES(?, ?)", (chat_id, jackpot))
+            con.executemany("""
+            INSERT INTO duel_bets(duel_id, chat_id, bet, a_paid, b_paid) VALUES(?, ?, ?, 1, 0)
+            """, bets)
+
+
+def corrupt(mod, chats: int, users: int, drift: int, rnd: random.Random) -> set:
+    bad = set()
+    with mod.db_tx() as con:
+        for c in range(chats):
+            chat_id = -1000 - c
+            for uid in rnd.sample(range(1, users + 1), drift):
+                con.execute("UPDATE wallet SET balance = balance + ? WHERE chat_id=? AND user_id=?",
+                            (rnd.choice((-1, 1)) * rnd.randint(1, 100), chat_id, uid))
+                bad.add((chat_id, uid))
+        con.execute("UPDATE treasury SET amount = amount + 7 WHERE chat_id=-1000")
+    return bad
+
+
+def run(mod, args, rows: int, rnd: random.Random):
+    with tempfile.TemporaryDirectory() as tmp:
+        mod.DB_PATH = os.path.join(tmp, "bench.db")
+        mod.init_db()
+        t0 = time.perf_counter()
+        seed(mod, args.chats, rows, args.users, rnd)
+        seed_s = time.perf_counter() - t0
+        bad = corrupt(mod, args.chats, args.users, args.drift, rnd)
+        total = mod.db_one("SELECT COUNT(*) FROM token_ledger")[0]
+        print(f"rows={rows}/chat chats={args.chats} ledger={total} seed={seed_s:.1f}s")
+
+        for w in [int(x) for x in args.workers.split(",")]:
+            t0 = time.perf_counter()
+            reports = mod.reconcile_all(mod.DB_PATH, workers=w, chunk=args.chunk)
+            dt = time.perf_counter() - t0
+            found = {(r["chat_id"], uid) for r in reports for uid, _want, _have in r["wallets"]}
+            pools = [r["chat_id"] for r in reports if r["treasury"][0] != r["treasury"][1]]
+            escrow = [r["chat_id"] for r in reports if r["escrow"][0] != r["escrow"][1]]
+            ok = found == bad and pools == [-1000] and not escrow
+            print(f"  workers={w} {dt:.2f}s rows/s={total / dt:,.0f} drift wallets={len(found)} "
+                  f"pools={pools} escrow={escrow} {'OK' if ok else 'MISMATCH'}")
+
+        tracemalloc.start()
+        mod.reconcile_all(mod.DB_PATH, workers=1, chunk=args.chunk)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  peak python heap (workers=1, chunk={args.chunk}): {peak / 1e6:.1f}MB")
+
+        now = datetime.now(timezone.utc)
+        fixes = sum(mod.reconcile_fix(r["chat_id"], now, args.chunk)
+                    for r in reports if mod.reconcile_has_drift(r))
+        left = [r for r in mod.reconcile_all(mod.DB_PATH, workers=1, chunk=args.chunk) if mod.reconcile_has_drift(r)]
+        print(f"  fix: adjust entries={fixes} drift after={len(left)}")
+        mod.db_close_all()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=250_000, help="проводок на чат")
+    ap.add_argument("--chats", type=int, default=4)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--drift", type=int, default=5, help="испорченных кошельков на чат")
+    ap.add_argument("--chunk", type=int, default=weirdo.RECONCILE_CHUNK)
+    ap.add_argument("--workers", default="1,2,4")
+    args = ap.parse_args()
+
+    print(f"cpu_count={os.cpu_count()}")
+    rnd = random.Random(1)
+    run(weirdo, args, args.rows, rnd)
+    run(weirdo, args, args.rows * 4, rnd)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
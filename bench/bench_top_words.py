@@ -0,0 +1,94 @@
+"""
+Бенчмарк: топ слов/фраз за 24h и 7d (get_top_words / get_top_phrase).
+
+raw    — как было: GROUP BY word по word_log за весь период
+rollup — суммы часовых/суточных счётчиков word_* / phrase_*
+
+Одни и те же сообщения пишем и в word_log/phrase_log, и через буфер
+в счётчики; since выравниваем на час, так что ответы должны совпасть.
+
+    python bench/bench_top_words.py
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, WORDS, db_ts, load_module  # noqa: E402
+
+CHAT = -1000
+
+
+def seed(mod, n: int, days: int, vocab: int, seed: int = 1):
+    rnd = random.Random(seed)
+    # словарь с длинным хвостом: частые WORDS + много редких
+    vocab_words = WORDS + [f"слово{i}" for i in range(vocab)]
+    weights = [1.0 / (i + 1) for i in range(len(vocab_words))]
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    raw_words, raw_phrases = [], []
+    for i in range(n):
+        ts = now - timedelta(seconds=1 + rnd.randrange(days * 86400))
+        text = " ".join(rnd.choices(vocab_words, weights, k=rnd.randint(2, 10)))
+        ts_s = db_ts(mod, ts)
+        raw_words.extend((CHAT, ts_s, w) for w in mod.tokenize(text) if len(w) >= 3)
+        raw_phrases.append((CHAT, ts_s, mod.normalize_phrase(text)))
+        mod.ingest_text(CHAT, ts, text)
+        if mod._ingest_rows >= 20000:
+            mod.ingest_write(mod.ingest_take())
+    batch = mod.ingest_take()
+    if batch:
+        mod.ingest_write(batch)
+    mod.db_many("INSERT INTO word_log(chat_id, ts, word) VALUES(?, ?, ?)", raw_words)
+    mod.db_many("INSERT INTO phrase_log(chat_id, ts, phrase) VALUES(?, ?, ?)", raw_phrases)
+    return now, len(raw_words)
+
+
+def raw_top_words(mod, since, limit):
+    return mod.db_all("""
+    SELECT word, COUNT(*) as c
+    FROM word_log
+    WHERE chat_id=? AND ts>=?
+    GROUP BY word
+    ORDER BY c DESC, word
+    LIMIT ?
+    """, (CHAT, db_ts(mod, since), limit))
+
+
+def timeit(fn, repeat: int):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        res = fn()
+    return (time.perf_counter() - t0) / repeat * 1000.0, res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=100_000, help="сообщений за --days дней")
+    ap.add_argument("--days", type=int, default=7)
+    ap.add_argument("--vocab", type=int, default=20_000)
+    ap.add_argument("--repeat", type=int, default=10)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(ROOT / "weirdo.py")
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        now, words = seed(mod, args.n, args.days, args.vocab)
+
+        print(f"messages={args.n} word rows={words} days={args.days}")
+        for label, delta in (("24h", timedelta(hours=24)), ("7d", timedelta(days=7))):
+            since = now - delta
+            raw_ms, raw = timeit(lambda: raw_top_words(mod, since, 5), args.repeat)
+            top_ms, top = timeit(lambda: mod.get_top_words(CHAT, since, 5), args.repeat)
+            print(f"{label:4s} words  raw={raw_ms:7.2f}ms  rollup={top_ms:6.2f}ms  x{raw_ms / top_ms:5.1f}  same={raw == top}")
+        mod.db_close_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Бенчмарк: точность и память top-k движка (Space-Saving) против точного запроса.
+
+Один и тот же поток сообщений за --days дней пишем в счётчики word_* (точный
+ответ — rollup_top) и в SpaceSaving с разной ёмкостью TOPK_CAPACITY. Для окон
+24h и 7d печатаем:
+- recall@N   — сколько из точного топ-N нашлось в топ-N движка;
+- max err    — максимальная относительная ошибка оценок для точного топ-N;
+- mem        — память саммари (tracemalloc) и число счётчиков;
+- query      — время запроса движка и точного SQL.
+
+    python bench/bench_topk.py
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, WORDS, load_module  # noqa: E402
+
+CHAT = -1000
+
+
+def make_stream(n: int, days: int, vocab: int, seed: int = 1):
+    rnd = random.Random(seed)
+    vocab_words = WORDS + [f"слово{i}" for i in range(vocab)]
+    weights = [1.0 / (i + 1) for i in range(len(vocab_words))]
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    stream = []
+    for _ in range(n):
+        ts = now - timedelta(seconds=1 + rnd.randrange(days * 86400))
+        stream.append((ts, " ".join(rnd.choices(vocab_words, weights, k=rnd.randint(2, 10)))))
+    stream.sort()
+    return now, stream
+
+
+def feed_exact(mod, stream):
+    mod.TOPK_ENGINE = "sql"
+    for ts, text in stream:
+        mod.ingest_text(CHAT, ts, text)
+        if mod._ingest_rows >= 20000:
+            mod.ingest_write(mod.ingest_take())
+    batch = mod.ingest_take()
+    if batch:
+        mod.ingest_write(batch)
+
+
+def feed_topk(mod, stream, k: int, now):
+    mod._topk.clear()
+    mod.TOPK_CAPACITY = k
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for ts, text in stream:
+        mod.topk_feed("word", CHAT, ts, [w for w in mod.tokenize(text) if len(w) >= 3])
+    feed_s = time.perf_counter() - t0
+    # как в проде: часовые бакеты старше TOPK_HOURLY_HOURS выкидываются при сбросе
+    mod.topk_take_snapshot(now)
+    mem, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    counters = sum(len(ss.counts) for ss in mod._topk.values())
+    return feed_s, mem, counters
+
+
+def timeit(fn, repeat: int):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        res = fn()
+    return (time.perf_counter() - t0) / repeat * 1000.0, res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=100_000, help="сообщений за --days дней")
+    ap.add_argument("--days", type=int, default=7)
+    ap.add_argument("--vocab", type=int, default=20_000)
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument("--caps", default="16,32,64,128,256,512,1024")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(ROOT / "weirdo.py")
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+
+        now, stream = make_stream(args.n, args.days, args.vocab)
+        feed_exact(mod, stream)
+        windows = (("24h", now - timedelta(hours=24)), ("7d", now - timedelta(days=7)))
+        exact = {}
+        for label, since in windows:
+            ms, rows = timeit(lambda: mod.rollup_top("word", CHAT, since, args.top), 5)
+            exact[label] = (ms, dict(rows), [w for w, _ in rows])
+        print(f"messages={args.n} days={args.days} vocab={args.vocab} top={args.top}")
+        print(f"exact SQL: 24h {exact['24h'][0]:.2f}ms  7d {exact['7d'][0]:.2f}ms")
+
+        mod.TOPK_ENGINE = "spacesaving"
+        for k in (int(x) for x in args.caps.split(",")):
+            feed_s, mem, counters = feed_topk(mod, stream, k, now)
+            line = f"k={k:5d} mem={mem / 1024:8.0f}KiB counters={counters:7d} feed={feed_s:5.2f}s"
+            for label, since in windows:
+                ms, rows = timeit(lambda: mod.topk_query("word", CHAT, since, args.top), 5)
+                _, truth, order = exact[label]
+                got = dict(rows)
+                recall = len(set(got) & set(order)) / max(1, len(order))
+                err = max((abs(got.get(w, 0) - truth[w]) / truth[w] for w in order), default=0.0)
+                line += f" | {label}: recall={recall:4.2f} err={err * 100:5.1f}% q={ms:5.2f}ms"
+            print(line)
+        mod.db_close_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Бенчмарк: стоимость /whereall (get_user_counts) на 24h / 7d / 30d.
+
+raw    — как было: GROUP BY user_id по сырым msg_log за весь период
+tiered — get_user_counts: хвост сырых строк + msg_hourly + msg_daily
+
+Сырые строки в бенче не чистим (tiered получает retention_days = --days + 1,
+чтобы их и читать), поэтому заодно сверяем, что ответы совпадают.
+
+    python bench/bench_whereall.py
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, db_ts, load_module  # noqa: E402
+
+CHAT = -1000
+
+
+def seed(mod, n: int, users: int, days: int, seed: int = 1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    for i in range(n):
+        ts = now - timedelta(seconds=rnd.randrange(days * 86400))
+        mod.ingest_msg(CHAT, ts, 1 + rnd.randrange(users))
+        if mod._ingest_rows >= 5000:
+            mod.ingest_write(mod.ingest_take())
+    batch = mod.ingest_take()
+    if batch:
+        mod.ingest_write(batch)
+    return now
+
+
+def raw_counts(mod, since):
+    return mod.db_all("""
+    SELECT user_id, COUNT(*) as c
+    FROM msg_log
+    WHERE chat_id=? AND ts>=?
+    GROUP BY user_id
+    ORDER BY c DESC
+    """, (CHAT, db_ts(mod, since)))
+
+
+def timeit(fn, repeat: int):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        res = fn()
+    return (time.perf_counter() - t0) / repeat * 1000.0, res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=300_000, help="сообщений за --days дней")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--days", type=int, default=30)
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        mod = load_module(ROOT / "weirdo.py")
+        mod.DB_PATH = os.environ["DB_PATH"]
+        mod.init_db()
+        mod.ensure_chat(CHAT)
+        now = seed(mod, args.n, args.users, args.days)
+
+        print(f"messages={args.n} users={args.users} days={args.days}")
+        for label, delta in (("24h", timedelta(hours=24)), ("7d", timedelta(days=7)), ("30d", timedelta(days=30))):
+            since = now - delta
+            raw_ms, raw = timeit(lambda: raw_counts(mod, since), args.repeat)
+            tier_ms, tier = timeit(lambda: mod.get_user_counts(CHAT, since, args.days + 1), args.repeat)
+            same = dict(raw) == dict(tier)
+            print(f"{label:4s} raw={raw_ms:7.2f}ms  tiered={tier_ms:6.2f}ms  x{raw_ms / tier_ms:5.1f}  same={same}")
+        mod.db_close_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
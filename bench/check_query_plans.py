@@ -0,0 +1,233 @@
+"""
+Проверка планов запросов: каждый SQL-запрос из weirdo.py — через EXPLAIN QUERY PLAN.
+
+Реестр запросов собирается из исходника: все строковые литералы, похожие на
+SQL (SELECT/INSERT/UPDATE/DELETE/WITH/REPLACE). f-строки подставляются из
+BINDINGS — значений, с которыми их реально вызывает бот; f-строки, для
+которых подстановки нет (перенос таблиц в миграциях), в отчёте помечены
+skip. База — свежая схема текущего weirdo.py, засеянная через его же функции
+(--rows сообщений, кошельки, репутация, журнал), без ANALYZE, как в проде.
+
+Падает (exit 1), если план запроса делает полный проход по таблице (SCAN)
+или строит временное B-дерево (USE TEMP B-TREE), а запрос не перечислен в
+ALLOW с причиной, почему это нормально.
+
+    python bench/check_query_plans.py          # только проблемы
+    python bench/check_query_plans.py -v       # весь реестр с планами
+"""
+import argparse
+import ast
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+VERB = re.compile(r"^\s*(SELECT\s|WITH\s|INSERT\s+INTO\s|REPLACE\s+INTO\s|UPDATE\s+\w+\s+SET\s|DELETE\s+FROM\s)")
+
+# подстановки для f-строк: имена локальных переменных -> значение; берутся
+# наборы, ключи которых ровно совпадают со свободными именами f-строки
+def bindings(mod) -> list[dict]:
+    out = [
+        {"field": "quiet_until"},
+        {"table": "treasury"},
+        {"table": "jackpot_pool"},
+        {"side": "a"},
+        {"chunk": [1, 2, 3]},
+        {"where": ""},
+        {"cols": "msg_count", "marks": "?", "sets": "msg_count = msg_count + excluded.msg_count"},
+    ]
+    out += [{"name": n, "col": c} for n, c in mod.ROLLUPS.items()]
+    out += [{"name": n} for n in mod.ROLLUPS if n != "msg"]
+    out += [{"table": t, "col": c, "key": k}
+            for t, c, k, _cut in mod.retention_cutoffs(datetime.now(timezone.utc), 30)]
+    return out
+
+
+# запросы, которым полный проход или временное B-дерево разрешены: регэксп по
+# запросу (пробелы схлопнуты) -> почему
+ALLOW = {
+    # раз на старте / по расписанию, по всем чатам
+    r"FROM chat_settings$": "все чаты: загрузка кеша настроек / retention, раз на старте и по расписанию",
+    r"^SELECT chat_id, total_wallet, holders, treasury, jackpot FROM econ_agg$": "econ_agg_check: сверка всех чатов",
+    r"FROM topk_state": "загрузка Space-Saving, раз на старте",
+    # полный пересчёт/сверка по построению
+    r"INSERT INTO econ_agg": "полный пересчёт econ_agg (миграция, reconcile --fix)",
+    r"^SELECT chat_id, SUM\(total_wallet\)": "econ_agg_check: сверка всех чатов",
+    r"^SELECT chat_id FROM wallet UNION": "reconcile: список всех чатов с экономикой",
+    r"FROM token_ledger WHERE id >= \?": "перенос token_tx: диапазон по id — хвост таблицы",
+    r"GROUP BY 1, 2, 3$": "пересборка роллапов и token_totals при миграции",
+    r"UPDATE token_ledger SET": "backfill fee/treasury/jackpot при миграции",
+    r"FROM token_tx": "старый журнал, читается только миграцией",
+    r"FROM sqlite_master|pragma_": "схема",
+    # GROUP BY по окну времени: группируются только строки окна (SEARCH по (chat_id, время))
+    r"SELECT user_id, (COUNT\(\*\)|SUM\(cnt\)) FROM msg_\w+ .*WHERE chat_id=\? AND \w+>=\?.* GROUP BY user_id$":
+        "счётчики юзеров за окно: группируются только строки окна",
+    # ORDER BY по агрегату: сортируем уже сгруппированное, без индекса не обойтись
+    r"ORDER BY c DESC": "топ по сумме счётчиков",
+    r"ORDER BY cnt DESC": "топ по сумме счётчиков",
+}
+
+# запросы, которые должны идти по конкретному индексу: SEARCH по префиксу
+# первичного ключа формально не SCAN, но на большом чате это тот же проход
+EXPECT = {
+    r"FROM user_cache WHERE chat_id=\? AND display=\?": "idx_user_cache_display",
+    r"FROM rep WHERE chat_id=\? ORDER BY score DESC": "idx_rep_chat_score",
+    r"FROM token_ledger WHERE chat_id=\? AND \(from_user_id=\? OR to_user_id=\?\)": "idx_ledger_",
+    r"FROM msg_log INDEXED BY": "idx_msg_log_chat_ts",
+    r"FROM duels WHERE state IN": "idx_duels_open",
+}
+
+TEMP_BTREE = re.compile(r"USE TEMP B-TREE")
+SCAN = re.compile(r"^SCAN (\w+)")
+
+
+def registry(mod) -> list[tuple[int, str | None, str]]:
+    """[(строка в weirdo.py, SQL или None — не подставилось, исходный текст)]."""
+    tree = ast.parse(Path(mod.__file__).read_text(encoding="utf-8"))
+    ns = vars(mod)
+    builtins = set(dir(__builtins__))
+    binds = bindings(mod)
+    out = []
+    seen = set()
+    in_fstr = {id(v) for n in ast.walk(tree) if isinstance(n, ast.JoinedStr) for v in n.values}
+    for node in ast.walk(tree):
+        if id(node) in in_fstr:
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and VERB.match(node.value):
+            sqls = [node.value]
+            text = node.value
+        elif isinstance(node, ast.JoinedStr):
+            text = "".join(v.value if isinstance(v, ast.Constant) else "{" + ast.unparse(v.value) + "}"
+                           for v in node.values)
+            if not VERB.match(text):
+                continue
+            free = {n.id for v in node.values if isinstance(v, ast.FormattedValue)
+                    for n in ast.walk(v.value) if isinstance(n, ast.Name) and n.id not in ns and n.id not in builtins}
+            sqls = []
+            for b in binds if free else [{}]:
+                if set(b) != free:
+                    continue
+                sqls.append("".join(
+                    v.value if isinstance(v, ast.Constant)
+                    else str(eval(compile(ast.Expression(v.value), "<sql>", "eval"), ns, b))
+                    for v in node.values))
+            sqls = sqls or [None]
+        else:
+            continue
+        for sql in sqls:
+            key = " ".join(sql.split()) if sql else (node.lineno, text)
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append((node.lineno, sql, " ".join(text.split())))
+    return sorted(out, key=lambda r: r[0])
+
+
+def explain(con, sql: str) -> list[str]:
+    # параметры не важны для плана — подставляем NULL
+    n = len(re.findall(r"\?", sql))
+    return [r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql, (None,) * n)]
+
+
+def problems(con, sql: str, plan: list[str]) -> list[str]:
+    tables = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    flat = " ".join(sql.split())
+    bad = [f"expected index {idx}" for pat, idx in EXPECT.items()
+           if re.search(pat, flat) and not any(idx in line for line in plan)]
+    for line in plan:
+        m = SCAN.match(line)
+        if (m and m.group(1) in tables) or TEMP_BTREE.search(line):
+            bad.append(line)
+    return bad
+
+
+def allowed(sql: str) -> str | None:
+    flat = " ".join(sql.split())
+    for pat, why in ALLOW.items():
+        if re.search(pat, flat):
+            return why
+    return None
+
+
+def seed(mod, rows: int, rnd: random.Random):
+    now = datetime.now(timezone.utc)
+    # старый журнал — только чтобы миграционные запросы к нему тоже прошли EXPLAIN
+    mod.db_exec("CREATE TABLE IF NOT EXISTS token_tx(chat_id, ts, from_user_id, to_user_id, amount, kind, meta)")
+    for uid in range(1, 201):
+        mod.upsert_user_display(-1000, uid, f"@user{uid}", now)
+    for i in range(rows):
+        mod.ingest_msg(-1000 - rnd.randrange(5), now - timedelta(seconds=rows - i), 1 + rnd.randrange(200))
+    mod.ingest_write(mod.ingest_take() or mod._ingest_new())
+    with mod.db_tx():
+        for c in range(5):
+            for uid in range(1, 201):
+                mod.wallet_add(-1000 - c, uid, rnd.randint(0, 500))
+                mod.rep_add(-1000 - c, uid, rnd.randint(-5, 20))
+                mod.tx_log(-1000 - c, now, None, uid, 10, "daily")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--module", default=str(ROOT / "weirdo.py"))
+    ap.add_argument("--rows", type=int, default=20_000, help="сообщений в засеве")
+    ap.add_argument("-v", action="store_true", help="печатать весь реестр с планами")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "plans.db")
+        mod = load_module(Path(args.module))
+        mod.DB_PATH = os.environ["DB_PATH"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            mod.init_db()
+        seed(mod, args.rows, random.Random(1))
+        con = mod.db_conn()
+
+        fails = skipped = ok = allowed_n = 0
+        for lineno, sql, text in registry(mod):
+            if sql is None:
+                skipped += 1
+                if args.v:
+                    print(f"skip  :{lineno} {text[:110]}")
+                continue
+            try:
+                plan = explain(con, sql)
+            except Exception as e:
+                fails += 1
+                print(f"ERROR :{lineno} {text[:110]}\n        {e}")
+                continue
+            bad = problems(con, sql, plan)
+            why = allowed(sql) if bad else None
+            if bad and not why:
+                fails += 1
+                tag = "FAIL "
+            elif bad:
+                allowed_n += 1
+                tag = "allow"
+            else:
+                ok += 1
+                tag = "ok   "
+            if args.v or tag == "FAIL ":
+                print(f"{tag} :{lineno} {' '.join(sql.split())[:110]}")
+                for line in plan:
+                    print(f"        {line}")
+                for line in bad:
+                    if line not in plan:
+                        print(f"        !! {line}")
+                if why:
+                    print(f"        ({why})")
+        mod.db_close_all()
+
+    print(f"queries: ok={ok} allowed={allowed_n} skipped={skipped} failed={fails}")
+    return 1 if fails else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
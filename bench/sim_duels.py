@@ -0,0 +1,318 @@
+"""
+Офлайн-симулятор баланса дуэлей (Monte Carlo на NumPy).
+
+Правила те же, что в duel_resolve_round: сначала небоевые действия (прицел,
+перезарядка, перевязка, уклон), потом выстрелы A и B; осечка, щелчок без
+патронов, штраф к точности при уклоне цели, крит после прицела и бафф крита.
+Дуэль идёт до чьей-то смерти или до --max-rounds (тогда — таймаут).
+Состояние всех дуэлей — массивы NumPy, один раунд — одна векторная операция
+на весь батч, поэтому миллион дуэлей считается за секунды.
+
+Стратегии (--a / --b): random, shoot, aim_shoot, mixed, careful.
+
+    pip install numpy                    # боту не нужен, только симулятору
+    python bench/sim_duels.py                            # матрица стратегий + баффы
+    python bench/sim_duels.py --a aim_shoot --b shoot -n 2000000
+    python bench/sim_duels.py --grid DUEL_BASE_ACC=0.3,0.35,0.4 --grid DUEL_AIM_BONUS=0.1,0.2
+    python bench/sim_duels.py --check    # сверка с настоящим duel_resolve_round
+
+Константы берутся из weirdo.py; --grid перебирает их декартовым произведением.
+--check гоняет те же стратегии через duel_resolve_round и сравнивает доли
+побед/ничьих (z-тест двух долей) и среднее число раундов; код выхода 1, если
+расхождение больше --z.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import math
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+PARAMS = (
+    "DUEL_HP", "DUEL_AMMO_MAX", "DUEL_BASE_ACC", "DUEL_AIM_BONUS", "DUEL_DODGE_PENALTY", "DUEL_MAX_ACC",
+    "DUEL_HEAL_AMOUNT", "DUEL_CRIT_BASE", "DUEL_CRIT_AFTER_AIM", "DUEL_CRIT_DMG", "DUEL_FUMBLE_PROB",
+)
+
+# коды ходов — индексы в weirdo.DUEL_MOVES
+SHOOT, AIM, DODGE, RELOAD, HEAL = 1, 2, 3, 4, 5
+
+
+class Batch:
+    """Состояние n дуэлей: по строке на игрока (0 — A, 1 — B)."""
+
+    def __init__(self, n: int, P: dict):
+        self.n = n
+        self.hp = np.full((2, n), P["DUEL_HP"], dtype=np.int16)
+        self.ammo = np.full((2, n), P["DUEL_AMMO_MAX"], dtype=np.int16)
+        self.acc = np.full((2, n), P["DUEL_BASE_ACC"], dtype=np.float32)
+        self.heal_used = np.zeros((2, n), dtype=bool)
+        self.aimed = np.zeros((2, n), dtype=bool)
+        self.crit_bonus = np.zeros((2, n), dtype=np.float32)
+
+    def take(self, sel: np.ndarray):
+        """Оставляет в батче только дуэли с индексами sel."""
+        self.n = len(sel)
+        for name in ("hp", "ammo", "acc", "heal_used", "aimed", "crit_bonus"):
+            setattr(self, name, getattr(self, name).take(sel, axis=1))
+
+    def apply_buff(self, p: int, kind: str, val, P: dict):
+        # как duel_apply_luck_buff
+        if kind == "acc":
+            self.acc[p] = np.clip(self.acc[p] + val, 0.05, P["DUEL_MAX_ACC"])
+        elif kind == "hp":
+            self.hp[p] += int(val)
+        elif kind == "ammo":
+            self.ammo[p] += int(val)
+        elif kind == "crit":
+            self.crit_bonus[p] += float(val)
+
+
+# =======================
+# СТРАТЕГИИ: (batch, p, rng) -> массив кодов ходов
+# =======================
+def pol_random(b: Batch, p: int, rng) -> np.ndarray:
+    return rng.integers(SHOOT, HEAL + 1, size=b.n, dtype=np.int8)
+
+def pol_shoot(b: Batch, p: int, rng) -> np.ndarray:
+    return np.where(b.ammo[p] > 0, SHOOT, RELOAD).astype(np.int8)
+
+def pol_aim_shoot(b: Batch, p: int, rng) -> np.ndarray:
+    m = np.where(b.aimed[p], SHOOT, AIM)
+    return np.where(b.ammo[p] > 0, m, RELOAD).astype(np.int8)
+
+def pol_mixed(b: Batch, p: int, rng) -> np.ndarray:
+    r = rng.random(b.n)
+    m = np.where(r < 0.5, SHOOT, np.where(r < 0.8, AIM, DODGE))
+    m = np.where(b.ammo[p] > 0, m, RELOAD)
+    return np.where((b.hp[p] <= 1) & ~b.heal_used[p], HEAL, m).astype(np.int8)
+
+def pol_careful(b: Batch, p: int, rng) -> np.ndarray:
+    # через раз уклоняется, пока противник прицелился, иначе aim_shoot
+    m = np.where(b.aimed[1 - p] & (rng.random(b.n) < 0.5), DODGE, pol_aim_shoot(b, p, rng))
+    return np.where((b.hp[p] <= 1) & ~b.heal_used[p], HEAL, m).astype(np.int8)
+
+POLICIES = {
+    "random": pol_random,
+    "shoot": pol_shoot,
+    "aim_shoot": pol_aim_shoot,
+    "mixed": pol_mixed,
+    "careful": pol_careful,
+}
+
+
+# =======================
+# ДВИЖОК
+# =======================
+def play_round(b: Batch, moves: np.ndarray, P: dict, rng):
+    """Один раунд для всех дуэлей батча, правила duel_resolve_round."""
+    n = b.n
+    # 1) небоевые — A, потом B
+    for p in (0, 1):
+        m = moves[p]
+        aim = m == AIM
+        np.copyto(b.acc[p], np.clip(b.acc[p] + np.float32(P["DUEL_AIM_BONUS"]), P["DUEL_BASE_ACC"], P["DUEL_MAX_ACC"]), where=aim)
+        b.aimed[p] |= aim
+        np.copyto(b.ammo[p], P["DUEL_AMMO_MAX"], where=m == RELOAD)
+        heal = (m == HEAL) & ~b.heal_used[p]
+        b.heal_used[p] |= heal
+        np.copyto(b.hp[p], np.minimum(b.hp[p] + P["DUEL_HEAL_AMOUNT"], 99), where=heal)
+
+    # 2) стрельба — A, потом B (выстрел B случается, даже если A его уложил)
+    roll = rng.random((2, 3, n), dtype=np.float32)
+    for p in (0, 1):
+        q = 1 - p
+        shot = moves[p] == SHOOT
+        fire = shot & (roll[p, 0] >= P["DUEL_FUMBLE_PROB"]) & (b.ammo[p] > 0)
+        b.ammo[p] -= fire
+        chance = b.acc[p].copy()
+        dodge = moves[q] == DODGE
+        np.copyto(chance, np.clip(chance - np.float32(P["DUEL_DODGE_PENALTY"]), 0.05, 0.95), where=dodge)
+        hit = fire & (roll[p, 1] < chance)
+        crit_p = np.where(b.aimed[p], np.float32(P["DUEL_CRIT_AFTER_AIM"]), np.float32(P["DUEL_CRIT_BASE"])) + b.crit_bonus[p]
+        crit = hit & (roll[p, 2] < np.minimum(crit_p, 0.95))
+        dmg = hit.astype(np.int16)
+        dmg[crit] = P["DUEL_CRIT_DMG"]
+        np.maximum(b.hp[q] - dmg, 0, out=b.hp[q])
+        b.aimed[p] &= ~shot
+
+def simulate(n: int, P: dict, pol_a, pol_b, rng, max_rounds: int = 100, buff_a=None, buff_b=None) -> dict:
+    b = Batch(n, P)
+    if buff_a:
+        b.apply_buff(0, *buff_a, P)
+    if buff_b:
+        b.apply_buff(1, *buff_b, P)
+    # закончившиеся дуэли доигрываются вхолостую (итог уже записан), а когда их
+    # набирается больше половины батча — батч ужимается до живых
+    idx = np.arange(n)
+    over = np.zeros(n, dtype=bool)
+    a_alive = np.ones(n, dtype=bool)
+    b_alive = np.ones(n, dtype=bool)
+    timeout = np.ones(n, dtype=bool)
+    rounds = np.full(n, max_rounds, dtype=np.int32)
+    for r in range(1, max_rounds + 1):
+        moves = np.stack((pol_a(b, 0, rng), pol_b(b, 1, rng)))
+        play_round(b, moves, P, rng)
+        done = ((b.hp[0] <= 0) | (b.hp[1] <= 0)) & ~over
+        if done.any():
+            ended = idx[done]
+            rounds[ended] = r
+            timeout[ended] = False
+            a_alive[ended] = b.hp[0, done] > 0
+            b_alive[ended] = b.hp[1, done] > 0
+            over |= done
+            left = b.n - int(np.count_nonzero(over))
+            if not left:
+                break
+            if left < b.n // 2:
+                sel = np.flatnonzero(~over)
+                idx = idx[sel]
+                over = over[sel]
+                b.take(sel)
+    return summarize(a_alive, b_alive, timeout, rounds)
+
+def summarize(a_alive: np.ndarray, b_alive: np.ndarray, timeout: np.ndarray, rounds: np.ndarray) -> dict:
+    n = len(rounds)
+    done = ~timeout
+    return {
+        "n": n,
+        "a_win": float(np.count_nonzero(done & a_alive & ~b_alive)) / n,
+        "b_win": float(np.count_nonzero(done & b_alive & ~a_alive)) / n,
+        "draw": float(np.count_nonzero(done & ~a_alive & ~b_alive)) / n,
+        "timeout": float(np.count_nonzero(timeout)) / n,
+        "rounds": float(rounds.mean()),
+        "rounds_var": float(rounds.var()),
+    }
+
+
+# =======================
+# СВЕРКА С duel_resolve_round
+# =======================
+def simulate_real(mod, k: int, P: dict, pol_a, pol_b, rng, max_rounds: int) -> dict:
+    """Те же стратегии, но раунд считает настоящий duel_resolve_round."""
+    a_id, b_id, chat = 1, 2, -1000
+    for name, val in P.items():
+        setattr(mod, name, val)
+    mod.random.seed(int(rng.integers(1 << 31)))
+    a_alive = np.zeros(k, dtype=bool)
+    b_alive = np.zeros(k, dtype=bool)
+    timeout = np.zeros(k, dtype=bool)
+    rounds = np.full(k, max_rounds, dtype=np.int32)
+    one = Batch(1, P)
+    for i in range(k):
+        st = mod.duel_new_data(a_id, b_id)
+        finished = False
+        for r in range(1, max_rounds + 1):
+            for p, pl in enumerate((st.a, st.b)):
+                one.hp[p, 0], one.ammo[p, 0], one.acc[p, 0] = pl.hp, pl.ammo, pl.acc
+                one.heal_used[p, 0], one.aimed[p, 0], one.crit_bonus[p, 0] = pl.heal_used, pl.aimed, pl.crit_bonus
+            st.a.move = mod.DUEL_MOVES[int(pol_a(one, 0, rng)[0])]
+            st.b.move = mod.DUEL_MOVES[int(pol_b(one, 1, rng)[0])]
+            _body, finished = mod.duel_resolve_round(chat, "sim", a_id, b_id, st)
+            if finished:
+                rounds[i] = r
+                break
+        a_alive[i], b_alive[i], timeout[i] = st.a.hp > 0, st.b.hp > 0, not finished
+    return summarize(a_alive, b_alive, timeout, rounds)
+
+def compare(sim: dict, real: dict) -> list[tuple[str, float, float, float]]:
+    out = []
+    for key in ("a_win", "b_win", "draw", "timeout"):
+        p1, n1, p2, n2 = sim[key], sim["n"], real[key], real["n"]
+        pool = (p1 * n1 + p2 * n2) / (n1 + n2)
+        se = math.sqrt(max(pool * (1 - pool), 1e-12) * (1 / n1 + 1 / n2))
+        out.append((key, p1, p2, (p1 - p2) / se))
+    se = math.sqrt(sim["rounds_var"] / sim["n"] + real["rounds_var"] / real["n"]) or 1e-12
+    out.append(("rounds", sim["rounds"], real["rounds"], (sim["rounds"] - real["rounds"]) / se))
+    return out
+
+
+def fmt(res: dict) -> str:
+    return (f"A {res['a_win'] * 100:5.1f}%  B {res['b_win'] * 100:5.1f}%  "
+            f"draw {res['draw'] * 100:4.1f}%  timeout {res['timeout'] * 100:4.1f}%  rounds {res['rounds']:5.2f}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=1_000_000, help="дуэлей на одну конфигурацию")
+    ap.add_argument("--a", default=None, choices=sorted(POLICIES), help="стратегия A (по умолчанию — все)")
+    ap.add_argument("--b", default=None, choices=sorted(POLICIES), help="стратегия B (по умолчанию — все)")
+    ap.add_argument("--grid", action="append", default=[], metavar="NAME=v1,v2", help="перебор константы")
+    ap.add_argument("--max-rounds", type=int, default=100)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--check", action="store_true", help="сверить с duel_resolve_round")
+    ap.add_argument("--check-n", type=int, default=5_000, help="дуэлей через настоящий движок на пару")
+    ap.add_argument("--z", type=float, default=4.0, help="порог |z| для --check")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "sim.db")
+        mod = load_module(ROOT / "weirdo.py")
+        mod.DB_PATH = os.environ["DB_PATH"]
+        base = {name: getattr(mod, name) for name in PARAMS}
+        pols_a = [args.a] if args.a else sorted(POLICIES)
+        pols_b = [args.b] if args.b else sorted(POLICIES)
+
+        if args.check:
+            mod.init_db()
+            mod.ensure_chat(-1000)
+            pairs = [(a, b) for a in pols_a for b in pols_b if not (args.a is None and args.b is None) or a <= b]
+            bad = 0
+            for a, b in pairs:
+                sim = simulate(args.n, base, POLICIES[a], POLICIES[b], rng, args.max_rounds)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    real = simulate_real(mod, args.check_n, base, POLICIES[a], POLICIES[b], rng, args.max_rounds)
+                print(f"{a} vs {b}")
+                print(f"  sim  {fmt(sim)}")
+                print(f"  real {fmt(real)}")
+                for key, p1, p2, z in compare(sim, real):
+                    if abs(z) > args.z:
+                        bad += 1
+                        print(f"  MISMATCH {key}: sim={p1:.4f} real={p2:.4f} z={z:+.1f}")
+            mod.db_close_all()
+            print("OK" if not bad else f"FAILED: {bad} расхождений")
+            return 1 if bad else 0
+
+        grid = []
+        for g in args.grid:
+            name, _, vals = g.partition("=")
+            if name not in base:
+                ap.error(f"неизвестная константа {name}; доступны: {', '.join(PARAMS)}")
+            grid.append([(name, type(base[name])(v)) for v in vals.split(",")])
+
+        t0 = time.perf_counter()
+        configs = 0
+        for combo in itertools.product(*grid) if grid else [()]:
+            P = dict(base, **dict(combo))
+            if combo:
+                print("== " + " ".join(f"{k}={v}" for k, v in combo))
+            for a in pols_a:
+                for b in pols_b:
+                    res = simulate(args.n, P, POLICIES[a], POLICIES[b], rng, args.max_rounds)
+                    configs += 1
+                    print(f"{a:>9} vs {b:<9} {fmt(res)}")
+
+        if not grid:
+            # преимущество первого хода и баффы — на зеркальном матче
+            mirror = args.a or "mixed"
+            print(f"\nбаффы ({mirror} vs {mirror}, бафф у A):")
+            same = simulate(args.n, base, POLICIES[mirror], POLICIES[mirror], rng, args.max_rounds)
+            print(f"  {'нет':>6}  {fmt(same)}  first-mover {(same['a_win'] - same['b_win']) * 100:+.2f}pp")
+            for kind, val, _ in mod.LUCK_BUFFS:
+                res = simulate(args.n, base, POLICIES[mirror], POLICIES[mirror], rng, args.max_rounds, buff_a=(kind, val))
+                configs += 1
+                print(f"  {kind:>6}  {fmt(res)}  Δ A {(res['a_win'] - same['a_win']) * 100:+.2f}pp")
+        print(f"\n{configs} конфигураций x {args.n} дуэлей за {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Проверка слотов: alias-таблицы SlotSampler против точных чисел slot_table_stats.
+
+NumPy крутит -n спинов на режим теми же cut/alias, что и SlotSampler.sample
+(один randrange на спин), плюс бросок джекпота как в slot_spin. Сверяем:
+долю каждого множителя (z-тест доли), EV и дисперсию множителя, hit/profit/x1
+и долю джекпотов. Дополнительно --py спинов гоняется через настоящий
+slot_spin — на случай, если sample() разошёлся с таблицами. Код выхода 1,
+если хоть одно |z| больше --z.
+
+    pip install numpy                    # боту не нужен, только проверке
+    python bench/sim_slots.py                    # 10^8 спинов на режим
+    python bench/sim_slots.py -n 10000000 --mode high
+"""
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_any_message import ROOT, load_module  # noqa: E402
+
+
+def spin_counts(sampler, jc: float, n: int, rng, chunk: int) -> tuple[np.ndarray, int]:
+    """Счётчики по индексам множителей и число джекпотов."""
+    k = len(sampler.vals)
+    cut = np.asarray(sampler.cut, dtype=np.int64)
+    alias = np.asarray(sampler.alias, dtype=np.int64)
+    counts = np.zeros(k, dtype=np.int64)
+    jackpots = 0
+    left = n
+    while left:
+        m = min(chunk, left)
+        left -= m
+        jp = rng.random(m) < jc
+        jackpots += int(jp.sum())
+        i, u = np.divmod(rng.integers(0, k * sampler.total, size=m - int(jp.sum())), sampler.total)
+        idx = np.where(u < cut[i], i, alias[i])
+        counts += np.bincount(idx, minlength=k)
+    return counts, jackpots
+
+
+def check(label: str, st: dict, vals: list, weights: list, counts: np.ndarray, jackpots: int,
+          n: int, zmax: float) -> int:
+    vals = np.asarray(vals)
+    total = sum(weights)
+    mean = float((counts * vals).sum()) / n
+    sq = float((counts * vals * vals).sum()) / n
+    var = sq - mean * mean
+    # стандартная ошибка дисперсии — через четвёртый момент
+    m4 = sum(w / total * (1 - st["jackpot"]) * (v - st["ev"]) ** 4 for v, w in zip(vals, weights))
+    rows = [
+        ("ev", mean, st["ev"], st["sd"] / math.sqrt(n)),
+        ("var", var, st["var"], math.sqrt(max(m4 - st["var"] ** 2, 0.0) / n)),
+    ]
+    for key, mask in (("hit", vals > 0), ("profit", vals > 1), ("x1", vals == 1)):
+        rows.append((key, float(counts[mask].sum()) / n, st[key], None))
+    rows.append(("jackpot", jackpots / n, st["jackpot"], None))
+    for v, w, c in zip(vals, weights, counts):
+        rows.append((f"mult {v:g}", c / n, (1 - st["jackpot"]) * w / total, None))
+
+    bad = 0
+    print(label)
+    for key, got, want, se in rows:
+        if se is None:
+            se = math.sqrt(want * (1 - want) / n)
+        z = (got - want) / se if se > 0 else (0.0 if got == want else math.inf)
+        flag = ""
+        if abs(z) > zmax:
+            bad += 1
+            flag = "  MISMATCH"
+        if not key.startswith("mult"):
+            print(f"  {key:>8} got={got:.6f} want={want:.6f} z={z:+.2f}{flag}")
+        elif flag:
+            print(f"  {key:>8} got={got:.6%} want={want:.6%} z={z:+.2f}{flag}")
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=100_000_000, help="спинов NumPy на режим")
+    ap.add_argument("--py", type=int, default=1_000_000, help="спинов через настоящий slot_spin на режим")
+    ap.add_argument("--mode", default=None, help="один режим вместо всех")
+    ap.add_argument("--chunk", type=int, default=10_000_000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--z", type=float, default=5.0, help="порог |z|")
+    args = ap.parse_args()
+
+    mod = load_module(ROOT / "weirdo.py")
+    stats = mod.slot_tables_check()
+    rng = np.random.default_rng(args.seed)
+    mod.random.seed(args.seed)
+    modes = [args.mode] if args.mode else list(mod.SLOT_TABLES)
+
+    bad = 0
+    for mode in modes:
+        st = stats[mode]
+        vals = [float(v) for v, _ in mod.SLOT_TABLES[mode]]
+        weights = [int(w) for _, w in mod.SLOT_TABLES[mode]]
+        print(f"== {mode}: EV={st['ev']:.6f} sd={st['sd']:.3f} hit={st['hit']:.4%} profit={st['profit']:.4%} "
+              f"x1={st['x1']:.4%} jackpot={st['jackpot']:.2%} rtp={st['rtp']:.4f} mint={st['mint']:+.4f}")
+
+        t0 = time.perf_counter()
+        counts, jackpots = spin_counts(mod.SLOT_SAMPLERS[mode], st["jackpot"], args.n, rng, args.chunk)
+        dt = time.perf_counter() - t0
+        bad += check(f"numpy alias, {args.n} spins in {dt:.1f}s", st, vals, weights, counts, jackpots, args.n, args.z)
+
+        if args.py:
+            index = {v: i for i, v in enumerate(vals)}
+            counts = np.zeros(len(vals), dtype=np.int64)
+            jackpots = 0
+            t0 = time.perf_counter()
+            for _ in range(args.py):
+                _line, mult, jp = mod.slot_spin(mode)
+                if jp:
+                    jackpots += 1
+                else:
+                    counts[index[mult]] += 1
+            dt = time.perf_counter() - t0
+            bad += check(f"slot_spin, {args.py} spins, {dt / args.py * 1e6:.2f}us/spin", st, vals, weights,
+                         counts, jackpots, args.py, args.z)
+
+    print("OK" if not bad else f"FAILED: {bad} расхождений")
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,37 @@
+import argparse
 import asyncio
+import bisect
+import concurrent.futures
+import cProfile
+import gzip
+import hashlib
+import heapq
+import multiprocessing
 import os
+import pstats
+import queue
 import re
 import random
 import sqlite3
+import struct
+import sys
 import json
+import tempfile
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Chat, Message, CallbackQuery, Update, User
 from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardMarkup
@@ -153,6 +175,20 @@ def now_tz(tz: str) -> datetime:
 def date_key(dt: datetime) -> str:
     return dt.date().isoformat()
 
+# время в БД — целые секунды UTC epoch; пояс чата — только при выводе (fmt_dt)
+def epoch(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+def from_epoch(ts: int | None, tz=timezone.utc) -> datetime | None:
+    return datetime.fromtimestamp(int(ts), tz) if ts is not None else None
+
+# ключи бакетов роллапов — всегда в UTC, чтобы /tz их не ломал
+def utc_hour_key(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H")
+
+def utc_day_key(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
 def tokenize(text: str):
     return [w.lower() for w in RE_WORD.findall(text or "")]
 
@@ -170,8 +206,10 @@ def clamp(x, lo, hi):
 def epic_fmt(t: str, **kw) -> str:
     return t.format(**kw)
 
-def fmt_dt(dt: datetime, tz: str) -> str:
-    # коротко, но понятно
+def fmt_dt(dt: datetime | int, tz: str) -> str:
+    # коротко, но понятно; dt — datetime или epoch из БД
+    if not isinstance(dt, datetime):
+        dt = from_epoch(dt)
     try:
         loc = dt.astimezone(ZoneInfo(tz))
     except Exception:
@@ -188,48 +226,566 @@ def safe_int(x, default=0):
 # =======================
 # DB HELPERS
 # =======================
+# Долгоживущие соединения: по одному на поток, с PRAGMA на каждом соединении
+# (busy_timeout/synchronous не переживают connect(), поэтому ставим их здесь).
+# sqlite3 держит LRU-кэш подготовленных выражений на соединение — размер задаёт DB_STMT_CACHE.
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))   # page cache на соединение
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", "256"))
+
+_db_local = threading.local()
+_db_conns = []  # все открытые соединения (закрываем на выходе)
+_db_conns_lock = threading.Lock()
+
+def _db_open(path: str) -> sqlite3.Connection:
+    # isolation_level=None: autocommit, транзакции только явные (db_tx)
+    con = sqlite3.connect(
+        path,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=DB_STMT_CACHE,
+        factory=_MeteredConnection if METRICS_PORT else sqlite3.Connection,
+    )
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+def db_conn() -> sqlite3.Connection:
+    con = getattr(_db_local, "con", None)
+    if con is None or _db_local.path != DB_PATH:
+        con = _db_open(DB_PATH)
+        _db_local.con = con
+        _db_local.path = DB_PATH
+        with _db_conns_lock:
+            _db_conns.append(con)
+    return con
+
+def db_close_all():
+    with _db_conns_lock:
+        conns = list(_db_conns)
+        _db_conns.clear()
+    for con in conns:
+        try:
+            con.close()
+        except Exception:
+            pass
+    _db_local.__dict__.clear()
+
+@contextmanager
+def db_tx(immediate: bool = False):
+    """
+    Явная транзакция на соединении текущего потока.
+    Вложенный db_tx просто присоединяется к внешней транзакции.
+    """
+    con = db_conn()
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
 def db_exec(sql, params=()):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(sql, params)
-    con.commit()
-    con.close()
+    db_conn().execute(sql, params)
+
+def db_many(sql, rows):
+    with db_tx() as con:
+        con.executemany(sql, rows)
+
+def db_table_exists(name: str, con: sqlite3.Connection | None = None) -> bool:
+    con = con or db_conn()
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
 
 def db_one(sql, params=()):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(sql, params)
-    row = cur.fetchone()
-    con.close()
+    row = db_conn().execute(sql, params).fetchone()
+    if METRICS_PORT and row is not None:
+        M_SQL_ROWS.inc(sql_template(sql))
     return row
 
 def db_all(sql, params=()):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    con.close()
+    rows = db_conn().execute(sql, params).fetchall()
+    if METRICS_PORT and rows:
+        M_SQL_ROWS.inc(sql_template(sql), len(rows))
     return rows
 
-def init_db():
-    con = sqlite3.connect(DB_PATH)
-    con.execute("PRAGMA journal_mode=WAL;")
-    con.execute("PRAGMA synchronous=NORMAL;")
-    con.execute("PRAGMA busy_timeout=5000;")
-    cur = con.cursor()
+# =======================
+# DB EXECUTOR (off the event loop)
+# =======================
+# Всё блокирующее SQLite уходит с event loop:
+# - записи (и всё, что читает-потом-пишет) — в один поток-писатель, строго FIFO;
+# - чистые чтения — в небольшой пул читателей (WAL позволяет читать параллельно).
+# Порядок внутри чата: пока у чата есть незавершённые записи, его чтения тоже идут
+# через писателя — чтение всегда видит записи этого чата, отправленные раньше.
+#
+# Group commit (db_write_group, операции экономики): писатель открывает одну
+# транзакцию, гоняет каждую операцию в своём SAVEPOINT (упала — откатили только
+# её) и добирает из очереди такие же операции, пока не выйдет окно
+# DB_GROUP_COMMIT_MS или не наберётся DB_GROUP_MAX. Окно ждём, только если
+# прошлая группа была больше одной операции: одиночный /slot в тихом чате
+# не платит задержкой за чужую нагрузку. Потом один COMMIT с
+# synchronous=DB_GROUP_SYNC, и только после него вызывающие получают ответ.
+# Обычная запись в очереди закрывает группу — FIFO сохраняется; чтение,
+# пришедшее через писателя (db_read при записях чата в полёте), группу не
+# закрывает: выполняется внутри неё и отвечает после того же COMMIT.
+DB_READERS = int(os.getenv("DB_READERS", "3"))
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "2"))
+DB_GROUP_MAX = int(os.getenv("DB_GROUP_MAX", "256"))
+DB_GROUP_SYNC = os.getenv("DB_GROUP_SYNC", "FULL")
+
+_db_write_q = queue.SimpleQueue()
+_db_writer = None
+_db_reader_pool = None
+_db_chat_writes = {}  # chat_id -> записей в полёте (трогаем только из event loop)
+_DB_NO_JOB = object()
+_db_group_busy = False  # прошлая группа собрала больше одной операции (только поток-писатель)
+
+def _db_writer_loop():
+    job = _DB_NO_JOB
+    while True:
+        if job is _DB_NO_JOB:
+            job = _db_write_q.get()
+        if job is None:
+            return
+        fut, fn, args, kind = job
+        job = _DB_NO_JOB
+        if kind == "group":
+            job = _db_group_run(fut, fn, args)
+            continue
+        if not fut.set_running_or_notify_cancel():
+            continue
+        try:
+            fut.set_result(fn(*args))
+        except BaseException as e:
+            fut.set_exception(e)
+
+def _db_group_run(fut, fn, args):
+    """Одна группа под одним COMMIT. -> следующая (не групповая) задача или _DB_NO_JOB."""
+    global _db_group_busy
+    con = db_conn()
+    done = []
+    nxt = _DB_NO_JOB
+    deadline = time.monotonic() + (DB_GROUP_COMMIT_MS / 1000 if _db_group_busy else 0.0)
+    con.execute(f"PRAGMA synchronous={DB_GROUP_SYNC}")
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        while True:
+            if fut.set_running_or_notify_cancel():
+                con.execute("SAVEPOINT grp")
+                try:
+                    res = fn(*args)
+                except BaseException as e:
+                    con.execute("ROLLBACK TO grp")
+                    done.append((fut, False, e))
+                else:
+                    done.append((fut, True, res))
+                con.execute("RELEASE grp")
+            if len(done) >= DB_GROUP_MAX:
+                break
+            try:
+                left = deadline - time.monotonic()
+                job = _db_write_q.get(timeout=left) if left > 0 else _db_write_q.get_nowait()
+            except queue.Empty:
+                break
+            if job is None or job[3] == "write":
+                nxt = job
+                break
+            fut, fn, args, _kind = job
+        con.execute("COMMIT")
+    except BaseException as e:
+        # сломался сам COMMIT/BEGIN — не записалось ничего
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        done = [(f, False, e) for f, _ok, _res in done]
+    finally:
+        con.execute("PRAGMA synchronous=NORMAL")
+    _db_group_busy = len(done) > 1
+    for f, ok, res in done:
+        if ok:
+            f.set_result(res)
+        else:
+            f.set_exception(res)
+    return nxt
+
+def db_start():
+    global _db_writer, _db_reader_pool
+    if _db_writer is not None:
+        return
+    _db_writer = threading.Thread(target=_db_writer_loop, name="db-writer", daemon=True)
+    _db_writer.start()
+    _db_reader_pool = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="db-reader")
+
+def db_stop():
+    global _db_writer, _db_reader_pool
+    if _db_writer is not None:
+        _db_write_q.put(None)
+        _db_writer.join()
+        _db_writer = None
+    if _db_reader_pool is not None:
+        _db_reader_pool.shutdown(wait=True)
+        _db_reader_pool = None
+    db_close_all()
+
+async def db_write(chat_id: int | None, fn, *args):
+    """
+    Выполнить fn(*args) в потоке-писателе. Всё, что внутри fn, атомарно
+    относительно других db_write (писатель один).
+    """
+    return await _db_submit(chat_id, fn, args, "write")
+
+async def db_write_group(chat_id: int | None, fn, *args):
+    """
+    Как db_write, но fn попадает в group commit: ответ приходит после
+    общего COMMIT, исключение в fn откатывает только её SAVEPOINT.
+    """
+    return await _db_submit(chat_id, fn, args, "group")
+
+async def _db_submit(chat_id: int | None, fn, args, kind: str):
+    db_start()
+    fut = concurrent.futures.Future()
+    _db_write_q.put((fut, fn, args, kind))
+    if chat_id is not None:
+        _db_chat_writes[chat_id] = _db_chat_writes.get(chat_id, 0) + 1
+    try:
+        return await asyncio.wrap_future(fut)
+    finally:
+        if chat_id is not None:
+            left = _db_chat_writes.get(chat_id, 1) - 1
+            if left > 0:
+                _db_chat_writes[chat_id] = left
+            else:
+                _db_chat_writes.pop(chat_id, None)
+
+async def db_read(chat_id: int | None, fn, *args):
+    if chat_id is not None and _db_chat_writes.get(chat_id):
+        return await _db_submit(chat_id, fn, args, "read")
+    db_start()
+    return await asyncio.get_running_loop().run_in_executor(_db_reader_pool, fn, *args)
+
+async def adb_exec(sql, params=(), chat_id: int | None = None):
+    await db_write(chat_id, db_exec, sql, params)
+
+async def adb_one(sql, params=(), chat_id: int | None = None):
+    return await db_read(chat_id, db_one, sql, params)
+
+async def adb_all(sql, params=(), chat_id: int | None = None):
+    return await db_read(chat_id, db_all, sql, params)
+
+
+# =======================
+# METRICS
+# =======================
+# Счётчики и гистограммы в памяти, наружу — текстом Prometheus:
+#   METRICS_PORT=9108 -> http://METRICS_HOST:9108/metrics (и /slow — последние медленные запросы).
+# При METRICS_PORT=0 (по умолчанию) не ставится ни одна обёртка и ни одна
+# мидлварь — ноль накладных расходов.
+# - хендлеры aiogram: weirdo_handler_seconds{handler} (внутренняя мидлварь
+#   message/callback_query, после фильтров и ChatSettingsMiddleware) и
+#   weirdo_handler_errors_total{handler};
+# - SQL: каждый execute/executemany на соединениях _db_open (фабрика
+#   _MeteredConnection): weirdo_sql_seconds{query}, weirdo_sql_rows_total{query}
+#   (rowcount для записей, выданные строки для db_one/db_all), дольше
+#   SLOW_QUERY_MS — в weirdo_sql_slow_total, в лог [SLOW SQL] и в /slow.
+#   query — шаблон: пробелы схлопнуты, списки "?, ?, ..." свёрнуты (IN-списки
+#   разной длины — одна серия). Время — шаг execute: у SELECT с ORDER BY/GROUP BY
+#   это вся работа, у потоковых SELECT без сортировки — до первой строки;
+# - Telegram API: weirdo_api_seconds{method}, weirdo_api_errors_total{method, error}
+#   (мидлварь сессии бота);
+# - лаг event loop (weirdo_loop_lag_seconds), ошибки log_error по месту,
+#   размеры словарей в памяти и очереди писателя — снимаются в момент запроса.
+# Запись — без блокировок: у каждого потока (loop, писатель, читатели) свой
+# шард, /metrics складывает шарды.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Metric:
+    """
+    Счётчик (buckets=None) или гистограмма по одному набору меток.
+    Значение серии в шарде: счётчик — [n]; гистограмма — [по корзинам..., +Inf, sum].
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple | None = None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.d
+        except AttributeError:
+            d = self._local.d = {}
+            with self._lock:
+                self._shards.append(d)
+            return d
+
+    def inc(self, key: tuple, n: int = 1):
+        d = self._shard()
+        s = d.get(key)
+        if s is None:
+            s = d[key] = [0]
+        s[0] += n
+
+    def observe(self, key: tuple, value: float):
+        d = self._shard()
+        s = d.get(key)
+        if s is None:
+            s = d[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect.bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def merged(self) -> dict:
+        out = {}
+        with self._lock:
+            shards = list(self._shards)
+        for d in shards:
+            for key, s in list(d.items()):
+                acc = out.get(key)
+                if acc is None:
+                    out[key] = list(s)
+                else:
+                    for i, v in enumerate(s):
+                        acc[i] += v
+        return out
+
+    def render(self, out: list[str]):
+        kind = "counter" if self.buckets is None else "histogram"
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {kind}")
+        for key, s in sorted(self.merged().items()):
+            pairs = list(zip(self.labels, key))
+            if self.buckets is None:
+                out.append(f"{self.name}{_prom_labels(pairs)} {s[0]}")
+                continue
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                out.append(f"{self.name}_bucket{_prom_labels(pairs + [('le', le)])} {acc}")
+            acc += s[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_prom_labels(pairs + [('le', '+Inf')])} {acc}")
+            out.append(f"{self.name}_sum{_prom_labels(pairs)} {s[-1]:.6f}")
+            out.append(f"{self.name}_count{_prom_labels(pairs)} {acc}")
+
+def _prom_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")  # noqa: E731
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+M_HANDLER = Metric("weirdo_handler_seconds", "aiogram handler latency", ("handler",), _LATENCY_BUCKETS)
+M_HANDLER_ERR = Metric("weirdo_handler_errors_total", "aiogram handler exceptions", ("handler",))
+M_SQL = Metric("weirdo_sql_seconds", "SQL statement latency (execute step)", ("query",), _LATENCY_BUCKETS)
+M_SQL_ROWS = Metric("weirdo_sql_rows_total", "rows written (rowcount) or returned by db_one/db_all", ("query",))
+M_SQL_SLOW = Metric("weirdo_sql_slow_total", f"SQL statements slower than SLOW_QUERY_MS={SLOW_QUERY_MS:g}", ("query",))
+M_API = Metric("weirdo_api_seconds", "Telegram Bot API call latency", ("method",), _LATENCY_BUCKETS)
+M_API_ERR = Metric("weirdo_api_errors_total", "Telegram Bot API call errors", ("method", "error"))
+M_LOOP_LAG = Metric("weirdo_loop_lag_seconds", "event loop wake-up lag", (),
+                    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+M_ERRORS = Metric("weirdo_errors_total", "log_error calls by place", ("where",))
+METRICS = (M_HANDLER, M_HANDLER_ERR, M_SQL, M_SQL_ROWS, M_SQL_SLOW, M_API, M_API_ERR, M_LOOP_LAG, M_ERRORS)
+
+_metrics_server = None
+_slow_queries = deque(maxlen=100)  # (время, ms, rows, шаблон)
+_sql_templates: dict[str, tuple] = {}
+RE_SQL_IN = re.compile(r"\bIN ?\(\?(?:, ?\?)*\)", re.IGNORECASE)
+RE_SQL_ROWS = re.compile(r"(\((?:\?, ?)*\?\))(?:, ?\((?:\?, ?)*\?\))+")
+
+def sql_template(sql: str) -> tuple:
+    key = _sql_templates.get(sql)
+    if key is None:
+        t = RE_SQL_IN.sub("IN (?...)", " ".join(sql.split()))
+        key = (RE_SQL_ROWS.sub(r"\1, ...", t),)
+        if len(_sql_templates) < 10_000:
+            _sql_templates[sql] = key
+    return key
+
+def _sql_observe(sql: str, dt: float, rows: int):
+    key = sql_template(sql)
+    M_SQL.observe(key, dt)
+    if rows > 0:
+        M_SQL_ROWS.inc(key, rows)
+    if dt * 1000 >= SLOW_QUERY_MS:
+        M_SQL_SLOW.inc(key)
+        rows = max(rows, 0)
+        _slow_queries.append((time.time(), dt * 1000, rows, key[0]))
+        print(f"[SLOW SQL] {dt * 1000:.0f}ms rows={rows} {key[0][:200]}")
+
+class _MeteredConnection(sqlite3.Connection):
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        cur = super().execute(sql, params)
+        _sql_observe(sql, time.perf_counter() - t0, cur.rowcount)
+        return cur
+
+    def executemany(self, sql, rows):
+        t0 = time.perf_counter()
+        cur = super().executemany(sql, rows)
+        _sql_observe(sql, time.perf_counter() - t0, cur.rowcount)
+        return cur
+
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        key = (data["handler"].callback.__name__,)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            M_HANDLER_ERR.inc(key)
+            raise
+        finally:
+            M_HANDLER.observe(key, time.perf_counter() - t0)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        key = (type(method).__name__,)
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            M_API_ERR.inc((key[0], type(e).__name__))
+            raise
+        finally:
+            M_API.observe(key, time.perf_counter() - t0)
+
+def metrics_install(bot: Bot):
+    """Мидлвари хендлеров и API. SQL меряется сам — фабрикой соединений в _db_open."""
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+
+def metrics_gauges() -> list[tuple[str, str, dict]]:
+    """(имя, help, {метки: значение}) — снимаются в момент запроса."""
+    sizes = {
+        "_last_edit_at": len(_last_edit_at), "_last_edit_text": len(_last_edit_text),
+        "_last_chat_text": len(_last_chat_text), "_settings_cache": len(_settings_cache),
+        "_user_display": len(_user_display), "_user_display_dirty": len(_user_display_dirty),
+        "_duels": len(_duels), "_duels_by_arena": len(_duels_by_arena), "_duels_dirty": len(_duels_dirty),
+        "_duel_timers": len(_duel_timers), "_topk": len(_topk), "_topk_dirty": len(_topk_dirty),
+        "_db_chat_writes": len(_db_chat_writes), "_record_buf": len(_record_buf),
+        "_sql_templates": len(_sql_templates),
+    }
+    lag = loop_lag_stats()
+    return [
+        ("weirdo_map_size", "entries in in-memory maps", {(("map", k),): v for k, v in sizes.items()}),
+        ("weirdo_db_write_queue", "jobs waiting for the db writer", {(): _db_write_q.qsize()}),
+        ("weirdo_ingest_rows", "rows buffered in the ingest write-behind", {(): _ingest_rows}),
+        ("weirdo_loop_lag_max_seconds", "max event loop lag since start", {(): lag["max_ms"] / 1000}),
+        ("weirdo_retention_deleted_total", "rows deleted by retention", {(): _retention["total_deleted"]}),
+    ]
+
+def metrics_render() -> str:
+    out = []
+    for m in METRICS:
+        m.render(out)
+    for name, help, series in metrics_gauges():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        for labels, v in series.items():
+            out.append(f"{name}{_prom_labels(labels)} {v}")
+    return "\n".join(out) + "\n"
+
+def metrics_slow_render() -> str:
+    return "".join(
+        f"{datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='seconds')} {ms:8.1f}ms rows={rows} {q}\n"
+        for ts, ms, rows, q in reversed(_slow_queries)
+    )
+
+async def _metrics_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+        if path == "/metrics":
+            status, body = "200 OK", metrics_render()
+        elif path == "/slow":
+            status, body = "200 OK", metrics_slow_render()
+        else:
+            status, body = "404 Not Found", "try /metrics or /slow\n"
+        data = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+    except Exception as e:
+        log_error("metrics", e)
+    finally:
+        writer.close()
+
+async def metrics_serve(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    global _metrics_server
+    _metrics_server = await asyncio.start_server(_metrics_client, host, port)
+    print(f"[METRICS] http://{host}:{port}/metrics")
+
+# =======================
+# EVENT LOOP LAG
+# =======================
+# Насколько позже запланированного просыпается sleep() — прямая мера того,
+# сколько loop был занят чем-то синхронным.
+LOOP_LAG_INTERVAL_S = 0.5
+LOOP_LAG_WARN_MS = 250
+
+_loop_lag = {"samples": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+def loop_lag_stats() -> dict:
+    st = dict(_loop_lag)
+    st["avg_ms"] = st["total_ms"] / st["samples"] if st["samples"] else 0.0
+    return st
+
+async def background_loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL_S):
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - t0 - interval) * 1000.0)
+        _loop_lag["samples"] += 1
+        _loop_lag["last_ms"] = lag_ms
+        M_LOOP_LAG.observe((), lag_ms / 1000.0)
+        _loop_lag["total_ms"] += lag_ms
+        if lag_ms > _loop_lag["max_ms"]:
+            _loop_lag["max_ms"] = lag_ms
+        if lag_ms >= LOOP_LAG_WARN_MS:
+            print(f"[LAG] event loop stalled for {lag_ms:.0f}ms")
+
+def schema_base(cur):
+    """
+    Миграция 1: схема, как её создавал init_db до SCHEMA MIGRATIONS. Всё через
+    IF NOT EXISTS и проверки колонок — базы без user_version могут быть любого
+    прошлого вида, и на них это тоже должно отработать.
+    """
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chat_settings (
         chat_id INTEGER PRIMARY KEY,
         enabled INTEGER NOT NULL DEFAULT 1,
         tz TEXT NOT NULL DEFAULT '',
-        quiet_until TEXT,
-        last_message_at TEXT,
-        last_easter_at TEXT,
-        last_autohype_at TEXT,
-        last_where_all_at TEXT,
-        last_interesting_at TEXT
+        quiet_until INTEGER,
+        last_message_at INTEGER,
+        last_easter_at INTEGER,
+        last_autohype_at INTEGER,
+        last_where_all_at INTEGER,
+        last_interesting_at INTEGER,
+        retention_days INTEGER
     )""")
+    # колонки, добавленные позже: на старых базах докидываем ALTER-ом
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(chat_settings)")}
+    if "retention_days" not in cols:
+        cur.execute("ALTER TABLE chat_settings ADD COLUMN retention_days INTEGER")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS daily_trigger_count (
@@ -242,16 +798,49 @@ def init_db():
     cur.execute("""
     CREATE TABLE IF NOT EXISTS msg_log (
         chat_id INTEGER,
-        ts TEXT,
+        ts INTEGER,
         user_id INTEGER
     )""")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_log_chat_ts ON msg_log(chat_id, ts)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_log_chat_user_ts ON msg_log(chat_id, user_id, ts)")
 
+    # роллапы активности: часовые и суточные счётчики по юзерам (ключи в UTC)
+    had_rollups = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='msg_hourly'").fetchone()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS msg_hourly (
+        chat_id INTEGER NOT NULL,
+        hour TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, hour, user_id)
+    ) WITHOUT ROWID""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS msg_daily (
+        chat_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, day, user_id)
+    ) WITHOUT ROWID""")
+    if not had_rollups:
+        # первый запуск с роллапами: строим их из того, что есть в msg_log
+        cur.execute("""
+        INSERT INTO msg_hourly(chat_id, hour, user_id, cnt)
+        SELECT chat_id, strftime('%Y-%m-%dT%H', ts), user_id, COUNT(*)
+        FROM msg_log WHERE user_id IS NOT NULL
+        GROUP BY 1, 2, 3
+        """)
+        cur.execute("""
+        INSERT INTO msg_daily(chat_id, day, user_id, cnt)
+        SELECT chat_id, substr(hour, 1, 10), user_id, SUM(cnt)
+        FROM msg_hourly
+        GROUP BY 1, 2, 3
+        """)
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS word_log (
         chat_id INTEGER,
-        ts TEXT,
+        ts INTEGER,
         word TEXT
     )""")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_word_log_chat_ts ON word_log(chat_id, ts)")
@@ -260,17 +849,61 @@ def init_db():
     cur.execute("""
     CREATE TABLE IF NOT EXISTS phrase_log (
         chat_id INTEGER,
-        ts TEXT,
+        ts INTEGER,
         phrase TEXT
     )""")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_phrase_log_chat_ts ON phrase_log(chat_id, ts)")
 
+    # счётчики слов и фраз по часам/суткам (UTC) вместо строки на каждое слово
+    had_terms = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='word_hourly'").fetchone()
+    for name in ("word", "phrase"):
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name}_hourly (
+            chat_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            {name} TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(chat_id, hour, {name})
+        ) WITHOUT ROWID""")
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name}_daily (
+            chat_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            {name} TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(chat_id, day, {name})
+        ) WITHOUT ROWID""")
+    # состояние top-k движка (см. TOP-K ENGINE)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS topk_state (
+        chat_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY(chat_id, kind, bucket)
+    )""")
+    if not had_terms:
+        # первый запуск со счётчиками: пересобираем их из word_log / phrase_log
+        for name in ("word", "phrase"):
+            cur.execute(f"""
+            INSERT INTO {name}_hourly(chat_id, hour, {name}, cnt)
+            SELECT chat_id, strftime('%Y-%m-%dT%H', ts), {name}, COUNT(*)
+            FROM {name}_log WHERE {name} IS NOT NULL AND ts IS NOT NULL
+            GROUP BY 1, 2, 3
+            """)
+            cur.execute(f"""
+            INSERT INTO {name}_daily(chat_id, day, {name}, cnt)
+            SELECT chat_id, substr(hour, 1, 10), {name}, SUM(cnt)
+            FROM {name}_hourly
+            GROUP BY 1, 2, 3
+            """)
+
     cur.execute("""
     CREATE TABLE IF NOT EXISTS user_cache (
         chat_id INTEGER,
         user_id INTEGER,
         display TEXT NOT NULL,
-        updated_at TEXT NOT NULL,
+        updated_at INTEGER NOT NULL,
         PRIMARY KEY(chat_id, user_id)
     )""")
 
@@ -287,7 +920,7 @@ def init_db():
         chat_id INTEGER,
         from_user_id INTEGER,
         to_user_id INTEGER,
-        ts TEXT NOT NULL,
+        ts INTEGER NOT NULL,
         PRIMARY KEY(chat_id, from_user_id, to_user_id)
     )""")
 
@@ -299,8 +932,8 @@ def init_db():
         a_id INTEGER NOT NULL,
         b_id INTEGER NOT NULL,
         state TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        accept_deadline TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        accept_deadline INTEGER NOT NULL,
         arena_msg_id INTEGER,
         data TEXT
     )""")
@@ -311,7 +944,7 @@ def init_db():
     CREATE TABLE IF NOT EXISTS luck_cooldown (
         chat_id INTEGER,
         user_id INTEGER,
-        ts TEXT NOT NULL,
+        ts INTEGER NOT NULL,
         PRIMARY KEY(chat_id, user_id)
     )""")
     cur.execute("""
@@ -341,23 +974,50 @@ def init_db():
         PRIMARY KEY(chat_id, user_id)
     )""")
 
+    # журнал проводок: kind — индекс в TX_KINDS, всё, по чему ищем, — в своих колонках
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS token_tx (
-        chat_id INTEGER,
-        ts TEXT NOT NULL,
+    CREATE TABLE IF NOT EXISTS token_ledger (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
         from_user_id INTEGER,
         to_user_id INTEGER,
         amount INTEGER NOT NULL,
-        kind TEXT NOT NULL,
-        meta TEXT
+        duel_id TEXT,
+        item TEXT,
+        mode TEXT,
+        mult REAL,
+        fee INTEGER NOT NULL DEFAULT 0,       -- сверх amount списано с from (комиссия перевода)
+        treasury INTEGER NOT NULL DEFAULT 0,  -- сколько операция положила в казну (или взяла)
+        jackpot INTEGER NOT NULL DEFAULT 0,   -- то же для джекпота
+        meta TEXT                 -- то, по чему не ищем (разбивка daily, причина возврата)
     )""")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_token_tx_chat_ts ON token_tx(chat_id, ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_chat_ts ON token_ledger(chat_id, ts)")
+    # покрывающие: суммы по юзеру и виду читаются из индекса, без похода в таблицу
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_ledger_from ON token_ledger(chat_id, from_user_id, kind, amount)
+    WHERE from_user_id IS NOT NULL""")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_ledger_to ON token_ledger(chat_id, to_user_id, kind, amount)
+    WHERE to_user_id IS NOT NULL""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ledger_duel ON token_ledger(duel_id) WHERE duel_id IS NOT NULL")
+    # итоги по юзеру и виду, ведутся в tx_log той же транзакцией
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS token_totals (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
+        spent INTEGER NOT NULL DEFAULT 0,
+        earned INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(chat_id, user_id, kind)
+    ) WITHOUT ROWID""")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS slot_cooldown (
         chat_id INTEGER,
         user_id INTEGER,
-        ts TEXT NOT NULL,
+        ts INTEGER NOT NULL,
         PRIMARY KEY(chat_id, user_id)
     )""")
 
@@ -385,7 +1045,7 @@ def init_db():
     CREATE TABLE IF NOT EXISTS daily_streak (
         chat_id INTEGER,
         user_id INTEGER,
-        last_claim_at TEXT,
+        last_claim_at INTEGER,
         streak INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY(chat_id, user_id)
     )""")
@@ -435,14 +1095,11 @@ def init_db():
         duel_losses INTEGER NOT NULL DEFAULT 0,
         duel_bank_won INTEGER NOT NULL DEFAULT 0,  -- сколько токенов выиграно банками дуэлей
 
-        updated_at TEXT,
+        updated_at INTEGER,
 
         PRIMARY KEY(chat_id, user_id)
     )""")
 
-    con.commit()
-    con.close()
-
 def ensure_chat(chat_id: int):
     row = db_one("SELECT chat_id FROM chat_settings WHERE chat_id=?", (chat_id,))
     if row is None:
@@ -452,14 +1109,13 @@ def get_settings(chat_id: int):
     ensure_chat(chat_id)
     row = db_one("""
     SELECT enabled, tz, quiet_until, last_message_at, last_easter_at, last_autohype_at,
-           last_where_all_at, last_interesting_at
+           last_where_all_at, last_interesting_at, retention_days
     FROM chat_settings WHERE chat_id=?
     """, (chat_id,))
-    enabled, tz, quiet_until, last_msg, last_easter, last_autohype, last_where, last_interesting = row
+    enabled, tz, quiet_until, last_msg, last_easter, last_autohype, last_where, last_interesting, retention = row
     tz = tz if tz else DEFAULT_TZ
 
-    def parse_dt(s):
-        return datetime.fromisoformat(s) if s else None
+    parse_dt = from_epoch
 
     return {
         "enabled": bool(enabled),
@@ -470,12 +1126,13 @@ def get_settings(chat_id: int):
         "last_autohype_at": parse_dt(last_autohype),
         "last_where_all_at": parse_dt(last_where),
         "last_interesting_at": parse_dt(last_interesting),
+        "retention_days": int(retention) if retention else RETENTION_DAYS,
     }
 
 def set_field(chat_id: int, field: str, value):
     ensure_chat(chat_id)
     if isinstance(value, datetime):
-        value = value.isoformat()
+        value = epoch(value)
     db_exec(f"UPDATE chat_settings SET {field}=? WHERE chat_id=?", (value, chat_id))
 
 def set_null(chat_id: int, field: str):
@@ -485,97 +1142,789 @@ def set_null(chat_id: int, field: str):
 def inc_daily_trigger(chat_id: int, day: str) -> int:
     row = db_one("SELECT cnt FROM daily_trigger_count WHERE chat_id=? AND day=?", (chat_id, day))
     if row is None:
-        db_exec("INSERT INTO daily_trigger_count(chat_id, day, cnt) VALUES(?, ?, 1)", (chat_id, day, 1))
+        db_exec("INSERT INTO daily_trigger_count(chat_id, day, cnt) VALUES(?, ?, 1)", (chat_id, day))
         return 1
     cnt = row[0] + 1
     db_exec("UPDATE daily_trigger_count SET cnt=? WHERE chat_id=? AND day=?", (cnt, chat_id, day))
     return cnt
 
-def add_msg_log(chat_id: int, ts: datetime, user_id: int):
-    db_exec("INSERT INTO msg_log(chat_id, ts, user_id) VALUES(?, ?, ?)", (chat_id, ts.isoformat(), user_id))
+# =======================
+# CHAT SETTINGS CACHE
+# =======================
+# Настройки чата нужны почти каждому апдейту, а меняются редко — держим их в
+# памяти. Промах грузит строку через поток-писатель; все записи идут через
+# settings_set/settings_clear, которые правят закэшированный словарь на месте.
+# Писатель один и очередь FIFO, поэтому загрузка не может вернуть значение
+# старее уже применённой записи.
+_settings_cache: dict[int, dict] = {}
+
+async def chat_settings(chat_id: int) -> dict:
+    s = _settings_cache.get(chat_id)
+    if s is None:
+        s = await db_write(chat_id, get_settings, chat_id)
+        s = _settings_cache.setdefault(chat_id, s)
+    return s
+
+def settings_cached(chat_id: int) -> dict | None:
+    return _settings_cache.get(chat_id)
+
+def settings_invalidate(chat_id: int | None = None):
+    if chat_id is None:
+        _settings_cache.clear()
+    else:
+        _settings_cache.pop(chat_id, None)
+
+async def settings_set(chat_id: int, field: str, value):
+    await db_write(chat_id, set_field, chat_id, field, value)
+    s = _settings_cache.get(chat_id)
+    if s is not None:
+        s[field] = bool(value) if field == "enabled" else value
 
-def add_words(chat_id: int, ts: datetime, words):
-    rows = []
+async def settings_clear(chat_id: int, field: str):
+    await db_write(chat_id, set_null, chat_id, field)
+    s = _settings_cache.get(chat_id)
+    if s is not None:
+        s[field] = None
+
+# =======================
+# INGEST BUFFER (write-behind)
+# =======================
+# Активность копится в памяти и пишется одной транзакцией: раз в INGEST_FLUSH_MS
+# или как только набралось INGEST_FLUSH_ROWS строк, плюс на выходе. При падении
+# процесса теряется не больше INGEST_FLUSH_MS активности (и не больше ~INGEST_FLUSH_ROWS строк).
+# - msg_log — сырые строки (+ last_message_at);
+# - msg / word / phrase — счётчики по (chat_id, час UTC, ключ), пишутся upsert-ом
+#   в <name>_hourly и <name>_daily. Строку на каждое слово больше не пишем.
+# В ту же транзакцию уходят сменившиеся имена из USER DISPLAY CACHE и data
+# дуэлей из реестра (см. DUELS).
+# Буфер трогаем только из event loop.
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "1000"))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "500"))
+
+# роллап -> колонка ключа в <name>_hourly / <name>_daily
+ROLLUPS = {"msg": "user_id", "word": "word", "phrase": "phrase"}
+
+def _ingest_new() -> dict:
+    batch = {"msg_log": [], "last_msg": {}}
+    for name in ROLLUPS:
+        batch[name] = {}  # (chat_id, hour, key) -> cnt
+    return batch
+
+_ingest = _ingest_new()
+_ingest_rows = 0
+_ingest_wake = asyncio.Event()
+
+def _ingest_count(n: int):
+    global _ingest_rows
+    _ingest_rows += n
+    if _ingest_rows >= INGEST_FLUSH_ROWS:
+        _ingest_wake.set()
+
+def _ingest_bump(name: str, chat_id: int, hour: str, key, n: int = 1):
+    counters = _ingest[name]
+    k = (chat_id, hour, key)
+    counters[k] = counters.get(k, 0) + n
+
+def ingest_batch_rows(batch: dict) -> int:
+    return len(batch["msg_log"]) + sum(sum(batch[name].values()) for name in ROLLUPS if name != "msg")
+
+def ingest_msg(chat_id: int, ts: datetime, user_id: int):
+    _ingest["msg_log"].append((chat_id, epoch(ts), user_id))
+    _ingest_bump("msg", chat_id, utc_hour_key(ts), user_id)
+    _ingest_count(1)
+
+def ingest_text(chat_id: int, ts: datetime, text: str):
+    hour = utc_hour_key(ts)
+    words = [w for w in tokenize(text) if len(w) >= 3]
     for w in words:
-        w = w.lower()
-        if len(w) < 3:
+        _ingest_bump("word", chat_id, hour, w)
+    n = len(words)
+
+    # как фразу логируем "нормализованную строку" (без огромных полотен)
+    phrase = normalize_phrase(text)
+    if 0 < len(phrase) <= 120:
+        _ingest_bump("phrase", chat_id, hour, phrase)
+        n += 1
+    else:
+        phrase = None
+    _ingest_count(n)
+
+    if TOPK_ENGINE == "spacesaving":
+        topk_feed("word", chat_id, ts, words)
+        if phrase:
+            topk_feed("phrase", chat_id, ts, (phrase,))
+
+def ingest_last_message(chat_id: int, ts: datetime):
+    _ingest["last_msg"][chat_id] = epoch(ts)
+    s = _settings_cache.get(chat_id)
+    if s is not None:
+        s["last_message_at"] = ts
+
+def ingest_take() -> dict | None:
+    global _ingest, _ingest_rows
+    if not _ingest_rows and not _ingest["last_msg"]:
+        return None
+    batch = _ingest
+    _ingest = _ingest_new()
+    _ingest_rows = 0
+    return batch
+
+def rollup_upsert(con: sqlite3.Connection, name: str, hourly: dict):
+    """Счётчики (chat_id, hour, key) -> n: в <name>_hourly и, свёрнутые по дню, в <name>_daily."""
+    col = ROLLUPS[name]
+    daily = {}
+    for (chat_id, hour, key), n in hourly.items():
+        k = (chat_id, hour[:10], key)
+        daily[k] = daily.get(k, 0) + n
+    con.executemany(f"""
+    INSERT INTO {name}_hourly(chat_id, hour, {col}, cnt) VALUES(?, ?, ?, ?)
+    ON CONFLICT(chat_id, hour, {col}) DO UPDATE SET cnt = cnt + excluded.cnt
+    """, [(*k, n) for k, n in hourly.items()])
+    con.executemany(f"""
+    INSERT INTO {name}_daily(chat_id, day, {col}, cnt) VALUES(?, ?, ?, ?)
+    ON CONFLICT(chat_id, day, {col}) DO UPDATE SET cnt = cnt + excluded.cnt
+    """, [(*k, n) for k, n in daily.items()])
+
+def ingest_write(batch: dict):
+    users = user_display_take()
+    duels = duels_dirty_take()
+    try:
+        with db_tx() as con:
+            _ingest_write(con, batch)
+            if users:
+                con.executemany(USER_DISPLAY_UPSERT, users)
+            if duels:
+                con.executemany("UPDATE duels SET data=? WHERE chat_id=? AND duel_id=?", duels)
+    except Exception:
+        user_display_restore(users)
+        duels_dirty_restore(duels)
+        raise
+
+def _ingest_write(con: sqlite3.Connection, batch: dict):
+    if batch["msg_log"]:
+        con.executemany("INSERT INTO msg_log(chat_id, ts, user_id) VALUES(?, ?, ?)", batch["msg_log"])
+    if batch["last_msg"]:
+        con.executemany(
+            "UPDATE chat_settings SET last_message_at=? WHERE chat_id=?",
+            [(ts, chat_id) for chat_id, ts in batch["last_msg"].items()],
+        )
+    for name in ROLLUPS:
+        if batch[name]:
+            rollup_upsert(con, name, batch[name])
+
+async def ingest_flush():
+    batch = ingest_take()
+    if batch is None:
+        if not _user_display_dirty and not _duels_dirty:
+            return
+        batch = _ingest_new()
+    try:
+        await db_write(None, ingest_write, batch)
+    except Exception:
+        # вернём строки в буфер — попробуем в следующий раз
+        _ingest["msg_log"][:0] = batch["msg_log"]
+        for chat_id, ts in batch["last_msg"].items():
+            _ingest["last_msg"].setdefault(chat_id, ts)
+        for name in ROLLUPS:
+            for (chat_id, hour, key), n in batch[name].items():
+                _ingest_bump(name, chat_id, hour, key, n)
+        _ingest_count(ingest_batch_rows(batch))
+        raise
+
+async def background_ingest_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_ingest_wake.wait(), timeout=INGEST_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _ingest_wake.clear()
+        try:
+            await ingest_flush()
+        except Exception as e:
+            log_error("ingest_flush", e)
+            # не крутимся вхолостую, пока БД недоступна
+            await asyncio.sleep(INGEST_FLUSH_MS / 1000)
+
+# =======================
+# RETENTION (background)
+# =======================
+# Сырые логи чистит фоновая задача раз в RETENTION_INTERVAL_S, а не any_message.
+# Удаляем пачками по RETENTION_BATCH строк (rowid через индекс chat_id+ts):
+# каждая пачка — отдельная короткая запись в потоке-писателе, между пачками
+# проходят записи хендлеров, write lock надолго не держим.
+# Окно хранения сырых логов и счётчиков слов/фраз — на чат (/retention),
+# по умолчанию RETENTION_DAYS. Роллапы сообщений живут дольше:
+# msg_hourly — ROLLUP_HOURLY_DAYS, msg_daily — ROLLUP_DAILY_DAYS.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "7"))
+RETENTION_MAX_DAYS = 365
+RETENTION_INTERVAL_S = int(os.getenv("RETENTION_INTERVAL_S", "600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "2000"))
+ROLLUP_HOURLY_DAYS = int(os.getenv("ROLLUP_HOURLY_DAYS", "31"))
+ROLLUP_DAILY_DAYS = int(os.getenv("ROLLUP_DAILY_DAYS", "400"))
+
+_retention = {"runs": 0, "last_deleted": 0, "last_ms": 0.0, "total_deleted": 0, "total_ms": 0.0}
+
+def retention_stats() -> dict:
+    return dict(_retention)
+
+def retention_chats() -> list[tuple[int, str, int]]:
+    rows = db_all("SELECT chat_id, tz, retention_days FROM chat_settings")
+    return [(cid, tz or DEFAULT_TZ, int(days) if days else RETENTION_DAYS) for cid, tz, days in rows]
+
+def retention_cutoffs(now: datetime, days: int) -> list[tuple[str, str, str, int | str]]:
+    """
+    (таблица, колонка времени, ключ строки, граница) — всё, что строго раньше
+    границы, удаляем. У роллапов (WITHOUT ROWID) ключ строки — первичный ключ,
+    граница — ключ бакета; у сырых логов — epoch.
+    """
+    since = now - timedelta(days=days)
+    raw = epoch(since)
+    cutoffs = [
+        ("msg_log", "ts", "rowid", raw),
+        ("word_log", "ts", "rowid", raw),
+        ("phrase_log", "ts", "rowid", raw),
+    ]
+    for name, col in ROLLUPS.items():
+        if name == "msg":
+            hour_cut = utc_hour_key(now - timedelta(days=ROLLUP_HOURLY_DAYS))
+            day_cut = utc_day_key(now - timedelta(days=ROLLUP_DAILY_DAYS))
+        else:
+            hour_cut, day_cut = utc_hour_key(since), utc_day_key(since)
+        cutoffs.append((f"{name}_hourly", "hour", f"chat_id, hour, {col}", hour_cut))
+        cutoffs.append((f"{name}_daily", "day", f"chat_id, day, {col}", day_cut))
+    return cutoffs
+
+def prune_log_batch(table: str, col: str, key: str, chat_id: int, cutoff: int | str, limit: int) -> int:
+    cur = db_conn().execute(f"""
+    DELETE FROM {table} WHERE ({key}) IN (
+        SELECT {key} FROM {table} WHERE chat_id=? AND {col} < ? LIMIT ?
+    )""", (chat_id, cutoff, limit))
+    return cur.rowcount
+
+async def retention_run_once(batch: int = RETENTION_BATCH) -> int:
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    deleted = 0
+    for chat_id, tz, days in await db_read(None, retention_chats):
+        for table, col, key, cutoff in retention_cutoffs(now_tz(tz), days):
+            while True:
+                n = await db_write(None, prune_log_batch, table, col, key, chat_id, cutoff, batch)
+                deleted += n
+                if n < batch:
+                    break
+
+    ms = (loop.time() - t0) * 1000.0
+    _retention["runs"] += 1
+    _retention["last_deleted"] = deleted
+    _retention["last_ms"] = ms
+    _retention["total_deleted"] += deleted
+    _retention["total_ms"] += ms
+    if deleted:
+        print(f"[RETENTION] deleted {deleted} rows in {ms:.0f}ms")
+    return deleted
+
+async def background_retention(interval: float = RETENTION_INTERVAL_S):
+    while True:
+        try:
+            await retention_run_once()
+        except Exception as e:
+            log_error("background_retention", e)
+        await asyncio.sleep(interval)
+
+# =======================
+# EPOCH MIGRATION
+# =======================
+# Раньше время лежало isoformat-текстом со смещением пояса чата: ts>=? сравнивал
+# строки (после /tz — неправильно), индексы пухли, а кулдауны парсили
+# fromisoformat на каждый вызов. Теперь все колонки из EPOCH_COLUMNS — INTEGER,
+# секунды UTC epoch.
+#
+# SQLite не меняет тип колонки на месте, поэтому таблицу пересобираем: старая
+# переименовывается в <table>_iso, создаётся новая по той же схеме (TEXT ->
+# INTEGER), индексы переезжают на неё, строки переносятся с
+# CAST(strftime('%s', ts) AS INTEGER) — смещение учитывает сам SQLite.
+# Маленькие таблицы (по строке на юзера/чат) переносим целиком в init_db.
+# Логи из EPOCH_ONLINE — онлайн: в init_db только самая свежая пачка (после
+# неё встают rowid новых строк), остальное — фоновая задача пачками по
+# EPOCH_MIGRATE_BATCH, от новых к старым, каждая пачка — короткая запись
+# в потоке-писателе. Пока перенос не закончен, окна по сырым логам могут
+# недосчитать самые старые строки, а сверка журнала ждёт.
+EPOCH_COLUMNS = {
+    "chat_settings": ("quiet_until", "last_message_at", "last_easter_at", "last_autohype_at",
+                      "last_where_all_at", "last_interesting_at"),
+    "user_cache": ("updated_at",),
+    "rep_votes": ("ts",),
+    "duels": ("created_at", "accept_deadline"),
+    "luck_cooldown": ("ts",),
+    "slot_cooldown": ("ts",),
+    "daily_streak": ("last_claim_at",),
+    "user_stats": ("updated_at",),
+    "msg_log": ("ts",),
+    "word_log": ("ts",),
+    "phrase_log": ("ts",),
+    "token_ledger": ("ts",),
+}
+EPOCH_ONLINE = ("msg_log", "word_log", "phrase_log", "token_ledger")
+EPOCH_MIGRATE_BATCH = int(os.getenv("EPOCH_MIGRATE_BATCH", "5000"))
+
+def _epoch_expr(col: str) -> str:
+    return f"CASE WHEN typeof({col})='text' THEN CAST(strftime('%s', {col}) AS INTEGER) ELSE {col} END"
+
+def epoch_migration_pending(con: sqlite3.Connection | None = None) -> list[str]:
+    con = con or db_conn()
+    names = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    return [t for t in EPOCH_ONLINE if f"{t}_iso" in names]
+
+def _epoch_copy_cols(cur, table: str) -> tuple[str, str]:
+    """-> (список колонок для INSERT, то же для SELECT из <table>_iso с конверсией)."""
+    info = cur.execute(f"PRAGMA table_info({table})").fetchall()
+    cols = [r[1] for r in info]
+    conv = [_epoch_expr(c) if c in EPOCH_COLUMNS[table] else c for c in cols]
+    # rowid сохраняем; у token_ledger он и так в id (INTEGER PRIMARY KEY)
+    if not any(r[5] == 1 and r[2].upper() == "INTEGER" for r in info):
+        cols, conv = ["rowid", *cols], ["rowid", *conv]
+    return ", ".join(cols), ", ".join(conv)
+
+def epoch_migrate_init(cur):
+    for table, cols in EPOCH_COLUMNS.items():
+        types = {r[1]: r[2].upper() for r in cur.execute(f"PRAGMA table_info({table})")}
+        if not any(types.get(c) == "TEXT" for c in cols):
             continue
-        rows.append((chat_id, ts.isoformat(), w))
-    if not rows:
-        return
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.executemany("INSERT INTO word_log(chat_id, ts, word) VALUES(?, ?, ?)", rows)
-    con.commit()
-    con.close()
-
-def add_phrase(chat_id: int, ts: datetime, phrase: str):
-    if not phrase:
-        return
-    phrase = normalize_phrase(phrase)
-    if not phrase or len(phrase) > 300:
-        return
-    db_exec("INSERT INTO phrase_log(chat_id, ts, phrase) VALUES(?, ?, ?)", (chat_id, ts.isoformat(), phrase))
-
-def prune_logs(chat_id: int, cutoff: datetime):
-    cutoff_s = cutoff.isoformat()
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("DELETE FROM msg_log WHERE chat_id=? AND ts < ?", (chat_id, cutoff_s))
-    cur.execute("DELETE FROM word_log WHERE chat_id=? AND ts < ?", (chat_id, cutoff_s))
-    cur.execute("DELETE FROM phrase_log WHERE chat_id=? AND ts < ?", (chat_id, cutoff_s))
-    con.commit()
-    con.close()
+        old = f"{table}_iso"
+        sql = cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+        indexes = cur.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+        ).fetchall()
+        for c in cols:
+            sql = re.sub(rf"\b{c}\s+TEXT\b", f"{c} INTEGER", sql)
+        t0 = time.perf_counter()
+        with db_tx():
+            cur.execute(f"ALTER TABLE {table} RENAME TO {old}")
+            for name, _sql in indexes:
+                cur.execute(f"DROP INDEX {name}")
+            cur.execute(sql)
+            for _name, isql in indexes:
+                cur.execute(isql)
+            if table not in EPOCH_ONLINE:
+                ins, sel = _epoch_copy_cols(cur, table)
+                cur.execute(f"INSERT INTO {table}({ins}) SELECT {sel} FROM {old}")
+                cur.execute(f"DROP TABLE {old}")
+            else:
+                epoch_migrate_step(table, EPOCH_MIGRATE_BATCH)
+        print(f"[EPOCH] {table}: {', '.join(cols)} -> INTEGER in {(time.perf_counter() - t0) * 1000:.0f}ms"
+              + (" (rest online)" if table in EPOCH_ONLINE else ""))
+
+def epoch_migrate_step(table: str, batch: int = EPOCH_MIGRATE_BATCH) -> int:
+    """Перенести из <table>_iso самые новые batch строк. -> сколько перенесли (0 — готово, _iso удалена)."""
+    old = f"{table}_iso"
+    with db_tx() as con:
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (old,)).fetchone():
+            return 0
+        row = con.execute(f"SELECT MIN(rowid) FROM (SELECT rowid FROM {old} ORDER BY rowid DESC LIMIT ?)",
+                          (batch,)).fetchone()
+        if row[0] is None:
+            con.execute(f"DROP TABLE {old}")
+            return 0
+        ins, sel = _epoch_copy_cols(con, table)
+        n = con.execute(f"INSERT INTO {table}({ins}) SELECT {sel} FROM {old} WHERE rowid >= ?", (row[0],)).rowcount
+        con.execute(f"DELETE FROM {old} WHERE rowid >= ?", (row[0],))
+        return n
+
+def epoch_migrate_backfill(batch: int = EPOCH_MIGRATE_BATCH) -> int:
+    """Одна пачка онлайн-переноса (миграция 5): первая таблица, где он не закончен. 0 — всё перенесено."""
+    for table in epoch_migration_pending():
+        n = epoch_migrate_step(table, batch)
+        if n:
+            return n
+    return 0
+
+def rollup_top(name: str, chat_id: int, since: datetime, limit: int):
+    """
+    Топ ключей роллапа name (word/phrase) с since: часовые бакеты от часа, в который
+    попал since, до ближайших суток, дальше суточные. Точность — до часа.
+    """
+    col = ROLLUPS[name]
+    h0 = since.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    d0 = h0.replace(hour=0)
+    if d0 < h0:
+        d0 += timedelta(days=1)
+    return db_all(f"""
+    SELECT {col}, SUM(cnt) AS c FROM (
+        SELECT {col}, cnt FROM {name}_hourly
+        WHERE chat_id=? AND hour>=? AND hour<?
+        UNION ALL
+        SELECT {col}, cnt FROM {name}_daily
+        WHERE chat_id=? AND day>=?
+    )
+    GROUP BY {col}
+    ORDER BY c DESC, {col}
+    LIMIT ?
+    """, (chat_id, utc_hour_key(h0), utc_hour_key(d0), chat_id, utc_day_key(d0), limit))
 
 def get_top_phrase(chat_id: int, since: datetime):
-    rows = db_all("""
-    SELECT phrase, COUNT(*) as c
-    FROM phrase_log
-    WHERE chat_id=? AND ts>=?
-    GROUP BY phrase
-    ORDER BY c DESC
-    LIMIT 1
-    """, (chat_id, since.isoformat()))
+    if TOPK_ENGINE == "spacesaving":
+        rows = topk_query("phrase", chat_id, since, 1)
+    else:
+        rows = rollup_top("phrase", chat_id, since, 1)
     return rows[0] if rows else None
 
 def get_top_words(chat_id: int, since: datetime, limit=3):
-    return db_all("""
-    SELECT word, COUNT(*) as c
-    FROM word_log
-    WHERE chat_id=? AND ts>=?
-    GROUP BY word
-    ORDER BY c DESC
-    LIMIT ?
-    """, (chat_id, since.isoformat(), limit))
+    if TOPK_ENGINE == "spacesaving":
+        return topk_query("word", chat_id, since, limit)
+    return rollup_top("word", chat_id, since, limit)
 
-def get_user_counts(chat_id: int, since: datetime):
-    return db_all("""
-    SELECT user_id, COUNT(*) as c
-    FROM msg_log
-    WHERE chat_id=? AND ts>=?
-    GROUP BY user_id
-    ORDER BY c DESC
-    """, (chat_id, since.isoformat()))
+# =======================
+# TOP-K ENGINE (Space-Saving)
+# =======================
+# Потоковый топ слов/фраз без полной таблицы частот. На каждый (чат, word|phrase,
+# бакет) держим не больше TOPK_CAPACITY счётчиков — алгоритм Space-Saving
+# (Metwally, Agrawal, El Abbadi, 2005). Бакеты: час UTC (последние TOPK_HOURLY_HOURS)
+# и сутки UTC (последние TOPK_DAYS); окно склеиваем так же, как rollup_top.
+#
+# Гарантии для одного бакета, где прошло N термов и k = TOPK_CAPACITY:
+# - оценка не меньше истинной частоты и больше неё не более чем на err ≤ N/k
+#   (err хранится у каждого счётчика);
+# - любой терм с частотой > N/k в бакете гарантированно есть среди счётчиков.
+# При склейке бакетов границы складываются: оценка в [истина − Σ min_b, истина + Σ N_b/k],
+# где min_b — минимальный счётчик заполненного бакета (терм мог туда не попасть).
+# Часовые бакеты живут TOPK_HOURLY_HOURS: у окон длиннее начало округляется
+# вверх до суток (7d ≈ последние 6–7 суток).
+#
+# Включается TOPK_ENGINE=spacesaving (по умолчанию топ считает SQL по счётчикам).
+# Кормим из ingest_text (event loop), читаем из потоков БД — всё под _topk_lock.
+# Состояние сбрасывается в topk_state раз в TOPK_PERSIST_S и поднимается на старте:
+# при падении теряется не больше TOPK_PERSIST_S активности.
+TOPK_ENGINE = os.getenv("TOPK_ENGINE", "sql")
+TOPK_CAPACITY = int(os.getenv("TOPK_CAPACITY", "256"))
+TOPK_HOURLY_HOURS = 48
+TOPK_DAYS = int(os.getenv("TOPK_DAYS", "8"))
+TOPK_PERSIST_S = int(os.getenv("TOPK_PERSIST_S", "60"))
+
+class SpaceSaving:
+    """
+    k счётчиков + корзины по значению счётчика (Stream-Summary), чтобы и инкремент,
+    и вытеснение минимального были O(1).
+    """
+    __slots__ = ("k", "n", "counts", "errs", "_by_count", "_min")
+
+    def __init__(self, k: int):
+        self.k = k
+        self.n = 0              # сколько термов прошло через бакет
+        self.counts = {}        # term -> оценка частоты
+        self.errs = {}          # term -> максимальная переоценка
+        self._by_count = {}     # count -> set(term)
+        self._min = 0
+
+    def _put(self, term: str, c: int):
+        self.counts[term] = c
+        b = self._by_count.get(c)
+        if b is None:
+            b = self._by_count[c] = set()
+        b.add(term)
+
+    def _drop(self, term: str, c: int):
+        b = self._by_count[c]
+        b.discard(term)
+        if not b:
+            del self._by_count[c]
+
+    def add(self, term: str):
+        self.n += 1
+        c = self.counts.get(term)
+        if c is not None:
+            self._drop(term, c)
+            self._put(term, c + 1)
+            if c == self._min and c not in self._by_count:
+                self._min = c + 1
+            return
+        if len(self.counts) < self.k:
+            self._put(term, 1)
+            self.errs[term] = 0
+            self._min = 1
+            return
+        # вытесняем минимальный счётчик; новый терм наследует его значение как ошибку
+        floor = self._min
+        victim = next(iter(self._by_count[floor]))
+        self._drop(victim, floor)
+        del self.counts[victim]
+        del self.errs[victim]
+        self._put(term, floor + 1)
+        self.errs[term] = floor
+        if floor not in self._by_count:
+            self._min = floor + 1
+
+    def min_count(self) -> int:
+        return self._min if len(self.counts) >= self.k else 0
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {"k": self.k, "n": self.n, "c": [[t, c, self.errs[t]] for t, c in self.counts.items()]},
+            ensure_ascii=False,
+        )
+
+    @classmethod
+    def loads(cls, raw: str) -> "SpaceSaving":
+        d = json.loads(raw)
+        ss = cls(int(d.get("k", TOPK_CAPACITY)))
+        ss.n = int(d.get("n", 0))
+        for t, c, e in d.get("c", []):
+            ss._put(t, int(c))
+            ss.errs[t] = int(e)
+        ss._min = min(ss._by_count) if ss._by_count else 0
+        return ss
+
+_topk = {}          # (chat_id, kind, bucket) -> SpaceSaving
+_topk_dirty = set()
+_topk_lock = threading.Lock()
+
+def _topk_expired(bucket: str, now: datetime) -> bool:
+    if "T" in bucket:
+        return bucket < utc_hour_key(now - timedelta(hours=TOPK_HOURLY_HOURS))
+    return bucket < utc_day_key(now - timedelta(days=TOPK_DAYS))
+
+def topk_feed(kind: str, chat_id: int, ts: datetime, terms):
+    hour = utc_hour_key(ts)
+    with _topk_lock:
+        for bucket in (hour, hour[:10]):
+            key = (chat_id, kind, bucket)
+            ss = _topk.get(key)
+            if ss is None:
+                ss = _topk[key] = SpaceSaving(TOPK_CAPACITY)
+            for t in terms:
+                ss.add(t)
+            _topk_dirty.add(key)
+
+def topk_query(kind: str, chat_id: int, since: datetime, limit: int):
+    h0 = since.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    d0 = h0.replace(hour=0)
+    if d0 < h0:
+        d0 += timedelta(days=1)
+    buckets = []
+    t = h0
+    while t < d0:
+        buckets.append(utc_hour_key(t))
+        t += timedelta(hours=1)
+    end = utc_day_key(datetime.now(timezone.utc))
+    t = d0
+    while utc_day_key(t) <= end:
+        buckets.append(utc_day_key(t))
+        t += timedelta(days=1)
+
+    total = {}
+    with _topk_lock:
+        for bucket in buckets:
+            ss = _topk.get((chat_id, kind, bucket))
+            if ss is None:
+                continue
+            for term, c in ss.counts.items():
+                total[term] = total.get(term, 0) + c
+    return sorted(total.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+def topk_take_snapshot(now: datetime) -> tuple[list, list]:
+    """-> (строки для upsert в topk_state, ключи протухших бакетов для удаления)"""
+    with _topk_lock:
+        expired = [key for key in _topk if _topk_expired(key[2], now)]
+        for key in expired:
+            del _topk[key]
+            _topk_dirty.discard(key)
+        rows = [(*key, _topk[key].dumps()) for key in _topk_dirty]
+        _topk_dirty.clear()
+    return rows, expired
+
+def topk_save(rows: list, expired: list):
+    with db_tx() as con:
+        if rows:
+            con.executemany("""
+            INSERT INTO topk_state(chat_id, kind, bucket, data) VALUES(?, ?, ?, ?)
+            ON CONFLICT(chat_id, kind, bucket) DO UPDATE SET data=excluded.data
+            """, rows)
+        if expired:
+            con.executemany("DELETE FROM topk_state WHERE chat_id=? AND kind=? AND bucket=?", expired)
+
+def topk_load():
+    now = datetime.now(timezone.utc)
+    expired = []
+    loaded = {}
+    for chat_id, kind, bucket, data in db_all("SELECT chat_id, kind, bucket, data FROM topk_state"):
+        key = (chat_id, kind, bucket)
+        if _topk_expired(bucket, now):
+            expired.append(key)
+            continue
+        try:
+            loaded[key] = SpaceSaving.loads(data)
+        except Exception as e:
+            log_error("topk_load", e)
+    with _topk_lock:
+        _topk.update(loaded)
+    if expired:
+        topk_save([], expired)
+    return len(loaded)
+
+async def topk_persist():
+    rows, expired = topk_take_snapshot(datetime.now(timezone.utc))
+    if rows or expired:
+        await db_write(None, topk_save, rows, expired)
+
+async def background_topk_persist(interval: float = TOPK_PERSIST_S):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await topk_persist()
+        except Exception as e:
+            log_error("topk_persist", e)
+
+def get_user_counts(chat_id: int, since: datetime, retention_days: int = RETENTION_DAYS):
+    """
+    Сообщения по юзерам начиная с since, по убыванию. Склеиваем три слоя без перекрытий:
+    - [since, h0)  — сырые msg_log (меньше часа строк);
+    - [h0, d0)     — msg_hourly (меньше суток бакетов);
+    - [d0, ...)    — msg_daily.
+    h0/d0 — ближайшие к since сверху граница часа и суток (UTC). Слой, который
+    retention уже подрезал, не читаем, а округляем начало окна вниз:
+    - since старше retention_days чата (сырых строк нет) — h0 = час since;
+    - since старше ROLLUP_HOURLY_DAYS (нет и часовых бакетов) — d0 = сутки since.
+    """
+    su = since.astimezone(timezone.utc)
+    now = datetime.now(timezone.utc)
+    hour_floor = su.replace(minute=0, second=0, microsecond=0)
+    if su < now - timedelta(days=ROLLUP_HOURLY_DAYS):
+        d0 = h0 = hour_floor.replace(hour=0)
+        since = None
+    else:
+        h0 = hour_floor
+        if su < now - timedelta(days=retention_days):
+            since = None
+        elif h0 < su:
+            h0 += timedelta(hours=1)
+        d0 = h0.replace(hour=0)
+        if d0 < h0:
+            d0 += timedelta(days=1)
+
+    counts = {}
+    parts = [
+        ("""
+        SELECT user_id, SUM(cnt) FROM msg_hourly
+        WHERE chat_id=? AND hour>=? AND hour<?
+        GROUP BY user_id
+        """, (chat_id, utc_hour_key(h0), utc_hour_key(d0))),
+        ("""
+        SELECT user_id, SUM(cnt) FROM msg_daily
+        WHERE chat_id=? AND day>=?
+        GROUP BY user_id
+        """, (chat_id, utc_day_key(d0))),
+    ]
+    if since is not None:
+        parts.append(("""
+        SELECT user_id, COUNT(*) FROM msg_log INDEXED BY idx_msg_log_chat_ts
+        WHERE chat_id=? AND ts>=? AND ts<?
+        GROUP BY user_id
+        """, (chat_id, epoch(since), epoch(h0))))
+    for sql, params in parts:
+        for uid, c in db_all(sql, params):
+            counts[uid] = counts.get(uid, 0) + int(c)
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+
+# =======================
+# USER DISPLAY CACHE
+# =======================
+# (chat_id, user_id) -> отображаемое имя, LRU на USER_DISPLAY_CACHE записей.
+# В user_cache пишем только когда имя реально поменялось, и не сразу: изменения
+# копятся в _user_display_dirty и уходят в той же транзакции, что и ingest-буфер.
+# Кэш трогают и писатель, и читатели, поэтому всё под _user_display_lock.
+USER_DISPLAY_CACHE = int(os.getenv("USER_DISPLAY_CACHE", "20000"))
+
+_user_display: OrderedDict[tuple[int, int], str] = OrderedDict()
+_user_display_dirty: dict[tuple[int, int], tuple[str, int]] = {}
+_user_display_lock = threading.Lock()
+
+USER_DISPLAY_UPSERT = """
+INSERT INTO user_cache(chat_id, user_id, display, updated_at)
+VALUES(?, ?, ?, ?)
+ON CONFLICT(chat_id, user_id) DO UPDATE SET
+  display=excluded.display,
+  updated_at=excluded.updated_at
+"""
+
+def _user_display_get(key: tuple[int, int]) -> str | None:
+    # под локом
+    pending = _user_display_dirty.get(key)
+    if pending:
+        return pending[0]
+    name = _user_display.get(key)
+    if name is not None:
+        _user_display.move_to_end(key)
+    return name
+
+def _user_display_put(key: tuple[int, int], name: str, loaded: bool = False):
+    # под локом; loaded=True — значение прочитано из БД и не должно затирать свежее
+    if loaded and (key in _user_display or key in _user_display_dirty):
+        return
+    _user_display[key] = name
+    _user_display.move_to_end(key)
+    if len(_user_display) > USER_DISPLAY_CACHE:
+        _user_display.popitem(last=False)
 
 def upsert_user_display(chat_id: int, user_id: int, display: str, ts: datetime):
     display = (display or "").strip() or f"id:{user_id}"
-    db_exec("""
-    INSERT INTO user_cache(chat_id, user_id, display, updated_at)
-    VALUES(?, ?, ?, ?)
-    ON CONFLICT(chat_id, user_id) DO UPDATE SET
-      display=excluded.display,
-      updated_at=excluded.updated_at
-    """, (chat_id, user_id, display, ts.isoformat()))
+    key = (chat_id, user_id)
+    with _user_display_lock:
+        cur = _user_display_get(key)
+    if cur is None:
+        row = db_one("SELECT display FROM user_cache WHERE chat_id=? AND user_id=?", key)
+        cur = row[0] if row else None
+    with _user_display_lock:
+        _user_display_put(key, display)
+        if cur != display:
+            _user_display_dirty[key] = (display, epoch(ts))
+
+def user_display_take() -> list[tuple]:
+    global _user_display_dirty
+    with _user_display_lock:
+        dirty, _user_display_dirty = _user_display_dirty, {}
+    return [(chat_id, user_id, d, ts) for (chat_id, user_id), (d, ts) in dirty.items()]
+
+def user_display_restore(rows: list[tuple]):
+    # запись не удалась — вернём, если за это время имя не сменилось ещё раз
+    with _user_display_lock:
+        for chat_id, user_id, d, ts in rows:
+            _user_display_dirty.setdefault((chat_id, user_id), (d, ts))
+
+def get_user_displays(chat_id: int, user_ids) -> dict[int, str]:
+    out = {}
+    missing = []
+    with _user_display_lock:
+        for uid in dict.fromkeys(int(u) for u in user_ids):
+            name = _user_display_get((chat_id, uid))
+            if name is None:
+                missing.append(uid)
+            else:
+                out[uid] = name
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        rows = db_all(
+            f"SELECT user_id, display FROM user_cache WHERE chat_id=? AND user_id IN ({','.join('?' * len(chunk))})",
+            (chat_id, *chunk),
+        )
+        with _user_display_lock:
+            for uid, name in rows:
+                out[int(uid)] = name
+                _user_display_put((chat_id, int(uid)), name, loaded=True)
+    for uid in missing:
+        out.setdefault(uid, f"id:{uid}")
+    return out
 
 def get_user_display(chat_id: int, user_id: int) -> str:
-    row = db_one("SELECT display FROM user_cache WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    return row[0] if row else f"id:{user_id}"
+    return get_user_displays(chat_id, (user_id,))[int(user_id)]
 
 def find_user_id_by_username(chat_id: int, username: str) -> int | None:
-    row = db_one("SELECT user_id FROM user_cache WHERE chat_id=? AND display=?", (chat_id, f"@{username}"))
+    display = f"@{username}"
+    with _user_display_lock:
+        for (c, uid), (d, _ts) in _user_display_dirty.items():
+            if c == chat_id and d == display:
+                return uid
+    row = db_one("SELECT user_id FROM user_cache WHERE chat_id=? AND display=?", (chat_id, display))
     return int(row[0]) if row else None
 
-
 # =======================
 # REPUTATION
 # =======================
@@ -601,17 +1950,14 @@ def rep_can_vote(chat_id: int, from_id: int, to_id: int, now: datetime, cooldown
     row = db_one("""
     SELECT ts FROM rep_votes WHERE chat_id=? AND from_user_id=? AND to_user_id=?
     """, (chat_id, from_id, to_id))
-    if not row:
-        return True
-    last = datetime.fromisoformat(row[0])
-    return (now - last) >= timedelta(minutes=cooldown_min)
+    return not row or epoch(now) - row[0] >= cooldown_min * 60
 
 def rep_mark_vote(chat_id: int, from_id: int, to_id: int, now: datetime):
     db_exec("""
     INSERT INTO rep_votes(chat_id, from_user_id, to_user_id, ts)
     VALUES(?, ?, ?, ?)
     ON CONFLICT(chat_id, from_user_id, to_user_id) DO UPDATE SET ts=excluded.ts
-    """, (chat_id, from_id, to_id, now.isoformat()))
+    """, (chat_id, from_id, to_id, epoch(now)))
 
 # =======================
 # TOKENS WALLET
@@ -632,17 +1978,129 @@ def wallet_add(chat_id: int, user_id: int, delta: int):
     """, (chat_id, user_id, delta, delta))
 
 def wallet_set(chat_id: int, user_id: int, value: int):
-    value = max(0, int(value))
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"negative balance {value} for chat={chat_id} user={user_id}")
     db_exec("""
     INSERT INTO wallet(chat_id, user_id, balance) VALUES(?, ?, ?)
     ON CONFLICT(chat_id, user_id) DO UPDATE SET balance = excluded.balance
     """, (chat_id, user_id, value))
 
-def tx_log(chat_id: int, ts: datetime, from_uid: int | None, to_uid: int | None, amount: int, kind: str, meta: str | None = None):
-    db_exec(
-        "INSERT INTO token_tx(chat_id, ts, from_user_id, to_user_id, amount, kind, meta) VALUES(?, ?, ?, ?, ?, ?, ?)",
-        (chat_id, ts.isoformat(), from_uid, to_uid, int(amount), kind, meta),
+# виды проводок: token_ledger.kind — индекс в TX_KINDS (новые — только в конец)
+TX_KINDS = (
+    None, "pay", "buy", "slot_bet", "slot_win", "daily",
+    "duel_bet_lock", "duel_bet_refund", "duel_bet_payout",
+    "adjust",  # поправка сверки (см. LEDGER RECONCILIATION)
+)
+TX_KIND = {name: i for i, name in enumerate(TX_KINDS) if name}
+
+def tx_log(chat_id: int, ts: datetime, from_uid: int | None, to_uid: int | None, amount: int, kind: str, *,
+           duel_id: str | None = None, item: str | None = None, mode: str | None = None,
+           mult: float | None = None, fee: int = 0, treasury: int = 0, jackpot: int = 0,
+           meta: str | None = None):
+    """
+    Проводка: from теряет amount + fee, to получает amount, пулы меняются на
+    treasury/jackpot. По этим правилам сверка пересчитывает балансы.
+    """
+    k = TX_KIND[kind]
+    amount = int(amount)
+    con = db_conn()
+    con.execute("""
+    INSERT INTO token_ledger(chat_id, ts, kind, from_user_id, to_user_id, amount, duel_id, item, mode, mult,
+                             fee, treasury, jackpot, meta)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (chat_id, epoch(ts), k, from_uid, to_uid, amount, duel_id, item, mode, mult,
+          int(fee), int(treasury), int(jackpot), meta))
+    for uid, spent, earned in ((from_uid, amount, 0), (to_uid, 0, amount)):
+        if uid is not None:
+            con.execute("""
+            INSERT INTO token_totals(chat_id, user_id, kind, spent, earned) VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id, kind) DO UPDATE SET
+              spent = spent + excluded.spent,
+              earned = earned + excluded.earned
+            """, (chat_id, uid, k, spent, earned))
+
+def token_totals_get(chat_id: int, user_id: int, kind: str) -> tuple[int, int]:
+    """-> (spent, earned) юзера по виду проводок."""
+    row = db_one(
+        "SELECT spent, earned FROM token_totals WHERE chat_id=? AND user_id=? AND kind=?",
+        (chat_id, user_id, TX_KIND[kind]),
     )
+    return (int(row[0]), int(row[1])) if row else (0, 0)
+
+def ledger_backfill_pools(cur, first_id: int = 0):
+    """
+    Проставить fee/treasury/jackpot старым проводкам (id >= first_id). Скимы
+    слотов — по текущим JACKPOT_PCT/TREASURY_PCT (в старых строках их не
+    писали); джекпот — это slot_win с mult=0.
+    """
+    cur.execute("""
+    UPDATE token_ledger SET fee = CAST(substr(meta, 5) AS INTEGER), treasury = CAST(substr(meta, 5) AS INTEGER), meta = NULL
+    WHERE kind=? AND id >= ? AND meta LIKE 'fee=%' AND meta NOT LIKE '%,%'
+    """, (TX_KIND["pay"], first_id))
+    cur.execute("UPDATE token_ledger SET treasury = amount WHERE kind=? AND id >= ?", (TX_KIND["buy"], first_id))
+    cur.execute("UPDATE token_ledger SET treasury = amount * ? / 100, jackpot = amount * ? / 100 WHERE kind=? AND id >= ?",
+                (TREASURY_PCT, JACKPOT_PCT, TX_KIND["slot_bet"], first_id))
+    cur.execute("UPDATE token_ledger SET jackpot = -amount WHERE kind=? AND mult = 0 AND id >= ?",
+                (TX_KIND["slot_win"], first_id))
+
+def ledger_pool_columns(cur):
+    """Миграция 3: fee/treasury/jackpot в журнале, созданном до них."""
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(token_ledger)")}
+    new_cols = [c for c in ("fee", "treasury", "jackpot") if c not in cols]
+    for c in new_cols:
+        cur.execute(f"ALTER TABLE token_ledger ADD COLUMN {c} INTEGER NOT NULL DEFAULT 0")
+    if new_cols:
+        ledger_backfill_pools(cur)
+
+def ledger_tx_backfill(batch: int) -> int:
+    """
+    Миграция 2: пачка старого token_tx -> token_ledger (+ token_totals), от
+    старых к новым; перенесённое удаляем, так что прерванный перенос
+    продолжается с того же места. -> сколько строк; 0 — готово, token_tx удалена.
+    """
+    with db_tx() as con:
+        if not db_table_exists("token_tx"):
+            return 0
+        rows = con.execute(
+            "SELECT rowid, chat_id, ts, from_user_id, to_user_id, amount, kind, meta FROM token_tx ORDER BY rowid LIMIT ?",
+            (batch,),
+        ).fetchall()
+        if not rows:
+            con.execute("DROP TABLE token_tx")
+            return 0
+        first = con.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM token_ledger").fetchone()[0]
+        con.executemany("""
+        INSERT INTO token_ledger(chat_id, ts, kind, from_user_id, to_user_id, amount, duel_id, item, mode, mult, meta)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (_tx_legacy_row(*r[1:]) for r in rows))
+        ledger_backfill_pools(con, first)
+        con.execute("""
+        INSERT INTO token_totals(chat_id, user_id, kind, spent, earned)
+        SELECT chat_id, user_id, kind, SUM(spent), SUM(earned) FROM (
+            SELECT chat_id, from_user_id AS user_id, kind, amount AS spent, 0 AS earned
+            FROM token_ledger WHERE id >= ? AND from_user_id IS NOT NULL
+            UNION ALL
+            SELECT chat_id, to_user_id, kind, 0, amount
+            FROM token_ledger WHERE id >= ? AND to_user_id IS NOT NULL
+        ) GROUP BY 1, 2, 3
+        ON CONFLICT(chat_id, user_id, kind) DO UPDATE SET
+          spent = spent + excluded.spent,
+          earned = earned + excluded.earned
+        """, (first, first))
+        con.execute("DELETE FROM token_tx WHERE rowid <= ?", (rows[-1][0],))
+        return len(rows)
+
+def _tx_legacy_row(chat_id, ts, from_uid, to_uid, amount, kind, meta) -> tuple:
+    # строка старого token_tx: meta вида "duel_id=...,bet=..." -> колонки token_ledger
+    fields = dict(p.split("=", 1) for p in (meta or "").split(",") if "=" in p)
+    duel_id = fields.pop("duel_id", None)
+    item = fields.pop("item", None)
+    mode = fields.pop("mode", None)
+    mult = fields.pop("mult", None)
+    rest = ",".join(f"{k}={v}" for k, v in fields.items()) or None
+    return (chat_id, epoch(datetime.fromisoformat(ts)), TX_KIND.get(kind, 0), from_uid, to_uid, amount,
+            duel_id, item, mode, float(mult) if mult is not None else None, rest)
 
 def pool_get(chat_id: int, table: str) -> int:
     row = db_one(f"SELECT amount FROM {table} WHERE chat_id=?", (chat_id,))
@@ -654,25 +2112,110 @@ def pool_add(chat_id: int, table: str, delta: int):
     ON CONFLICT(chat_id) DO UPDATE SET amount = amount + ?
     """, (chat_id, int(delta), int(delta)))
 
-def econ_snapshot(chat_id: int) -> dict:
-    total_wallet = db_one("SELECT COALESCE(SUM(balance),0) FROM wallet WHERE chat_id=?", (chat_id,))
-    total_wallet = int(total_wallet[0]) if total_wallet else 0
+# econ_agg: UPSERT в wallet срабатывает как INSERT или как UPDATE — триггеры
+# ловят оба случая; голые INSERT/UPDATE/DELETE (миграции, сверка) — тоже.
+ECON_AGG_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_econ_wallet_ins AFTER INSERT ON wallet BEGIN
+        INSERT INTO econ_agg(chat_id, total_wallet, holders) VALUES(NEW.chat_id, NEW.balance, NEW.balance > 0)
+        ON CONFLICT(chat_id) DO UPDATE SET total_wallet = total_wallet + excluded.total_wallet,
+                                           holders = holders + excluded.holders;
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_econ_wallet_upd AFTER UPDATE OF balance ON wallet
+    WHEN NEW.balance != OLD.balance BEGIN
+        UPDATE econ_agg SET total_wallet = total_wallet + NEW.balance - OLD.balance,
+                            holders = holders + (NEW.balance > 0) - (OLD.balance > 0)
+        WHERE chat_id = NEW.chat_id;
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_econ_wallet_del AFTER DELETE ON wallet BEGIN
+        UPDATE econ_agg SET total_wallet = total_wallet - OLD.balance, holders = holders - (OLD.balance > 0)
+        WHERE chat_id = OLD.chat_id;
+    END""",
+) + tuple(
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_econ_{table}_{ev.split()[0].lower()} AFTER {ev} ON {table} BEGIN
+        INSERT INTO econ_agg(chat_id, {col}) VALUES({row}.chat_id, {val})
+        ON CONFLICT(chat_id) DO UPDATE SET {col} = excluded.{col};
+    END"""
+    for table, col in (("treasury", "treasury"), ("jackpot_pool", "jackpot"))
+    for ev, row, val in (("INSERT", "NEW", "NEW.amount"), ("UPDATE OF amount", "NEW", "NEW.amount"),
+                         ("DELETE", "OLD", "0"))
+)
 
-    holders = db_one("SELECT COUNT(*) FROM wallet WHERE chat_id=? AND balance>0", (chat_id,))
-    holders = int(holders[0]) if holders else 0
+ECON_AGG_RECOMPUTE = """
+SELECT chat_id, SUM(total_wallet), SUM(holders), SUM(treasury), SUM(jackpot) FROM (
+    SELECT chat_id, SUM(balance) AS total_wallet, SUM(balance > 0) AS holders, 0 AS treasury, 0 AS jackpot
+    FROM wallet GROUP BY chat_id
+    UNION ALL SELECT chat_id, 0, 0, amount, 0 FROM treasury
+    UNION ALL SELECT chat_id, 0, 0, 0, amount FROM jackpot_pool
+)
+"""
 
-    treasury = pool_get(chat_id, "treasury")
-    jackpot = pool_get(chat_id, "jackpot_pool")
+def econ_agg_create(cur):
+    """Миграция 4: econ_agg + триггеры; на базе с кошельками — сразу полный пересчёт."""
+    had_agg = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='econ_agg'").fetchone()
+    # денежная масса чата: ведут триггеры на wallet/treasury/jackpot_pool в той же
+    # транзакции, что и само изменение, так что /econ и /balance — одна строка
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS econ_agg (
+        chat_id INTEGER PRIMARY KEY,
+        total_wallet INTEGER NOT NULL DEFAULT 0,
+        holders INTEGER NOT NULL DEFAULT 0,   -- у кого balance > 0
+        treasury INTEGER NOT NULL DEFAULT 0,
+        jackpot INTEGER NOT NULL DEFAULT 0
+    )""")
+    for sql in ECON_AGG_TRIGGERS:
+        cur.execute(sql)
+    if not had_agg:
+        econ_agg_rebuild(cur)
+
+def econ_agg_rebuild(cur, chat_id: int | None = None):
+    """Пересчитать econ_agg с нуля (весь или один чат)."""
+    where = "" if chat_id is None else " WHERE chat_id=?"
+    args = () if chat_id is None else (chat_id,)
+    cur.execute("DELETE FROM econ_agg" + where, args)
+    cur.execute(f"""
+    INSERT INTO econ_agg(chat_id, total_wallet, holders, treasury, jackpot)
+    {ECON_AGG_RECOMPUTE}{where} GROUP BY chat_id
+    """, args)
+
+def econ_agg_check(con: sqlite3.Connection | None = None) -> list[tuple]:
+    """
+    Инвариант: econ_agg == полный пересчёт.
+    -> [(chat_id, (total_wallet, holders, treasury, jackpot) в econ_agg, то же пересчётом)], пусто — всё сходится.
+    """
+    con = con or db_conn()
+    want = {r[0]: tuple(int(x) for x in r[1:]) for r in con.execute(ECON_AGG_RECOMPUTE + " GROUP BY chat_id")}
+    have = {r[0]: tuple(r[1:]) for r in con.execute(
+        "SELECT chat_id, total_wallet, holders, treasury, jackpot FROM econ_agg")}
+    zero = (0, 0, 0, 0)
+    return [(c, have.get(c, zero), want.get(c, zero)) for c in sorted(want.keys() | have.keys())
+            if have.get(c, zero) != want.get(c, zero)]
 
+def econ_snapshot(chat_id: int) -> dict:
+    row = db_one("SELECT total_wallet, holders, treasury, jackpot FROM econ_agg WHERE chat_id=?", (chat_id,))
+    total_wallet, holders, treasury, jackpot = row or (0, 0, 0, 0)
     return {
-        "total_wallet": total_wallet,
-        "holders": holders,
+        "total_wallet": int(total_wallet),
+        "holders": int(holders),
         "treasury": int(treasury),
         "jackpot": int(jackpot),
     }
 
+def econ_balance(chat_id: int, user_id: int) -> tuple[int, int]:
+    """-> (баланс, джекпот) одним запросом."""
+    row = db_one("""
+    SELECT (SELECT balance FROM wallet WHERE chat_id=? AND user_id=?),
+           (SELECT jackpot FROM econ_agg WHERE chat_id=?)
+    """, (chat_id, user_id, chat_id))
+    return int(row[0] or 0), int(row[1] or 0)
+
 def pool_set(chat_id: int, table: str, value: int):
-    value = max(0, int(value))
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"negative {table} {value} for chat={chat_id}")
     db_exec(f"""
     INSERT INTO {table}(chat_id, amount) VALUES(?, ?)
     ON CONFLICT(chat_id) DO UPDATE SET amount = excluded.amount
@@ -680,17 +2223,14 @@ def pool_set(chat_id: int, table: str, value: int):
 
 def slot_can_spin(chat_id: int, user_id: int, now: datetime) -> bool:
     row = db_one("SELECT ts FROM slot_cooldown WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    if not row:
-        return True
-    last = datetime.fromisoformat(row[0])
-    return (now - last) >= timedelta(minutes=SLOT_COOLDOWN_MIN)
+    return not row or epoch(now) - row[0] >= SLOT_COOLDOWN_MIN * 60
 
 def slot_mark_spin(chat_id: int, user_id: int, now: datetime):
     db_exec("""
     INSERT INTO slot_cooldown(chat_id, user_id, ts)
     VALUES(?, ?, ?)
     ON CONFLICT(chat_id, user_id) DO UPDATE SET ts=excluded.ts
-    """, (chat_id, user_id, now.isoformat()))
+    """, (chat_id, user_id, epoch(now)))
 
 def daily_claimed(chat_id: int, user_id: int, day: str) -> bool:
     row = db_one(
@@ -718,7 +2258,7 @@ def daily_streak_set(chat_id: int, user_id: int, last_claim_at: datetime, streak
     ON CONFLICT(chat_id, user_id) DO UPDATE SET
       last_claim_at=excluded.last_claim_at,
       streak=excluded.streak
-    """, (chat_id, user_id, last_claim_at.isoformat(), int(streak)))
+    """, (chat_id, user_id, epoch(last_claim_at), int(streak)))
 
 def duel_bet_create(chat_id: int, duel_id: str, bet: int):
     db_exec(
@@ -746,26 +2286,24 @@ def duel_mark_loss(chat_id: int, duel_id: str, loser_id: int, now: datetime):
     stats_inc(chat_id, loser_id, "duel_losses", 1, now)
 
 def duel_bet_payout(chat_id: int, duel_id: str, winner_id: int, now: datetime):
-    row = duel_bet_get(duel_id)
-    if not row:
-        return 0
-    _chat, bet, a_paid, b_paid = row
-    bet = int(bet)
-    if bet <= 0:
+    with db_tx(immediate=True):
+        row = duel_bet_get(duel_id)
+        if not row:
+            return 0
+        _chat, bet, a_paid, b_paid = row
+        bet = int(bet)
         duel_bet_delete(duel_id)
-        return 0
+        if bet <= 0:
+            return 0
 
-    bank = bet * 2
-    wallet_add(chat_id, winner_id, bank)
+        bank = bet * 2
+        wallet_add(chat_id, winner_id, bank)
 
-    # победителю начислили банк — это "выигрыш общий"
-    stats_inc(chat_id, winner_id, "tokens_earned", bank, now)
-    stats_inc(chat_id, winner_id, "duel_bank_won", bank, now)
-    stats_inc(chat_id, winner_id, "duel_wins", 1, now)
+        # победителю начислили банк — это "выигрыш общий"
+        stats_inc_many(chat_id, winner_id, {"tokens_earned": bank, "duel_bank_won": bank, "duel_wins": 1}, now)
 
-    tx_log(chat_id, now, None, winner_id, bank, "duel_bet_payout", meta=f"duel_id={duel_id},bet={bet}")
-    duel_bet_delete(duel_id)
-    return bank
+        tx_log(chat_id, now, None, winner_id, bank, "duel_bet_payout", duel_id=duel_id)
+        return bank
 
 # =======================
 # SLOTS (TOKENS) — режимы риска + джекпот
@@ -774,8 +2312,14 @@ def duel_bet_payout(chat_id: int, duel_id: str, winner_id: int, now: datetime):
 JACKPOT_PCT = 8   # % в джекпот
 TREASURY_PCT = 2  # % в казну
 
+# границы для таблиц: EV множителя (с учётом шанса джекпота) и самый жирный
+# множитель. Таблица, вышедшая за них, валит старт — см. slot_tables_check
+SLOT_EV_MIN = float(os.getenv("SLOT_EV_MIN", "0.95"))
+SLOT_EV_MAX = float(os.getenv("SLOT_EV_MAX", "1.20"))
+SLOT_MAX_MULT = float(os.getenv("SLOT_MAX_MULT", "1000"))
+
+# EV, дисперсию и доли считает slot_table_stats, руками их тут не пишем
 SLOT_TABLES = {
-    # EV ≈ 1.0115 (+1.15%), x1 = 2.80%
     "low": [
         (0.0, 2100),
         (0.2, 900),
@@ -794,7 +2338,6 @@ SLOT_TABLES = {
         (100.0, 1),     # 0.01%
     ],
 
-    # EV ≈ 1.0293 (+2.93%), x1 = 1.80%
     "mid": [
         (0.0, 2200),
         (0.2, 800),
@@ -832,7 +2375,6 @@ SLOT_TABLES = {
         (250.0, 1),     # 0.01%
         (500.0, 1),     # 0.01%
         (1000.0, 1),     # 0.01%
-        (10000000.0, 1),     # 0.01%
     ],
 }
 
@@ -842,15 +2384,91 @@ JACKPOT_CHANCE = {  # шанс “сорвать банк”
     "high": 0.005,
 }
 
-def weighted_choice(pairs):
+class SlotSampler:
+    """
+    Alias-метод (Vose) на целых весах: спин — один randrange и одно сравнение,
+    распределение совпадает с весами таблицы точно, без float-погрешности.
+    Корзина i берёт свой множитель при u < cut[i] (u из [0, total)),
+    иначе — множитель alias[i].
+    """
+    __slots__ = ("vals", "total", "cut", "alias")
+
+    def __init__(self, pairs):
+        self.vals = [float(v) for v, _ in pairs]
+        weights = [int(w) for _, w in pairs]
+        n = len(weights)
+        self.total = sum(weights)
+        if n == 0 or self.total <= 0 or min(weights) < 0:
+            raise ValueError("slot table needs non-negative weights with a positive sum")
+
+        # вес * n против total: меньше — корзину добивает alias, больше — донор
+        scaled = [w * n for w in weights]
+        self.cut = [self.total] * n
+        self.alias = list(range(n))
+        small = [i for i in range(n) if scaled[i] < self.total]
+        large = [i for i in range(n) if scaled[i] >= self.total]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.cut[s], self.alias[s] = scaled[s], l
+            scaled[l] -= self.total - scaled[s]
+            (small if scaled[l] < self.total else large).append(l)
+
+        # проверка точности: масса каждого множителя == вес * n
+        mass = [0] * n
+        for i in range(n):
+            mass[i] += self.cut[i]
+            mass[self.alias[i]] += self.total - self.cut[i]
+        if mass != [w * n for w in weights]:
+            raise ValueError("alias table does not reproduce slot weights")
+
+    def sample(self) -> float:
+        i, u = divmod(random.randrange(len(self.vals) * self.total), self.total)
+        return self.vals[i] if u < self.cut[i] else self.vals[self.alias[i]]
+
+SLOT_SAMPLERS = {mode: SlotSampler(pairs) for mode, pairs in SLOT_TABLES.items()}
+
+def slot_table_stats(mode: str) -> dict:
+    """
+    Точные числа режима на единицу ставки (без округления выплат до целых):
+    ev/var/sd — множитель спина, джекпотный спин идёт как x0;
+    hit — хоть что-то вернулось, profit — больше ставки, x1 — ровно ставка;
+    rtp — ev + доля в джекпот (в долгую банк целиком уходит игрокам);
+    mint — сколько токенов спин создаёт: выплата + скимы − ставка.
+    """
+    pairs = SLOT_TABLES[mode]
+    jc = JACKPOT_CHANCE[mode]
     total = sum(w for _, w in pairs)
-    r = random.randint(1, total)
-    s = 0
-    for val, w in pairs:
-        s += w
-        if r <= s:
-            return val
-    return pairs[-1][0]
+    probs = [(float(v), (1.0 - jc) * w / total) for v, w in pairs]
+    ev = sum(v * p for v, p in probs)
+    var = sum(v * v * p for v, p in probs) - ev * ev
+    return {
+        "ev": ev,
+        "var": var,
+        "sd": var ** 0.5,
+        "hit": sum(p for v, p in probs if v > 0),
+        "profit": sum(p for v, p in probs if v > 1),
+        "x1": sum(p for v, p in probs if v == 1),
+        "jackpot": jc,
+        "max_mult": max(v for v, _ in probs),
+        "rtp": ev + JACKPOT_PCT / 100,
+        "mint": ev - 1 + (JACKPOT_PCT + TREASURY_PCT) / 100,
+    }
+
+def slot_tables_check() -> dict:
+    """Считает статистику всех режимов; таблица вне SLOT_EV_*/SLOT_MAX_MULT — RuntimeError."""
+    stats, bad = {}, []
+    for mode in SLOT_TABLES:
+        if mode not in JACKPOT_CHANCE:
+            bad.append(f"{mode}: no JACKPOT_CHANCE")
+            continue
+        st = stats[mode] = slot_table_stats(mode)
+        if not SLOT_EV_MIN <= st["ev"] <= SLOT_EV_MAX:
+            bad.append(f"{mode}: EV {st['ev']:.4f} outside [{SLOT_EV_MIN}, {SLOT_EV_MAX}]")
+        if st["max_mult"] > SLOT_MAX_MULT:
+            bad.append(f"{mode}: x{st['max_mult']:g} above SLOT_MAX_MULT={SLOT_MAX_MULT:g}")
+    if bad:
+        raise RuntimeError("slot tables out of bounds: " + "; ".join(bad))
+    return stats
 
 def parse_slot_args(args: str | None) -> tuple[str, int] | None:
     """
@@ -890,7 +2508,7 @@ def slot_spin(mode: str) -> tuple[str, float, bool]:
     if random.random() < JACKPOT_CHANCE[mode]:
         return "👑 | 👑 | 👑", 0.0, True
 
-    mult = float(weighted_choice(SLOT_TABLES[mode]))
+    mult = SLOT_SAMPLERS[mode].sample()
     # просто визуал, не влияет на математику
     if mult >= 8:
         line = "💎 | 💎 | 💎"
@@ -908,50 +2526,454 @@ def slot_spin(mode: str) -> tuple[str, float, bool]:
     return line, mult, False
 
 # =======================
-# SAFE EDIT (ANTI FLOOD)
+# ECONOMY (атомарные операции)
 # =======================
-_last_edit_at = {}
-_last_edit_text = {}
+# Каждая операция экономики — одна транзакция BEGIN IMMEDIATE: списание,
+# скимы в пулы, статистика, tx_log и кулдауны коммитятся вместе или никак.
+# Хватает ли денег, решает сам UPDATE (balance >= ?), а не чтение перед ним.
+# Все econ_* зовутся в потоке-писателе и возвращают (alert, None) при
+# отказе, иначе (None, результат).
+
+def wallet_debit(chat_id: int, user_id: int, amount: int) -> bool:
+    """Списать amount, если хватает. False — баланс не тронут."""
+    cur = db_conn().execute(
+        "UPDATE wallet SET balance = balance - ? WHERE chat_id=? AND user_id=? AND balance >= ?",
+        (int(amount), chat_id, user_id, int(amount)),
+    )
+    return cur.rowcount == 1
+
+def pool_take(chat_id: int, table: str) -> int:
+    """Забрать весь пул (джекпот). Только внутри транзакции."""
+    amount = pool_get(chat_id, table)
+    if amount:
+        pool_set(chat_id, table, 0)
+    return amount
+
+def econ_slot(chat_id: int, uid: int, mode: str, bet: int, now: datetime):
+    """-> (None, {line, mult, jackpot_hit, win, balance, jackpot})"""
+    with db_tx(immediate=True):
+        if not slot_can_spin(chat_id, uid, now):
+            row = db_one("SELECT ts FROM slot_cooldown WHERE chat_id=? AND user_id=?", (chat_id, uid))
+            last = from_epoch(row[0]) if row else now
+            left = (last + timedelta(minutes=SLOT_COOLDOWN_MIN)) - now
+            mins = max(0, int(left.total_seconds() // 60))
+            secs = max(0, int(left.total_seconds() % 60))
+            return f"⏳ Слот на кд. Осталось ~{mins}m {secs}s.", None
+
+        if not wallet_debit(chat_id, uid, bet):
+            return f"Не хватает tokens. Ставка {bet}, у тебя {wallet_get(chat_id, uid)}.", None
+
+        # распределили проценты
+        jp_add = (bet * JACKPOT_PCT) // 100
+        tr_add = (bet * TREASURY_PCT) // 100
+        pool_add(chat_id, "jackpot_pool", +jp_add)
+        pool_add(chat_id, "treasury", +tr_add)
+
+        line, mult, jackpot_hit = slot_spin(mode)
+        # джекпот забираем в той же транзакции, что и ставку
+        win = pool_take(chat_id, "jackpot_pool") if jackpot_hit else int(round(bet * mult))
+
+        deltas = {"tokens_spent": bet, "slot_spent": bet}
+        if win > 0:
+            wallet_add(chat_id, uid, +win)
+            deltas.update(tokens_earned=win, slot_won=win)
+        stats_inc_many(chat_id, uid, deltas, now)
+
+        slot_mark_spin(chat_id, uid, now)
+        tx_log(chat_id, now, uid, None, bet, "slot_bet", mode=mode, treasury=tr_add, jackpot=jp_add)
+        if win > 0:
+            tx_log(chat_id, now, None, uid, win, "slot_win", mode=mode, mult=mult,
+                   jackpot=-win if jackpot_hit else 0)
+
+        return None, {
+            "line": line,
+            "mult": mult,
+            "jackpot_hit": jackpot_hit,
+            "win": win,
+            "balance": wallet_get(chat_id, uid),
+            "jackpot": pool_get(chat_id, "jackpot_pool"),
+        }
 
-async def safe_edit_text(msg: Message, text: str, reply_markup=None, *, min_interval=1.2):
-    if msg is None:
-        return
+def econ_pay(chat_id: int, from_uid: int, to_uid: int, amount: int, fee: int, now: datetime):
+    with db_tx(immediate=True):
+        total = amount + fee
+        if not wallet_debit(chat_id, from_uid, total):
+            bal = wallet_get(chat_id, from_uid)
+            return f"Не хватает tokens. Нужно {total} (включая комиссию {fee}). У тебя {bal}.", None
 
-    now = datetime.utcnow()
-    key = (msg.chat.id, msg.message_id)
+        wallet_add(chat_id, to_uid, +amount)
+        pool_add(chat_id, "treasury", +fee)
+        tx_log(chat_id, now, from_uid, to_uid, amount, "pay", fee=fee, treasury=fee)
+        return None, None
 
-    if _last_edit_text.get(key) == text:
-        return
+def econ_buy(chat_id: int, uid: int, item: str, now: datetime):
+    """-> (None, title или None для расходника)"""
+    it = SHOP_ITEMS[item]
+    price = int(it["price"])
+    with db_tx(immediate=True):
+        if not wallet_debit(chat_id, uid, price):
+            return f"Не хватает tokens. Нужно {price}, у тебя {wallet_get(chat_id, uid)}.", None
+
+        stats_inc(chat_id, uid, "tokens_spent", price, now)
+        pool_add(chat_id, "treasury", +price)
+        tx_log(chat_id, now, uid, None, price, "buy", item=item, treasury=price)
+
+        if it["type"] == "title":
+            db_exec("""
+            INSERT INTO user_profile(chat_id, user_id, title) VALUES(?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET title=excluded.title
+            """, (chat_id, uid, it["value"]))
+            return None, it["value"]
+        inv_add(chat_id, uid, item, 1)
+        return None, None
 
-    last_at = _last_edit_at.get(key)
-    if last_at and (now - last_at).total_seconds() < min_interval:
-        return
+def econ_daily(chat_id: int, uid: int, now: datetime):
+    """-> (None, {amount, base, bonus, streak_bonus, streak, balance})"""
+    day = date_key(now)
+    with db_tx(immediate=True):
+        # отметка дня — и есть проверка: вторая вставка за день ничего не вставит
+        cur = db_conn().execute(
+            "INSERT OR IGNORE INTO daily_claim(chat_id, user_id, day) VALUES(?, ?, ?)",
+            (chat_id, uid, day),
+        )
+        if cur.rowcount != 1:
+            return "⏳ Ты уже забирал daily сегодня.", None
 
-    try:
-        await msg.edit_text(text, reply_markup=reply_markup)
-        _last_edit_at[key] = now
-        _last_edit_text[key] = text
-    except Exception:
-        # не шумим, Telegram/aiogram сам иногда ругается на слишком частые edits
-        pass
+        # --- streak ---
+        row = daily_streak_get(chat_id, uid)
+        last = from_epoch(row[0], now.tzinfo) if row and row[0] is not None else None
+        streak = int(row[1]) if row else 0
 
+        yesterday = (now - timedelta(days=1)).date().isoformat()
+        if last and last.date().isoformat() == yesterday:
+            streak += 1
+        else:
+            streak = 1
 
-# =======================
-# LUCK / SLOTS
-# =======================
-def luck_can_spin(chat_id: int, user_id: int, now: datetime) -> bool:
-    row = db_one("SELECT ts FROM luck_cooldown WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    if not row:
+        # базовый дроп
+        base = random.randint(25, 50)
+
+        # бонус за активность за 24ч: +0..+10
+        since = now - timedelta(hours=24)
+        row2 = db_one(
+            "SELECT COUNT(*) FROM msg_log WHERE chat_id=? AND user_id=? AND ts>=?",
+            (chat_id, uid, epoch(since)),
+        )
+        c = int(row2[0]) if row2 else 0
+        bonus = min(10, c // 5)
+
+        # бонус за стрик
+        streak_bonus = min(20, (streak - 1) * 2)
+
+        amount = base + bonus + streak_bonus
+
+        wallet_add(chat_id, uid, amount)
+        stats_inc(chat_id, uid, "tokens_earned", amount, now)
+        daily_streak_set(chat_id, uid, now, streak)
+        tx_log(chat_id, now, None, uid, amount, "daily", meta=f"base={base},bonus={bonus},streak={streak},msg24h={c}")
+
+        return None, {
+            "amount": amount,
+            "base": base,
+            "bonus": bonus,
+            "streak_bonus": streak_bonus,
+            "streak": streak,
+            "balance": wallet_get(chat_id, uid),
+        }
+
+def econ_duel_lock(chat_id: int, duel_id: str, uid: int, side: str, bet: int, now: datetime) -> bool:
+    """
+    Заблокировать ставку игрока side ("a"/"b") в банк дуэли. False — не хватило.
+    Уже внесённая ставка второй раз не списывается (повторное нажатие "принять").
+    """
+    with db_tx(immediate=True) as con:
+        cur = con.execute(f"UPDATE duel_bets SET {side}_paid=1 WHERE duel_id=? AND {side}_paid=0", (duel_id,))
+        if cur.rowcount != 1:
+            return True
+        if not wallet_debit(chat_id, uid, bet):
+            # db_tx мог присоединиться к внешней транзакции — флаг возвращаем сами
+            con.execute(f"UPDATE duel_bets SET {side}_paid=0 WHERE duel_id=?", (duel_id,))
+            return False
+        tx_log(chat_id, now, uid, None, bet, "duel_bet_lock", duel_id=duel_id)
         return True
-    last = datetime.fromisoformat(row[0])
-    return (now - last) >= timedelta(minutes=LUCK_COOLDOWN_MIN)
+
+def econ_duel_unlock(chat_id: int, duel_id: str, uid: int, side: str, now: datetime, reason: str) -> int:
+    """Вернуть одну внесённую ставку, банк остаётся (дуэль ещё pending). -> сколько вернули."""
+    with db_tx(immediate=True) as con:
+        row = duel_bet_get(duel_id)
+        if not row or int(row[1]) <= 0:
+            return 0
+        bet = int(row[1])
+        cur = con.execute(f"UPDATE duel_bets SET {side}_paid=0 WHERE duel_id=? AND {side}_paid=1", (duel_id,))
+        if cur.rowcount != 1:
+            return 0
+        wallet_add(chat_id, uid, +bet)
+        tx_log(chat_id, now, None, uid, bet, "duel_bet_refund", duel_id=duel_id, meta=f"reason={reason}")
+        return bet
+
+def econ_duel_refund(chat_id: int, duel_id: str, a_id: int, b_id: int, now: datetime,
+                     reason: str | None = None) -> int:
+    """Вернуть обоим внесённые ставки и закрыть банк. -> сколько вернули всего."""
+    with db_tx(immediate=True):
+        row = duel_bet_get(duel_id)
+        if not row:
+            return 0
+        _chat, bet, a_paid, b_paid = row
+        bet = int(bet)
+        duel_bet_delete(duel_id)
+        if bet <= 0:
+            return 0
+        refunded = 0
+        for uid, paid in ((a_id, a_paid), (b_id, b_paid)):
+            if int(paid) != 1:
+                continue
+            wallet_add(chat_id, uid, +bet)
+            tx_log(chat_id, now, None, uid, bet, "duel_bet_refund", duel_id=duel_id,
+                   meta=f"reason={reason}" if reason else None)
+            refunded += bet
+        return refunded
+
+# =======================
+# LEDGER RECONCILIATION
+# =======================
+# Сверка: журнал чата читается кусками по RECONCILE_CHUNK строк (keyset по
+# (ts, id) на idx_ledger_chat_ts), по правилам tx_log из него считаются
+# ожидаемые балансы, казна, джекпот и эскроу ставок дуэлей, и всё это
+# сравнивается с wallet / treasury / jackpot_pool / duel_bets. Память —
+# O(юзеров чата + кусок), от длины журнала не зависит. Чаты идут параллельно
+# в пуле процессов (spawn: у бота живые потоки и соединения, fork их
+# унаследовал бы). Каждый чат читается в одной read-транзакции — снимок
+# согласован даже под живой нагрузкой. Заодно econ_agg сверяется с полным
+# пересчётом по wallet и пулам.
+#
+# Поправки (--fix / RECONCILE_FIX=1) — проводки "adjust": журнал догоняет
+# фактические балансы; econ_agg пересобирается. Считаются заново в потоке-
+# писателе под BEGIN IMMEDIATE, чтобы не писать поправку по устаревшему
+# снимку. Эскроу только репортим.
+#
+# Вручную: python weirdo.py reconcile [--fix]
+RECONCILE_INTERVAL_S = int(os.getenv("RECONCILE_INTERVAL_S", "0"))  # 0 — только вручную
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "4"))
+RECONCILE_CHUNK = int(os.getenv("RECONCILE_CHUNK", "5000"))
+RECONCILE_FIX = os.getenv("RECONCILE_FIX", "0") == "1"
+
+def ledger_replay(con: sqlite3.Connection, chat_id: int, chunk: int = RECONCILE_CHUNK) -> dict:
+    """Ожидаемые балансы/пулы чата по журналу, потоком по chunk строк."""
+    lock, refund, payout = TX_KIND["duel_bet_lock"], TX_KIND["duel_bet_refund"], TX_KIND["duel_bet_payout"]
+    wallets = {}
+    treasury = jackpot = escrow = rows = 0
+    last_ts, last_id = -1, 0
+    while True:
+        batch = con.execute("""
+        SELECT ts, id, kind, from_user_id, to_user_id, amount, fee, treasury, jackpot
+        FROM token_ledger INDEXED BY idx_ledger_chat_ts
+        WHERE chat_id=? AND (ts, id) > (?, ?)
+        ORDER BY ts, id
+        LIMIT ?
+        """, (chat_id, last_ts, last_id, chunk)).fetchall()
+        if not batch:
+            break
+        for _ts, _id, kind, from_uid, to_uid, amount, fee, tr, jp in batch:
+            if from_uid is not None:
+                wallets[from_uid] = wallets.get(from_uid, 0) - amount - fee
+            if to_uid is not None:
+                wallets[to_uid] = wallets.get(to_uid, 0) + amount
+            treasury += tr
+            jackpot += jp
+            if kind == lock:
+                escrow += amount
+            elif kind == refund or kind == payout:
+                escrow -= amount
+        rows += len(batch)
+        last_ts, last_id = batch[-1][0], batch[-1][1]
+    return {"rows": rows, "wallets": wallets, "treasury": treasury, "jackpot": jackpot, "escrow": escrow}
+
+def reconcile_chat(con: sqlite3.Connection, chat_id: int, chunk: int = RECONCILE_CHUNK) -> dict:
+    """
+    -> {chat_id, rows, wallets: [(uid, expected, actual)], treasury/jackpot/escrow: (expected, actual)}
+    В wallets — только расхождения.
+    """
+    exp = ledger_replay(con, chat_id, chunk)
+    expected = exp["wallets"]
+    drift = []
+    for uid, bal in con.execute("SELECT user_id, balance FROM wallet WHERE chat_id=?", (chat_id,)):
+        want = expected.pop(uid, 0)
+        if want != bal:
+            drift.append((uid, want, bal))
+    drift.extend((uid, want, 0) for uid, want in expected.items() if want != 0)
+
+    def one(sql) -> int:
+        row = con.execute(sql, (chat_id,)).fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    agg = con.execute("SELECT total_wallet, holders, treasury, jackpot FROM econ_agg WHERE chat_id=?",
+                      (chat_id,)).fetchone()
+    full = con.execute(ECON_AGG_RECOMPUTE + " WHERE chat_id=? GROUP BY chat_id", (chat_id,)).fetchone()
+    return {
+        "chat_id": chat_id,
+        "rows": exp["rows"],
+        "wallets": drift,
+        "treasury": (exp["treasury"], one("SELECT amount FROM treasury WHERE chat_id=?")),
+        "jackpot": (exp["jackpot"], one("SELECT amount FROM jackpot_pool WHERE chat_id=?")),
+        "escrow": (exp["escrow"], one("SELECT SUM(bet * (a_paid + b_paid)) FROM duel_bets WHERE chat_id=?")),
+        # econ_agg против полного пересчёта: (пересчёт, econ_agg)
+        "agg": (tuple(int(x) for x in full[1:]) if full else (0, 0, 0, 0), tuple(agg) if agg else (0, 0, 0, 0)),
+    }
+
+def reconcile_has_drift(rep: dict) -> bool:
+    return bool(rep["wallets"]) or any(rep[k][0] != rep[k][1] for k in ("treasury", "jackpot", "escrow", "agg"))
+
+def _reconcile_worker(path: str, chat_id: int, chunk: int) -> dict:
+    # отдельный процесс: своё соединение, один снимок на весь чат
+    con = _db_open(path)
+    try:
+        con.execute("BEGIN")
+        return reconcile_chat(con, chat_id, chunk)
+    finally:
+        con.close()
+
+def reconcile_all(path: str | None = None, workers: int = RECONCILE_WORKERS, chunk: int = RECONCILE_CHUNK) -> list[dict]:
+    """Сверить все чаты; -> отчёты (по одному на чат), в порядке chat_id."""
+    path = path or DB_PATH
+    con = _db_open(path)
+    try:
+        if epoch_migration_pending(con):
+            raise RuntimeError("epoch migration in progress, token_ledger is incomplete")
+        chats = [r[0] for r in con.execute("""
+        SELECT chat_id FROM wallet UNION SELECT chat_id FROM treasury
+        UNION SELECT chat_id FROM jackpot_pool UNION SELECT chat_id FROM duel_bets
+        UNION SELECT DISTINCT chat_id FROM token_ledger
+        ORDER BY 1
+        """)]
+    finally:
+        con.close()
+    # spawn-воркер платит за импорт модуля (aiogram — секунды), так что больше
+    # процессов, чем ядер, не берём; на одном ядре сверяем прямо здесь
+    workers = min(workers, len(chats), os.cpu_count() or 1)
+    if workers <= 1:
+        return [_reconcile_worker(path, chat_id, chunk) for chat_id in chats]
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        return list(pool.map(_reconcile_worker, [path] * len(chats), chats, [chunk] * len(chats)))
+
+def reconcile_fix(chat_id: int, now: datetime, chunk: int = RECONCILE_CHUNK) -> int:
+    """Пересчитать чат под BEGIN IMMEDIATE и записать поправки "adjust". -> сколько проводок."""
+    with db_tx(immediate=True) as con:
+        rep = reconcile_chat(con, chat_id, chunk)
+        if rep["agg"][0] != rep["agg"][1]:
+            econ_agg_rebuild(con, chat_id)
+        n = 0
+        for uid, want, have in rep["wallets"]:
+            d = have - want
+            tx_log(chat_id, now, None if d > 0 else uid, uid if d > 0 else None, abs(d), "adjust", meta="reconcile")
+            n += 1
+        tr = rep["treasury"][1] - rep["treasury"][0]
+        jp = rep["jackpot"][1] - rep["jackpot"][0]
+        if tr or jp:
+            tx_log(chat_id, now, None, None, 0, "adjust", treasury=tr, jackpot=jp, meta="reconcile")
+            n += 1
+        return n
+
+def reconcile_report_line(rep: dict) -> str:
+    parts = [f"chat={rep['chat_id']} rows={rep['rows']}"]
+    if rep["wallets"]:
+        total = sum(have - want for _uid, want, have in rep["wallets"])
+        worst = max(rep["wallets"], key=lambda w: abs(w[2] - w[1]))
+        parts.append(f"wallets={len(rep['wallets'])} drift={total:+d} worst=user {worst[0]} {worst[2] - worst[1]:+d}")
+    for k in ("treasury", "jackpot", "escrow"):
+        want, have = rep[k]
+        if want != have:
+            parts.append(f"{k}={have - want:+d}")
+    want, have = rep["agg"]
+    if want != have:
+        parts.append(f"econ_agg={have} recomputed={want}")
+    return " ".join(parts)
+
+async def reconcile_run_once(fix: bool = RECONCILE_FIX) -> list[dict]:
+    t0 = time.perf_counter()
+    reports = await asyncio.get_running_loop().run_in_executor(None, reconcile_all)
+    bad = [r for r in reports if reconcile_has_drift(r)]
+    ms = (time.perf_counter() - t0) * 1000
+    print(f"[RECONCILE] chats={len(reports)} rows={sum(r['rows'] for r in reports)} drift={len(bad)} in {ms:.0f}ms")
+    for r in bad:
+        print(f"[RECONCILE] {reconcile_report_line(r)}")
+        if fix:
+            n = await db_write(r["chat_id"], reconcile_fix, r["chat_id"], datetime.now(timezone.utc))
+            print(f"[RECONCILE] chat={r['chat_id']} adjust entries={n}")
+    return reports
+
+async def background_reconcile(interval: float = RECONCILE_INTERVAL_S):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await reconcile_run_once()
+        except Exception as e:
+            log_error("background_reconcile", e)
+
+def reconcile_cli(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(prog="weirdo.py reconcile")
+    ap.add_argument("--fix", action="store_true", help="записать корректирующие проводки по расхождениям")
+    fix = ap.parse_args(argv).fix
+    init_db()
+    while migrate_step(online=True):
+        pass
+    reports = reconcile_all()
+    bad = [r for r in reports if reconcile_has_drift(r)]
+    print(f"chats={len(reports)} rows={sum(r['rows'] for r in reports)} drift={len(bad)}")
+    for r in bad:
+        print(reconcile_report_line(r))
+        if fix:
+            print(f"  adjust entries={reconcile_fix(r['chat_id'], datetime.now(timezone.utc))}")
+    if fix and bad:
+        # поправки не трогают эскроу — то, что осталось после них, всё ещё ошибка
+        bad = [r for r in (reconcile_chat(db_conn(), r["chat_id"]) for r in bad) if reconcile_has_drift(r)]
+        for r in bad:
+            print("still " + reconcile_report_line(r))
+    db_close_all()
+    return 1 if bad else 0
+
+# =======================
+# SAFE EDIT (ANTI FLOOD)
+# =======================
+_last_edit_at = {}
+_last_edit_text = {}
+
+async def safe_edit_text(msg: Message, text: str, reply_markup=None, *, min_interval=1.2):
+    if msg is None:
+        return
+
+    now = datetime.utcnow()
+    key = (msg.chat.id, msg.message_id)
+
+    if _last_edit_text.get(key) == text:
+        return
+
+    last_at = _last_edit_at.get(key)
+    if last_at and (now - last_at).total_seconds() < min_interval:
+        return
+
+    try:
+        await msg.edit_text(text, reply_markup=reply_markup)
+        _last_edit_at[key] = now
+        _last_edit_text[key] = text
+    except Exception:
+        # не шумим, Telegram/aiogram сам иногда ругается на слишком частые edits
+        pass
+
+
+# =======================
+# LUCK / SLOTS
+# =======================
+def luck_can_spin(chat_id: int, user_id: int, now: datetime) -> bool:
+    row = db_one("SELECT ts FROM luck_cooldown WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+    return not row or epoch(now) - row[0] >= LUCK_COOLDOWN_MIN * 60
 
 def luck_mark_spin(chat_id: int, user_id: int, now: datetime):
     db_exec("""
     INSERT INTO luck_cooldown(chat_id, user_id, ts)
     VALUES(?, ?, ?)
     ON CONFLICT(chat_id, user_id) DO UPDATE SET ts=excluded.ts
-    """, (chat_id, user_id, now.isoformat()))
+    """, (chat_id, user_id, epoch(now)))
 
 def luck_set_buff(chat_id: int, user_id: int, buff: dict):
     db_exec("""
@@ -1034,6 +3056,177 @@ def luck_aura(luck_score: int) -> str:
         return "🌧️ аура: не везёт"
     return "🫥 аура: ровно"
 
+# =======================
+# SCHEMA MIGRATIONS
+# =======================
+# Версия схемы — PRAGMA user_version: сколько шагов MIGRATIONS применено.
+# init_db на свежей базе — одно чтение user_version и выход, так что время
+# старта от числа шагов не зависит. Шаги идут строго по порядку:
+# - apply(cur) — DDL и быстрые правки, одной транзакцией; должен быть
+#   идемпотентным (прерванный шаг на следующем старте начнётся заново);
+# - backfill(batch) -> строк — долгий перенос данных пачками, каждая пачка
+#   своей транзакцией; вызывается, пока не вернёт 0, и сам помнит, где
+#   остановился (по состоянию таблиц), так что переживает рестарт;
+# - online=True — backfill не держит старт: init_db останавливается на этом
+#   шаге, дальше его (и всё после него) в фоне дожимает background_migrate
+#   через поток-писатель;
+# - estimate(con) -> строк — сколько строк шаг тронет (для --dry-run; у
+#   online-шага после apply ещё и "есть ли что дожимать", так что дешёвый).
+# user_version поднимается отдельной записью после шага: упасть между ними —
+# значит на следующем старте повторить идемпотентный шаг вхолостую.
+#
+# Новый шаг — только в конец MIGRATIONS; старые не правим.
+#
+# Вручную: python weirdo.py migrate [--dry-run]
+MIGRATE_BATCH = int(os.getenv("MIGRATE_BATCH", "5000"))
+
+class Migration:
+    __slots__ = ("name", "apply", "backfill", "estimate", "online")
+
+    def __init__(self, name: str, apply=None, backfill=None, estimate=None, online: bool = False):
+        self.name = name
+        self.apply = apply
+        self.backfill = backfill
+        self.estimate = estimate
+        self.online = online
+
+def _rows(con: sqlite3.Connection, *tables: str) -> int:
+    return sum(con.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in tables if db_table_exists(t, con))
+
+def _estimate_base(con) -> int:
+    # base на существующей базе трогает только пересборку роллапов из сырых логов
+    n = 0 if db_table_exists("msg_hourly", con) else _rows(con, "msg_log")
+    return n + (0 if db_table_exists("word_hourly", con) else _rows(con, "word_log", "phrase_log"))
+
+def _estimate_ledger_pools(con) -> int:
+    if not db_table_exists("token_ledger", con):
+        return 0
+    cols = {r[1] for r in con.execute("PRAGMA table_info(token_ledger)")}
+    return 0 if "fee" in cols else _rows(con, "token_ledger")
+
+def _estimate_epoch(con) -> int:
+    n = 0
+    for table, cols in EPOCH_COLUMNS.items():
+        types = {r[1]: r[2].upper() for r in con.execute(f"PRAGMA table_info({table})")}
+        if any(types.get(c) == "TEXT" for c in cols):
+            n += _rows(con, table)
+    return n + _rows(con, *(f"{t}_iso" for t in EPOCH_ONLINE))
+
+def lookup_indexes(cur):
+    """Миграция 6: индексы под запросы, которые шли по всему чату (см. bench/check_query_plans.py)."""
+    # /rep @username: find_user_id_by_username
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_cache_display ON user_cache(chat_id, display)")
+    # /toprep: rep_all сортирует по score прямо из индекса
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_rep_chat_score ON rep(chat_id, score DESC, user_id)")
+    # загрузка реестра дуэлей: только открытые, без прохода по всей истории
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_duels_open ON duels(state) WHERE state IN ('pending', 'active')")
+
+MIGRATIONS = (
+    Migration("base schema", schema_base, estimate=_estimate_base),
+    Migration("token_tx -> token_ledger", backfill=ledger_tx_backfill,
+              estimate=lambda con: _rows(con, "token_tx")),
+    Migration("token_ledger fee/treasury/jackpot", ledger_pool_columns, estimate=_estimate_ledger_pools),
+    Migration("econ_agg", econ_agg_create,
+              estimate=lambda con: 0 if db_table_exists("econ_agg", con) else _rows(con, "wallet", "treasury", "jackpot_pool")),
+    Migration("epoch timestamps", epoch_migrate_init, backfill=epoch_migrate_backfill, estimate=_estimate_epoch,
+              online=True),
+    Migration("lookup indexes", lookup_indexes, estimate=lambda con: _rows(con, "user_cache", "rep", "duels")),
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(con: sqlite3.Connection | None = None) -> int:
+    return (con or db_conn()).execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_plan(con: sqlite3.Connection | None = None) -> list[tuple[int, str, int]]:
+    """Неприменённые шаги: [(версия, имя, примерно строк)]. Ничего не меняет."""
+    con = con or db_conn()
+    v = schema_version(con)
+    return [(i, m.name, m.estimate(con) if m.estimate else 0)
+            for i, m in enumerate(MIGRATIONS[v:], v + 1)]
+
+def migrate_apply(m: Migration):
+    if m.apply:
+        with db_tx() as con:
+            m.apply(con.cursor())
+
+def migrate_mark(v: int):
+    with db_tx() as con:
+        con.execute(f"PRAGMA user_version={int(v)}")
+
+def migrate_step(online: bool, batch: int = MIGRATE_BATCH) -> bool:
+    """
+    Применить следующий шаг целиком. -> False, если применять нечего или шаг
+    online, а online=False (тогда только его apply, backfill оставляем фону).
+    """
+    v = schema_version()
+    if v >= SCHEMA_VERSION:
+        return False
+    m = MIGRATIONS[v]
+    t0 = time.perf_counter()
+    # apply online-шага быстрый — сразу, чтобы новая схема была с первого апдейта
+    migrate_apply(m)
+    if m.online and not online and m.estimate(db_conn()):
+        return False
+    rows = 0
+    if m.backfill:
+        while n := m.backfill(batch):
+            rows += n
+    migrate_mark(v + 1)
+    print(f"[MIGRATE] v{v + 1} {m.name}: {rows} rows backfilled in {(time.perf_counter() - t0) * 1000:.0f}ms")
+    return True
+
+def init_db():
+    con = db_conn()
+    con.execute("PRAGMA journal_mode=WAL;")
+    v = schema_version(con)
+    if v == SCHEMA_VERSION:
+        return
+    if v > SCHEMA_VERSION:
+        raise RuntimeError(f"schema v{v} is newer than this code (v{SCHEMA_VERSION})")
+    while migrate_step(online=False):
+        pass
+
+def migrate_pending() -> bool:
+    return schema_version() < SCHEMA_VERSION
+
+async def background_migrate():
+    """Дожать online-шаги (и всё после них) — по пачке за запись, чтобы не держать писателя."""
+    while await db_read(None, migrate_pending):
+        v = await db_read(None, schema_version)
+        m = MIGRATIONS[v]
+        t0 = time.perf_counter()
+        rows = 0
+        await db_write(None, migrate_apply, m)
+        while m.backfill:
+            try:
+                n = await db_write(None, m.backfill, MIGRATE_BATCH)
+            except Exception as e:
+                log_error(f"migrate v{v + 1} {m.name}", e)
+                await asyncio.sleep(5)
+                continue
+            if not n:
+                break
+            rows += n
+        await db_write(None, migrate_mark, v + 1)
+        print(f"[MIGRATE] v{v + 1} {m.name}: {rows} rows backfilled online in {time.perf_counter() - t0:.1f}s")
+
+def migrate_cli(argv: list[str]) -> int:
+    """python weirdo.py migrate [--dry-run]: всё, включая online-шаги, синхронно."""
+    ap = argparse.ArgumentParser(prog="weirdo.py migrate")
+    ap.add_argument("--dry-run", action="store_true", help="только показать план, ничего не менять")
+    args = ap.parse_args(argv)
+    print(f"schema v{schema_version()} of v{SCHEMA_VERSION}")
+    plan = migrate_plan()
+    for v, name, rows in plan:
+        print(f"  v{v} {name}: ~{rows} rows" + (" (online)" if MIGRATIONS[v - 1].online else ""))
+    if args.dry_run or not plan:
+        return 0
+    init_db()
+    while migrate_step(online=True):
+        pass
+    db_close_all()
+    return 0
+
 # =======================
 # DUELS
 # =======================
@@ -1073,21 +3266,145 @@ def kb_duel_accept(duel_id: str) -> InlineKeyboardMarkup:
     kb.adjust(2)
     return kb.as_markup()
 
-def duel_new_data(a_id: int, b_id: int) -> dict:
-    return {
-        "round": 1,
-        "round_seconds": DUEL_ROUND_SECONDS,
-        "deadline": None,
-        "players": {
-            str(a_id): {"hp": DUEL_HP, "ammo": DUEL_AMMO_MAX, "acc": DUEL_BASE_ACC, "heal_used": False, "aimed": False, "crit_bonus": 0.0},
-            str(b_id): {"hp": DUEL_HP, "ammo": DUEL_AMMO_MAX, "acc": DUEL_BASE_ACC, "heal_used": False, "aimed": False, "crit_bonus": 0.0},
-        },
-        "turn": str(a_id),
-        "moves": {str(a_id): None, str(b_id): None},
-        "last_round_lines": [],
-    }
+# Состояние дуэли — два слотовых класса вместо вложенного JSON со строковыми
+# ключами. В duels.data лежит BLOB: байт версии + struct-поля + строки
+# (duel_state_dumps). Старые строки с JSON читаются duel_state_loads как раньше
+# и при следующей записи переезжают в бинарный формат.
+DUEL_MOVES = (None, "shoot", "aim", "dodge", "reload", "heal")
+DUEL_MOVE_CODE = {m: i for i, m in enumerate(DUEL_MOVES)}
+
+class DuelPlayer:
+    __slots__ = ("uid", "hp", "ammo", "acc", "heal_used", "aimed", "crit_bonus", "move")
+
+    def __init__(self, uid: int, hp: int = DUEL_HP, ammo: int = DUEL_AMMO_MAX, acc: float = DUEL_BASE_ACC,
+                 heal_used: bool = False, aimed: bool = False, crit_bonus: float = 0.0, move: str | None = None):
+        self.uid = uid
+        self.hp = hp
+        self.ammo = ammo
+        self.acc = acc
+        self.heal_used = heal_used
+        self.aimed = aimed
+        self.crit_bonus = crit_bonus
+        self.move = move
+
+class DuelState:
+    __slots__ = ("round", "round_seconds", "deadline", "turn", "a", "b",
+                 "last_round_lines", "last_round_log", "last_epic")
+
+    def __init__(self, a: DuelPlayer, b: DuelPlayer, round: int = 1, round_seconds: int = DUEL_ROUND_SECONDS,
+                 deadline: float | None = None, turn: int | None = None):
+        self.round = round
+        self.round_seconds = round_seconds
+        self.deadline = deadline        # unix ts конца раунда
+        self.turn = a.uid if turn is None else turn
+        self.a = a
+        self.b = b
+        self.last_round_lines: list[str] = []
+        self.last_round_log: list[str] = []
+        self.last_epic: str | None = None
+
+    def player(self, uid: int) -> DuelPlayer:
+        return self.a if uid == self.a.uid else self.b
+
+def duel_new_data(a_id: int, b_id: int) -> DuelState:
+    return DuelState(DuelPlayer(int(a_id)), DuelPlayer(int(b_id)))
+
+# v1: <B версия><I round><I round_seconds><d deadline|nan><q turn>, 2 x игрок, 3 списка строк
+DUEL_STATE_VERSION = 1
+_DUEL_HDR = struct.Struct("<BIIdq")
+_DUEL_PLAYER = struct.Struct("<qhhdBdB")
+_DUEL_STR = struct.Struct("<H")
+
+def _pack_player(p: DuelPlayer) -> bytes:
+    flags = (1 if p.heal_used else 0) | (2 if p.aimed else 0)
+    return _DUEL_PLAYER.pack(p.uid, p.hp, p.ammo, p.acc, flags, p.crit_bonus, DUEL_MOVE_CODE.get(p.move, 0))
+
+def _unpack_player(buf: bytes, off: int) -> DuelPlayer:
+    uid, hp, ammo, acc, flags, crit_bonus, move = _DUEL_PLAYER.unpack_from(buf, off)
+    return DuelPlayer(uid, hp, ammo, acc, bool(flags & 1), bool(flags & 2), crit_bonus, DUEL_MOVES[move])
+
+def _pack_strs(items: list[str]) -> bytes:
+    out = [bytes((len(items),))]
+    for x in items:
+        raw = x.encode("utf-8")[:0xFFFF]
+        out.append(_DUEL_STR.pack(len(raw)))
+        out.append(raw)
+    return b"".join(out)
+
+def _unpack_strs(buf: bytes, off: int) -> tuple[list[str], int]:
+    n = buf[off]
+    off += 1
+    items = []
+    for _ in range(n):
+        (ln,) = _DUEL_STR.unpack_from(buf, off)
+        off += _DUEL_STR.size
+        items.append(bytes(buf[off:off + ln]).decode("utf-8", "replace"))
+        off += ln
+    return items, off
+
+def duel_state_dumps(st: DuelState) -> bytes:
+    return b"".join((
+        _DUEL_HDR.pack(DUEL_STATE_VERSION, st.round, st.round_seconds,
+                       float("nan") if st.deadline is None else st.deadline, st.turn),
+        _pack_player(st.a),
+        _pack_player(st.b),
+        _pack_strs(st.last_round_lines[:255]),
+        _pack_strs(st.last_round_log[:255]),
+        _pack_strs([st.last_epic] if st.last_epic else []),
+    ))
+
+def duel_state_loads(raw, a_id: int, b_id: int) -> DuelState:
+    """BLOB текущего формата или легаси-JSON (str)."""
+    if raw is None:
+        return duel_new_data(a_id, b_id)
+    if isinstance(raw, str):
+        return _duel_state_from_json(json.loads(raw), a_id, b_id)
+    version = raw[0]
+    if version != DUEL_STATE_VERSION:
+        raise ValueError(f"unknown duel state version {version}")
+    _v, rnd, round_s, deadline, turn = _DUEL_HDR.unpack_from(raw, 0)
+    off = _DUEL_HDR.size
+    a = _unpack_player(raw, off)
+    b = _unpack_player(raw, off + _DUEL_PLAYER.size)
+    off += 2 * _DUEL_PLAYER.size
+    st = DuelState(a, b, rnd, round_s, None if deadline != deadline else deadline, turn)
+    st.last_round_lines, off = _unpack_strs(raw, off)
+    st.last_round_log, off = _unpack_strs(raw, off)
+    epic, off = _unpack_strs(raw, off)
+    st.last_epic = epic[0] if epic else None
+    return st
+
+def _duel_state_from_json(d: dict, a_id: int, b_id: int) -> DuelState:
+    players = d.get("players") or {}
+    moves = d.get("moves") or {}
+
+    def player(uid: int) -> DuelPlayer:
+        p = players.get(str(uid)) or {}
+        return DuelPlayer(
+            int(uid),
+            int(p.get("hp", DUEL_HP)),
+            int(p.get("ammo", DUEL_AMMO_MAX)),
+            float(p.get("acc", DUEL_BASE_ACC)),
+            bool(p.get("heal_used")),
+            bool(p.get("aimed")),
+            float(p.get("crit_bonus", 0.0)),
+            moves.get(str(uid)),
+        )
+
+    dl = d.get("deadline")
+    st = DuelState(
+        player(a_id), player(b_id),
+        int(d.get("round", 1)),
+        int(d.get("round_seconds", DUEL_ROUND_SECONDS)),
+        datetime.fromisoformat(dl).timestamp() if dl else None,
+        safe_int(d.get("turn"), int(a_id)),
+    )
+    st.last_round_lines = [x for x in (d.get("last_round_lines") or []) if x]
+    st.last_round_log = [x for x in (d.get("last_round_log") or []) if x]
+    st.last_epic = d.get("last_epic") or None
+    return st
 
-def duel_apply_luck_buff(chat_id: int, user_id: int, p: dict) -> str | None:
+def duel_apply_luck_buff(chat_id: int, user_id: int, p: DuelPlayer) -> str | None:
     buff = luck_pop_buff(chat_id, user_id)
     if not buff:
         return None
@@ -1095,19 +3412,84 @@ def duel_apply_luck_buff(chat_id: int, user_id: int, p: dict) -> str | None:
     kind = buff.get("kind")
     val = buff.get("value")
     if kind == "acc":
-        p["acc"] = clamp(float(p["acc"]) + float(val), 0.05, DUEL_MAX_ACC)
+        p.acc = clamp(p.acc + float(val), 0.05, DUEL_MAX_ACC)
         return "🎲 Бафф удачи применён: +точность"
     if kind == "hp":
-        p["hp"] = int(p["hp"]) + int(val)
+        p.hp += int(val)
         return "🎲 Бафф удачи применён: +HP"
     if kind == "ammo":
-        p["ammo"] = int(p["ammo"]) + int(val)
+        p.ammo += int(val)
         return "🎲 Бафф удачи применён: +патроны"
     if kind == "crit":
-        p["crit_bonus"] = float(p.get("crit_bonus", 0.0)) + float(val)
+        p.crit_bonus += float(val)
         return "🎲 Бафф удачи применён: +шанс крита"
     return None
 
+# Незавершённые дуэли (pending/active) живут в памяти: кнопки и таймеры работают
+# с объектом Duel, без SELECT и json.loads. Смена state/арены пишется в БД сразу
+# (от неё зависят ставки), а data раунда — отложенно: duel_update_data помечает
+# дуэль грязной, и она уходит в той же транзакции, что и ingest-буфер.
+# Реестр меняет только поток-писатель; читатели делают лишь поиск по ключу.
+# На старте реестр собирается из таблицы duels (duel_registry_load).
+class Duel:
+    __slots__ = ("chat_id", "duel_id", "a_id", "b_id", "state", "accept_deadline", "arena_msg_id", "data")
+
+    def __init__(self, chat_id: int, duel_id: str, a_id: int, b_id: int, state: str,
+                 accept_deadline: datetime | None, arena_msg_id: int | None, data: DuelState):
+        self.chat_id = chat_id
+        self.duel_id = duel_id
+        self.a_id = a_id
+        self.b_id = b_id
+        self.state = state
+        self.accept_deadline = accept_deadline
+        self.arena_msg_id = arena_msg_id
+        self.data = data
+
+    @classmethod
+    def from_row(cls, row) -> "Duel":
+        chat_id, duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, raw = row
+        dl = from_epoch(accept_deadline)
+        try:
+            data = duel_state_loads(raw, a_id, b_id)
+        except Exception as e:
+            log_error(f"duel_state_loads {duel_id}", e)
+            data = duel_new_data(a_id, b_id)
+        return cls(chat_id, duel_id, int(a_id), int(b_id), state, dl, arena_msg_id, data)
+
+_duels: dict[str, Duel] = {}
+_duels_by_arena: dict[tuple[int, int], Duel] = {}
+_duels_dirty: dict[str, Duel] = {}
+
+DUEL_COLUMNS = "chat_id, duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, data"
+
+def duel_registry_load() -> int:
+    _duels.clear()
+    _duels_by_arena.clear()
+    for row in db_all(f"SELECT {DUEL_COLUMNS} FROM duels WHERE state IN ('pending', 'active')"):
+        duel_registry_put(Duel.from_row(row))
+    return len(_duels)
+
+def duel_registry_put(duel: Duel):
+    if duel.state in ("pending", "active"):
+        _duels[duel.duel_id] = duel
+        if duel.arena_msg_id is not None:
+            _duels_by_arena[(duel.chat_id, duel.arena_msg_id)] = duel
+    else:
+        _duels.pop(duel.duel_id, None)
+        if duel.arena_msg_id is not None:
+            _duels_by_arena.pop((duel.chat_id, duel.arena_msg_id), None)
+
+def duels_dirty_take() -> list[tuple]:
+    global _duels_dirty
+    dirty, _duels_dirty = _duels_dirty, {}
+    return [(duel_state_dumps(d.data), d.chat_id, d.duel_id) for d in dirty.values()]
+
+def duels_dirty_restore(rows: list[tuple]):
+    for _data, chat_id, duel_id in rows:
+        duel = _duels.get(duel_id)
+        if duel is not None and duel.chat_id == chat_id:
+            _duels_dirty.setdefault(duel_id, duel)
+
 def duel_create(chat_id: int, a_id: int, b_id: int, now: datetime) -> str:
     duel_id = str(uuid.uuid4())
     accept_deadline = now + timedelta(minutes=DUEL_ACCEPT_MIN)
@@ -1115,58 +3497,78 @@ def duel_create(chat_id: int, a_id: int, b_id: int, now: datetime) -> str:
     db_exec("""
     INSERT INTO duels(chat_id, duel_id, a_id, b_id, state, created_at, accept_deadline, data)
     VALUES(?, ?, ?, ?, 'pending', ?, ?, ?)
-    """, (chat_id, duel_id, a_id, b_id, now.isoformat(), accept_deadline.isoformat(), json.dumps(data, ensure_ascii=False)))
+    """, (chat_id, duel_id, a_id, b_id, epoch(now), epoch(accept_deadline), duel_state_dumps(data)))
+    duel_registry_put(Duel(chat_id, duel_id, a_id, b_id, "pending", accept_deadline, None, data))
+    duel_schedule(chat_id, duel_id, accept_deadline.timestamp())
     return duel_id
 
-def duel_get(chat_id: int, duel_id: str):
-    return db_one("""
-    SELECT duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, data
-    FROM duels WHERE chat_id=? AND duel_id=?
-    """, (chat_id, duel_id))
-
-def duel_get_pending_for_b(chat_id: int, b_id: int):
-    return db_one("""
-    SELECT duel_id, a_id, b_id, accept_deadline
-    FROM duels
-    WHERE chat_id=? AND b_id=? AND state='pending'
-    ORDER BY created_at DESC
-    LIMIT 1
-    """, (chat_id, b_id))
-
-def duel_get_active_by_arena(chat_id: int, arena_msg_id: int):
-    return db_one("""
-    SELECT duel_id, a_id, b_id, data
-    FROM duels
-    WHERE chat_id=? AND arena_msg_id=? AND state='active'
-    """, (chat_id, arena_msg_id))
+def duel_get(chat_id: int, duel_id: str) -> Duel | None:
+    duel = _duels.get(duel_id)
+    if duel is not None:
+        return duel if duel.chat_id == chat_id else None
+    # завершённые в реестре не держим — за ними (редко) ходим в БД
+    row = db_one(f"SELECT {DUEL_COLUMNS} FROM duels WHERE chat_id=? AND duel_id=?", (chat_id, duel_id))
+    return Duel.from_row(row) if row else None
+
+def duel_get_pending_for_b(chat_id: int, b_id: int) -> Duel | None:
+    for duel in _duels.values():
+        if duel.chat_id == chat_id and duel.b_id == b_id and duel.state == "pending":
+            return duel
+    return None
+
+def duel_get_active_by_arena(chat_id: int, arena_msg_id: int) -> Duel | None:
+    duel = _duels_by_arena.get((chat_id, arena_msg_id))
+    return duel if duel is not None and duel.state == "active" else None
 
 def duel_set_state(chat_id: int, duel_id: str, state: str):
     db_exec("UPDATE duels SET state=? WHERE chat_id=? AND duel_id=?", (state, chat_id, duel_id))
+    duel = _duels.get(duel_id)
+    if duel is not None:
+        duel.state = state
+        duel_registry_put(duel)
 
 def duel_set_arena(chat_id: int, duel_id: str, arena_msg_id: int):
     db_exec("UPDATE duels SET arena_msg_id=? WHERE chat_id=? AND duel_id=?", (arena_msg_id, chat_id, duel_id))
-
-def duel_update_data(chat_id: int, duel_id: str, data: dict):
-    db_exec("UPDATE duels SET data=? WHERE chat_id=? AND duel_id=?", (json.dumps(data, ensure_ascii=False), chat_id, duel_id))
+    duel = _duels.get(duel_id)
+    if duel is not None:
+        duel.arena_msg_id = arena_msg_id
+        duel_registry_put(duel)
+
+def duel_update_data(chat_id: int, duel_id: str, data: DuelState):
+    duel = _duels.get(duel_id)
+    if duel is None:
+        db_exec("UPDATE duels SET data=? WHERE chat_id=? AND duel_id=?", (duel_state_dumps(data), chat_id, duel_id))
+        return
+    duel.data = data
+    _duels_dirty[duel_id] = duel
+    if data.deadline and duel.state == "active":
+        # новый раунд (duel_start_round) — заводим таймер на его дедлайн
+        duel_schedule(chat_id, duel_id, data.deadline)
 
 def duel_activate(chat_id: int, duel_id: str, arena_msg_id: int):
     db_exec("UPDATE duels SET state='active', arena_msg_id=? WHERE chat_id=? AND duel_id=?", (arena_msg_id, chat_id, duel_id))
-
-def duel_start_round(data: dict, now_dt: datetime, a_id: int, b_id: int):
-    data["last_epic"] = None
-    data["moves"][str(a_id)] = None
-    data["moves"][str(b_id)] = None
-    data["turn"] = str(a_id)
-    data["deadline"] = (now_dt + timedelta(seconds=int(data.get("round_seconds", DUEL_ROUND_SECONDS)))).isoformat()
-
-def duel_status_text(chat_id: int, a_id: int, b_id: int, data: dict) -> str:
-    a = data["players"][str(a_id)]
-    b = data["players"][str(b_id)]
-    a_name = get_user_display(chat_id, a_id)
-    b_name = get_user_display(chat_id, b_id)
-
-    def moved(uid: int) -> str:
-        return "✅ походил" if data["moves"].get(str(uid)) else "⏳ ждёт"
+    duel = _duels.get(duel_id)
+    if duel is not None:
+        duel.state = "active"
+        duel.arena_msg_id = arena_msg_id
+        duel_registry_put(duel)
+
+def duel_start_round(data: DuelState, now_dt: datetime):
+    data.last_epic = None
+    data.a.move = None
+    data.b.move = None
+    data.turn = data.a.uid
+    data.deadline = now_dt.timestamp() + data.round_seconds
+
+def duel_status_text(chat_id: int, a_id: int, b_id: int, data: DuelState) -> str:
+    a = data.a
+    b = data.b
+    turn_id = data.turn or 0
+    names = get_user_displays(chat_id, (a_id, b_id, turn_id) if turn_id else (a_id, b_id))
+    a_name, b_name = names[a_id], names[b_id]
+
+    def moved(p: DuelPlayer) -> str:
+        return "✅ походил" if p.move else "⏳ ждёт"
 
     def hp_bar(hp: int, max_hp: int) -> str:
         hp = max(0, min(hp, max_hp))
@@ -1177,23 +3579,19 @@ def duel_status_text(chat_id: int, a_id: int, b_id: int, data: dict) -> str:
         return "●" * ammo + "○" * (max_ammo - ammo)
 
     deadline_str = ""
-    if data.get("deadline"):
-        try:
-            dl = datetime.fromisoformat(data["deadline"])
-            remain_s = int((dl - datetime.now(dl.tzinfo)).total_seconds())
-            if remain_s < 0:
-                remain_s = 0
-            deadline_str = f"{remain_s}s"
-        except Exception:
-            deadline_str = ""
+    if data.deadline:
+        remain_s = int(data.deadline - time.time())
+        if remain_s < 0:
+            remain_s = 0
+        deadline_str = f"{remain_s}s"
 
-    round_s = int(data.get("round_seconds", DUEL_ROUND_SECONDS))
+    round_s = data.round_seconds
 
-    def p_block(name: str, p: dict, uid: int) -> str:
-        acc = int(float(p["acc"]) * 100)
-        hp = int(p["hp"])
-        ammo = int(p["ammo"])
-        heal_left = 0 if p.get("heal_used") else 1
+    def p_block(name: str, p: DuelPlayer) -> str:
+        acc = int(p.acc * 100)
+        hp = p.hp
+        ammo = p.ammo
+        heal_left = 0 if p.heal_used else 1
 
         # базовые лимиты
         base_hp_max = DUEL_HP
@@ -1223,11 +3621,11 @@ def duel_status_text(chat_id: int, a_id: int, b_id: int, data: dict) -> str:
             f"👤 {name}\n"
             f"{hp_line}\n"
             f"{ammo_line}   🎯 {acc}%   🩹{heal_left}\n"
-            f"{moved(uid)}"
+            f"{moved(p)}"
         )
 
     last_lines = []
-    for line in (data.get("last_round_lines") or []):
+    for line in data.last_round_lines:
         line = (line or "").strip()
         if line:
             last_lines.append("— " + line)
@@ -1236,78 +3634,77 @@ def duel_status_text(chat_id: int, a_id: int, b_id: int, data: dict) -> str:
     if last_lines:
         last_block = "\n\n🧾 Прошлый раунд:\n" + "\n".join(last_lines)
 
-    epic = (data.get("last_epic") or "").strip()
+    epic = (data.last_epic or "").strip()
     if epic:
         last_block += "\n\n⚡ Эпик момент:\n" + epic
 
-    header = f"🤠 ДУЭЛЬ • Раунд {data.get('round', 1)}"
+    header = f"🤠 ДУЭЛЬ • Раунд {data.round}"
     timer = f"⏱️ Осталось: {deadline_str} (раунд {round_s}s)" if deadline_str else f"⏱️ Раунд: {round_s}s"
-    
-    turn_id = safe_int(data.get("turn"), 0)
-    turn_name = get_user_display(chat_id, turn_id) if turn_id else "?"
+
+    turn_name = names[turn_id] if turn_id else "?"
     
     return (
         f"{header}\n"
         f"▶️ Ходит: {turn_name}\n"
         f"{timer}\n\n"
-        f"{p_block(a_name, a, a_id)}\n\n"
-        f"{p_block(b_name, b, b_id)}"
+        f"{p_block(a_name, a)}\n\n"
+        f"{p_block(b_name, b)}"
         f"{last_block}\n\n"
         f"Жми кнопки ниже 👇"
     )
 
-def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: dict) -> tuple[str, bool]:
-    pA = data["players"][str(a_id)]
-    pB = data["players"][str(b_id)]
-    mA = data["moves"].get(str(a_id))
-    mB = data["moves"].get(str(b_id))
+def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: DuelState) -> tuple[str, bool]:
+    pA = data.a
+    pB = data.b
+    mA = pA.move
+    mB = pB.move
 
-    a_name = get_user_display(chat_id, a_id)
-    b_name = get_user_display(chat_id, b_id)
+    names = get_user_displays(chat_id, (a_id, b_id))
+    a_name, b_name = names[a_id], names[b_id]
 
     if mA is None:
         mA = "dodge"
     if mB is None:
         mB = "dodge"
 
-    a_hp_before = int(pA["hp"])
-    b_hp_before = int(pB["hp"])
+    a_hp_before = pA.hp
+    b_hp_before = pB.hp
 
     log = []
 
-    def apply_action(action: str, me: dict, actor_name: str):
+    def apply_action(action: str, me: DuelPlayer, actor_name: str):
         if action == "aim":
-            me["acc"] = clamp(float(me["acc"]) + DUEL_AIM_BONUS, DUEL_BASE_ACC, DUEL_MAX_ACC)
-            me["aimed"] = True
+            me.acc = clamp(me.acc + DUEL_AIM_BONUS, DUEL_BASE_ACC, DUEL_MAX_ACC)
+            me.aimed = True
             log.append(f"{actor_name}: 🎯 прицел.")
         elif action == "reload":
-            me["ammo"] = DUEL_AMMO_MAX
+            me.ammo = DUEL_AMMO_MAX
             log.append(f"{actor_name}: 🔄 перезарядка.")
         elif action == "heal":
-            if me.get("heal_used"):
+            if me.heal_used:
                 log.append(f"{actor_name}: 🩹 перевязка не удалась (уже была).")
             else:
-                me["heal_used"] = True
-                before = int(me["hp"])
-                me["hp"] = clamp(int(me["hp"]) + DUEL_HEAL_AMOUNT, 0, 99)
-                log.append(f"{actor_name}: 🩹 перевязка ({before}→{int(me['hp'])}❤).")
+                me.heal_used = True
+                before = me.hp
+                me.hp = clamp(me.hp + DUEL_HEAL_AMOUNT, 0, 99)
+                log.append(f"{actor_name}: 🩹 перевязка ({before}→{me.hp}❤).")
         elif action == "dodge":
             log.append(f"{actor_name}: 🕺 уклон.")
 
-    def shoot(shooter_name: str, shooter: dict, target_name: str, target: dict, target_action: str):
+    def shoot(shooter_name: str, shooter: DuelPlayer, target_name: str, target: DuelPlayer, target_action: str):
         if DUEL_FUMBLE_PROB > 0 and random.random() < DUEL_FUMBLE_PROB:
             log.append(f"{shooter_name}: 🔫 осечка!")
-            shooter["aimed"] = False
+            shooter.aimed = False
             return {"shot": True, "hit": False, "crit": False, "near": False}
 
-        if int(shooter["ammo"]) <= 0:
+        if shooter.ammo <= 0:
             log.append(f"{shooter_name}: 🔫 щёлк — патронов нет.")
-            shooter["aimed"] = False
+            shooter.aimed = False
             return {"shot": False, "hit": False, "crit": False, "near": False}
 
-        shooter["ammo"] = int(shooter["ammo"]) - 1
+        shooter.ammo -= 1
 
-        chance = float(shooter["acc"])
+        chance = shooter.acc
         if target_action == "dodge":
             chance = clamp(chance - DUEL_DODGE_PENALTY, 0.05, 0.95)
 
@@ -1316,12 +3713,11 @@ def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: d
         near = (not hit) and abs(roll - chance) <= 0.07
 
         if hit:
-            base_crit = DUEL_CRIT_AFTER_AIM if shooter.get("aimed") else DUEL_CRIT_BASE
-            crit_bonus = float(shooter.get("crit_bonus", 0.0))
-            crit = random.random() < clamp(base_crit + crit_bonus, 0.0, 0.95)
+            base_crit = DUEL_CRIT_AFTER_AIM if shooter.aimed else DUEL_CRIT_BASE
+            crit = random.random() < clamp(base_crit + shooter.crit_bonus, 0.0, 0.95)
 
             dmg = DUEL_CRIT_DMG if crit else 1
-            target["hp"] = max(0, int(target["hp"]) - dmg)
+            target.hp = max(0, target.hp - dmg)
 
             if crit:
                 log.append(f"{shooter_name}: 💥 КРИТ по {target_name}! (-{dmg}❤)")
@@ -1331,7 +3727,7 @@ def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: d
             miss_lines = ["💨 МИМО!", "🫥 промах.", "🧱 пуля в стену.", "🌪️ мимо цели."]
             log.append(f"{shooter_name}: 🔫 {random.choice(miss_lines)}")
 
-        shooter["aimed"] = False
+        shooter.aimed = False
         return {"shot": True, "hit": hit, "crit": crit if hit else False, "near": near}
 
     # 1) небоевые
@@ -1347,15 +3743,15 @@ def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: d
     if mB == "shoot":
         sB = shoot(b_name, pB, a_name, pA, mA)
 
-    a_hp_after = int(pA["hp"])
-    b_hp_after = int(pB["hp"])
+    a_hp_after = pA.hp
+    b_hp_after = pB.hp
 
     def short_line(name: str, action: str, before: int, after: int) -> str:
         if action == "heal":
             return f"{name}: {act_name(action)} ({before}→{after}❤️)"
         return f"{name}: {act_name(action)}"
 
-    data["last_round_lines"] = [
+    data.last_round_lines = [
         short_line(a_name, mA, a_hp_before, a_hp_after),
         short_line(b_name, mB, b_hp_before, b_hp_after),
     ]
@@ -1380,24 +3776,24 @@ def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: d
         log.append(epic)
 
     # сохраним эпик отдельно, чтобы показать в статусе
-    data["last_epic"] = epic  # будет None если не было
+    data.last_epic = epic  # будет None если не было
 
     body = "\n".join([x for x in log if x.strip()]) if log else "Тишина."
     # сохраним лог раунда (чтобы показать в статусе)
-    data["last_round_log"] = [x for x in log if (x or "").strip()][-2:]  # последние 2 строк
+    data.last_round_log = [x for x in log if (x or "").strip()][-2:]  # последние 2 строк
 
     finished = False
     result = ""
 
-    if int(pA["hp"]) <= 0 and int(pB["hp"]) <= 0:
+    if pA.hp <= 0 and pB.hp <= 0:
         finished = True
         result = "Оба падают. Ничья."
-    elif int(pA["hp"]) <= 0:
+    elif pA.hp <= 0:
         finished = True
         rep_add(chat_id, b_id, DUEL_REP_REWARD)
         score = rep_get(chat_id, b_id)
         result = f"Победа {b_name}. +{DUEL_REP_REWARD} репутации (итого {score})."
-    elif int(pB["hp"]) <= 0:
+    elif pB.hp <= 0:
         finished = True
         rep_add(chat_id, a_id, DUEL_REP_REWARD)
         score = rep_get(chat_id, a_id)
@@ -1406,40 +3802,48 @@ def duel_resolve_round(chat_id: int, duel_id: str, a_id: int, b_id: int, data: d
     if finished:
         return f"{body}\n\n{result}", True
 
-    data["round"] = int(data.get("round", 1)) + 1
-    data["moves"][str(a_id)] = None
-    data["moves"][str(b_id)] = None
+    data.round += 1
+    pA.move = None
+    pB.move = None
     return body, False
 
 # =======================
 # STATS HELPERS
 # =======================
 def stats_ensure(chat_id: int, user_id: int, now: datetime | None = None):
-    ts = now.isoformat() if isinstance(now, datetime) else None
+    ts = epoch(now) if isinstance(now, datetime) else None
     db_exec("""
     INSERT INTO user_stats(chat_id, user_id, updated_at)
     VALUES(?, ?, ?)
     ON CONFLICT(chat_id, user_id) DO UPDATE SET updated_at=COALESCE(excluded.updated_at, updated_at)
     """, (chat_id, user_id, ts))
 
-def stats_inc(chat_id: int, user_id: int, field: str, delta: int, now: datetime | None = None):
-    # защита от кривого field
-    allowed = {
-        "msg_count",
-        "tokens_earned", "tokens_spent",
-        "slot_spent", "slot_won",
-        "duel_wins", "duel_losses", "duel_bank_won",
-    }
-    if field not in allowed:
+STATS_FIELDS = (
+    "msg_count",
+    "tokens_earned", "tokens_spent",
+    "slot_spent", "slot_won",
+    "duel_wins", "duel_losses", "duel_bank_won",
+)
+
+def stats_inc_many(chat_id: int, user_id: int, deltas: dict, now: datetime | None = None):
+    """Несколько счётчиков одним UPSERT (кривые field молча пропускаем)."""
+    fields = [f for f in deltas if f in STATS_FIELDS]
+    if not fields:
         return
-    stats_ensure(chat_id, user_id, now)
-    ts = now.isoformat() if isinstance(now, datetime) else None
+    ts = epoch(now) if isinstance(now, datetime) else None
+    cols = ", ".join(fields)
+    marks = ", ".join("?" for _ in fields)
+    sets = ", ".join(f"{f} = {f} + excluded.{f}" for f in fields)
     db_exec(f"""
-    UPDATE user_stats
-    SET {field} = {field} + ?,
-        updated_at = COALESCE(?, updated_at)
-    WHERE chat_id=? AND user_id=?
-    """, (int(delta), ts, chat_id, user_id))
+    INSERT INTO user_stats(chat_id, user_id, {cols}, updated_at)
+    VALUES(?, ?, {marks}, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+      {sets},
+      updated_at = COALESCE(excluded.updated_at, updated_at)
+    """, (chat_id, user_id, *(int(deltas[f]) for f in fields), ts))
+
+def stats_inc(chat_id: int, user_id: int, field: str, delta: int, now: datetime | None = None):
+    stats_inc_many(chat_id, user_id, {field: delta}, now)
 
 def stats_get(chat_id: int, user_id: int) -> dict:
     row = db_one("""
@@ -1553,125 +3957,172 @@ async def maybe_set_poop_reaction(bot: Bot, msg: Message):
 
 
 # =======================
-# DUEL WATCHER (timer)
+# DUEL SCHEDULER (timers)
 # =======================
+# Дедлайны дуэлей (accept_deadline у pending, data.deadline у раунда) лежат
+# в куче (unix ts, chat_id, duel_id). background_duel_watcher спит ровно до
+# ближайшего и просыпается раньше, если duel_schedule положил более ранний.
+# Запись в куче — только напоминание: при срабатывании дуэль перечитывается из
+# БД, и если дедлайн успел сдвинуться или дуэль закончилась, ничего не делаем.
+# Поэтому старые записи не чистим. Кучу трогает поток-писатель, так что лок.
+_duel_timers: list[tuple[float, int, str]] = []
+_duel_timers_lock = threading.Lock()
+_duel_wake = asyncio.Event()
+_duel_loop: asyncio.AbstractEventLoop | None = None
+
+def duel_schedule(chat_id: int, duel_id: str, when: float):
+    item = (when, chat_id, duel_id)
+    with _duel_timers_lock:
+        heapq.heappush(_duel_timers, item)
+        earliest = _duel_timers[0] is item
+    loop = _duel_loop
+    if earliest and loop is not None:
+        loop.call_soon_threadsafe(_duel_wake.set)
+
+def duel_timers_load(chat_id: int | None = None) -> int:
+    """Заводит таймеры для всех незавершённых дуэлей (на старте и после /on)."""
+    n = 0
+    for duel in list(_duels.values()):
+        if chat_id is not None and duel.chat_id != chat_id:
+            continue
+        if duel.state == "pending" and duel.accept_deadline:
+            duel_schedule(duel.chat_id, duel.duel_id, duel.accept_deadline.timestamp())
+            n += 1
+        elif duel.state == "active" and duel.arena_msg_id is not None and duel.data.deadline:
+            duel_schedule(duel.chat_id, duel.duel_id, duel.data.deadline)
+            n += 1
+    return n
+
+def duel_timers_due(now_ts: float) -> tuple[list[tuple[int, str]], float | None]:
+    """Снимает сработавшие таймеры; возвращает их и время следующего."""
+    due = []
+    with _duel_timers_lock:
+        while _duel_timers and _duel_timers[0][0] <= now_ts:
+            _ts, chat_id, duel_id = heapq.heappop(_duel_timers)
+            due.append((chat_id, duel_id))
+        nxt = _duel_timers[0][0] if _duel_timers else None
+    return list(dict.fromkeys(due)), nxt
+
+def duel_watch_one(chat_id: int, duel_id: str) -> tuple[int, str, str | None] | None:
+    """
+    Синхронная часть watcher-а для одной дуэли (идёт в потоке-писателе).
+    Возвращает правку арены: (arena_msg_id, text, duel_id для кнопок или None).
+    """
+    duel = _duels.get(duel_id)
+    if duel is None or duel.chat_id != chat_id:
+        # уже завершена — устаревший таймер
+        return None
+    s = get_settings(chat_id)
+    if not s["enabled"]:
+        # бот выключен — дуэль замирает, таймеры заведёт /on
+        return None
+    tz = s["tz"]
+    now = now_tz(tz)
+    a_id, b_id, arena_msg_id = duel.a_id, duel.b_id, duel.arena_msg_id
+
+    # 1) pending: истёк дедлайн принятия
+    if duel.state == "pending":
+        dl = duel.accept_deadline
+        if dl and now <= dl:
+            # разбудили чуть раньше (точность часов) — перезаводим
+            duel_schedule(chat_id, duel_id, dl.timestamp())
+        elif dl:
+            with db_tx(immediate=True):
+                econ_duel_refund(chat_id, duel_id, a_id, b_id, now, reason="expired")
+                duel_set_state(chat_id, duel_id, "done")
+        return None
+
+    # 2) active: истёк раунд
+    if duel.state != "active" or arena_msg_id is None:
+        return None
+    data = duel.data
+
+    dl = data.deadline
+    if not dl:
+        return None
+
+    if now.timestamp() <= dl:
+        duel_schedule(chat_id, duel_id, dl)
+        return None
+
+    # если кто-то не походил — dodge
+    if data.a.move is None:
+        data.a.move = "dodge"
+    if data.b.move is None:
+        data.b.move = "dodge"
+
+    body, finished = duel_resolve_round(chat_id, duel_id, a_id, b_id, data)
+
+    if finished:
+        duel_set_state(chat_id, duel_id, "done")
+
+        # определяем победителя по hp
+        a_hp = data.a.hp
+        b_hp = data.b.hp
+        winner = None
+        if a_hp > 0 and b_hp <= 0:
+            winner = a_id
+        elif b_hp > 0 and a_hp <= 0:
+            winner = b_id
+
+        if winner:
+            loser = b_id if winner == a_id else a_id
+            with db_tx(immediate=True):
+                duel_mark_loss(chat_id, duel_id, loser, now)
+                bank = duel_bet_payout(chat_id, duel_id, winner, now)
+            if bank > 0:
+                body += f"\n\n💰 Банк: +{bank} tokens победителю."
+
+        duel_update_data(chat_id, duel_id, data)
+        return arena_msg_id, "🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n" + body, None
+
+    duel_start_round(data, now)
+    duel_update_data(chat_id, duel_id, data)
+    return arena_msg_id, duel_status_text(chat_id, a_id, b_id, data), duel_id
+
 async def background_duel_watcher(bot: Bot):
     """
-    Каждые 2 секунды:
+    Спит до ближайшего дедлайна дуэли (или пока duel_schedule не разбудит):
     - закрываем просроченные pending-дуэли
     - закрываем/двигаем активные дуэли по истечению раунда
     """
-    while True:
-        try:
-            chats = db_all("SELECT chat_id FROM chat_settings WHERE enabled=1")
-            for (chat_id,) in chats:
-                s = get_settings(chat_id)
-                tz = s["tz"]
-                now = now_tz(tz)
-
-                # 1) pending: истёк дедлайн принятия
-                pending = db_all("""
-                    SELECT duel_id, a_id, b_id, accept_deadline
-                    FROM duels
-                    WHERE chat_id=? AND state='pending'
-                """, (chat_id,))
-                for duel_id, a_id, b_id, accept_deadline in pending:
-                    try:
-                        dl = datetime.fromisoformat(accept_deadline)
-                    except Exception:
-                        dl = None
-                    if dl and now > dl:
-                        bet_row = duel_bet_get(duel_id)
-                        if bet_row:
-                            _chat, bet, a_paid, b_paid = bet_row
-                            bet = int(bet)
-                            if bet > 0 and int(a_paid) == 1:
-                                wallet_add(chat_id, a_id, +bet)
-                                tx_log(chat_id, now, None, a_id, bet, "duel_bet_refund", meta=f"duel_id={duel_id},reason=expired")
-                            
-                            duel_bet_delete(duel_id)
-
-                        duel_set_state(chat_id, duel_id, "done")
-
-                # 2) active: истёк раунд
-                active = db_all("""
-                    SELECT duel_id, a_id, b_id, arena_msg_id, data
-                    FROM duels
-                    WHERE chat_id=? AND state='active' AND arena_msg_id IS NOT NULL
-                """, (chat_id,))
-
-                for duel_id, a_id, b_id, arena_msg_id, data_json in active:
-                    if not data_json:
-                        continue
-                    try:
-                        data = json.loads(data_json)
-                    except Exception:
-                        continue
-
-                    dl_s = data.get("deadline")
-                    if not dl_s:
-                        continue
-                    try:
-                        dl = datetime.fromisoformat(dl_s)
-                    except Exception:
-                        continue
-
-                    if now > dl:
-                        # если кто-то не походил — dodge
-                        if data["moves"].get(str(a_id)) is None:
-                            data["moves"][str(a_id)] = "dodge"
-                        if data["moves"].get(str(b_id)) is None:
-                            data["moves"][str(b_id)] = "dodge"
-
-                        body, finished = duel_resolve_round(chat_id, duel_id, a_id, b_id, data)
-
-                        if finished:
-                            duel_set_state(chat_id, duel_id, "done")
-                            
-                            # определяем победителя по hp
-                            a_hp = int(data["players"][str(a_id)]["hp"])
-                            b_hp = int(data["players"][str(b_id)]["hp"])
-                            winner = None
-                            if a_hp > 0 and b_hp <= 0:
-                                winner = a_id
-                            elif b_hp > 0 and a_hp <= 0:
-                                winner = b_id
-
-                            if winner:
-                                loser = b_id if winner == a_id else a_id
-                                duel_mark_loss(chat_id, duel_id, loser, now)
-
-                                bank = duel_bet_payout(chat_id, duel_id, winner, now)
-                                if bank > 0:
-                                    body += f"\n\n💰 Банк: +{bank} tokens победителю."
-
-                            duel_update_data(chat_id, duel_id, data)
-                            try:
-                                await bot.edit_message_text(
-                                    chat_id=chat_id,
-                                    message_id=arena_msg_id,
-                                    text="🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n" + body,
-                                )
-                            except Exception:
-                                pass
-                        else:
-                            duel_start_round(data, now, a_id, b_id)
-                            duel_update_data(chat_id, duel_id, data)
-                            try:
-                                arena_text = duel_status_text(chat_id, a_id, b_id, data)
-                                await bot.edit_message_text(
-                                    chat_id=chat_id,
-                                    message_id=arena_msg_id,
-                                    text=arena_text,
-                                    reply_markup=kb_duel_actions(duel_id),
-                                )
-                            except Exception:
-                                pass
+    global _duel_loop
+    _duel_loop = asyncio.get_running_loop()
+    try:
+        await db_write(None, duel_timers_load)
+    except Exception as e:
+        log_error("duel_timers_load", e)
 
-        except Exception as e:
-            log_error("background_duel_watcher", e)
+    while True:
+        # сбрасываем до снятия таймеров: duel_schedule между ними не потеряется
+        _duel_wake.clear()
+        due, nxt = duel_timers_due(time.time())
+        for chat_id, duel_id in due:
+            try:
+                edit = await db_write(chat_id, duel_watch_one, chat_id, duel_id)
+            except Exception as e:
+                log_error("background_duel_watcher", e)
+                continue
+            if not edit:
+                continue
+            arena_msg_id, text, kb_duel_id = edit
+            try:
+                await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=arena_msg_id,
+                    text=text,
+                    reply_markup=kb_duel_actions(kb_duel_id) if kb_duel_id else None,
+                )
+            except Exception:
+                pass
+        if due:
+            continue
 
-        await asyncio.sleep(2)
+        timeout = None if nxt is None else max(0.0, nxt - time.time())
+        try:
+            await asyncio.wait_for(_duel_wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
 
 # =======================
@@ -1727,7 +4178,7 @@ async def reply_help(msg: Message):
         "• /rank — ранг по покупкам\n\n"
 
         "📊 Статистика (для админов/интереса)\n"
-        "• /whereall [day|week|month] — активность\n"
+        "• /whereall [day|week|month|year] — активность\n"
         "• /interesting — топ-слова/фраза за 24ч\n"
         "• /wordweek — слово недели\n\n"
 
@@ -1740,7 +4191,8 @@ async def reply_help(msg: Message):
 
         "⚙️ Настройки (редко)\n"
         "• /tz Europe/Moscow — часовой пояс\n"
-        "• /quiet 30m | 2h | 1d | off — тихий режим\n\n"
+        "• /quiet 30m | 2h | 1d | off — тихий режим\n"
+        "• /retention 14 — сколько дней хранить логи для статистики\n\n"
 
         "ℹ️ Подсказки:\n"
         "• Репа: ответь на сообщение символом + или -\n"
@@ -1775,6 +4227,7 @@ def parse_period_arg(arg: str | None) -> tuple[str, timedelta]:
     - default: 24 часа
     - week: 7 дней
     - month: 30 дней
+    - year: 365 дней (из суточных роллапов)
     """
     a = (arg or "").strip().lower()
 
@@ -1787,12 +4240,16 @@ def parse_period_arg(arg: str | None) -> tuple[str, timedelta]:
     if a in ("month", "30d", "m"):
         return ("30d", timedelta(days=30))
 
+    if a in ("year", "365d", "y"):
+        return ("365d", timedelta(days=365))
+
     # неизвестное — по умолчанию 24ч
     return ("24h", timedelta(hours=24))
 
-def build_whereall_text(chat_id: int, tz: str, now: datetime, delta: timedelta, label: str) -> str:
+def build_whereall_text(chat_id: int, tz: str, now: datetime, delta: timedelta, label: str,
+                        retention_days: int = RETENTION_DAYS) -> str:
     since = now - delta
-    rows = get_user_counts(chat_id, since)
+    rows = get_user_counts(chat_id, since, retention_days)
     if not rows:
         return f"За период {label} сообщений нет."
 
@@ -1800,12 +4257,13 @@ def build_whereall_text(chat_id: int, tz: str, now: datetime, delta: timedelta,
         "24h": "📊 Активность за 24ч",
         "7d": "📊 Активность за 7 дней",
         "30d": "📊 Активность за 30 дней",
+        "365d": "📊 Активность за год",
     }.get(label, "📊 Активность")
 
     lines = [f"{title} (с {fmt_dt(since, tz)}):"]
+    names = get_user_displays(chat_id, [uid for uid, _ in rows[:15]])
     for uid, c in rows[:15]:
-        name = get_user_display(chat_id, int(uid))
-        lines.append(f"• {name}: {c}")
+        lines.append(f"• {names[int(uid)]}: {c}")
     if len(rows) > 15:
         lines.append(f"… и ещё {len(rows)-15} участников.")
     return "\n".join(lines)
@@ -1850,7 +4308,7 @@ def build_word_of_period(chat_id: int, tz: str, now: datetime, delta: timedelta,
 
 async def handle_autohype(msg: Message, chat_id: int, tz: str, now: datetime):
     since = now - timedelta(hours=24)
-    topw = get_top_words(chat_id, since, limit=3)
+    topw = await db_read(chat_id, get_top_words, chat_id, since, 3)
     if not topw:
         return
     words = ", ".join([w for w, _ in topw])
@@ -1860,7 +4318,7 @@ async def handle_autohype(msg: Message, chat_id: int, tz: str, now: datetime):
         f"🧠 Чат живёт на: {words}.",
     ])
     await msg.reply(hype)
-    set_field(chat_id, "last_autohype_at", now)
+    await settings_set(chat_id, "last_autohype_at", now)
 
 async def handle_easter(msg: Message, chat_id: int, now: datetime):
     egg = random.choice([
@@ -1871,10 +4329,11 @@ async def handle_easter(msg: Message, chat_id: int, now: datetime):
         "🥷 тень прошла.",
     ])
     await msg.reply(egg)
-    set_field(chat_id, "last_easter_at", now)
+    await settings_set(chat_id, "last_easter_at", now)
 
 def log_error(where: str, e: Exception):
     # минимальный лог в консоль
+    M_ERRORS.inc((where.split()[0],))
     try:
         print(f"[ERROR] {where}: {type(e).__name__}: {e}")
     except Exception:
@@ -1896,60 +4355,98 @@ def inv_get(chat_id: int, user_id: int, item: str) -> int:
 dp = Dispatcher()
 
 
+class ChatSettingsMiddleware(BaseMiddleware):
+    """
+    Достаёт настройки чата один раз на апдейт и кладёт их в data["settings"].
+    Заодно решает, пускать ли апдейт к хендлеру — по флагу flags={"chat": ...}:
+    - "any"  — всегда (управляющие команды: /on, /tz, /quiet, ...);
+    - "loud" — только если бот включён и чат не в тихом режиме;
+    - без флага — только если бот включён.
+    """
+
+    async def __call__(self, handler, event, data):
+        msg = event if isinstance(event, Message) else event.message
+        settings = await chat_settings(msg.chat.id)
+        data["settings"] = settings
+        mode = get_flag(data, "chat")
+        if mode != "any":
+            if not settings["enabled"]:
+                if isinstance(event, CallbackQuery):
+                    await event.answer("Бот выключен.", show_alert=True)
+                return None
+            if mode == "loud" and chat_is_quiet(settings, now_tz(settings["tz"])):
+                return None
+        return await handler(event, data)
+
+
+dp.message.middleware(ChatSettingsMiddleware())
+dp.callback_query.middleware(ChatSettingsMiddleware())
+
+
 # =======================
 # BASIC COMMANDS
 # =======================
-@dp.message(Command("start"))
-async def cmd_start(msg: Message):
+@dp.message(Command("start"), flags={"chat": "any"})
+async def cmd_start(msg: Message, settings: dict):
     await reply_help(msg)
 
-@dp.message(Command("help"))
-async def cmd_help(msg: Message):
+@dp.message(Command("help"), flags={"chat": "any"})
+async def cmd_help(msg: Message, settings: dict):
     await reply_help(msg)
 
-@dp.message(Command("on"))
-async def cmd_on(msg: Message):
+@dp.message(Command("on"), flags={"chat": "any"})
+async def cmd_on(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    ensure_chat(chat_id)
-    set_field(chat_id, "enabled", 1)
+    await settings_set(chat_id, "enabled", 1)
+    # пока бот был выключен, дуэли стояли — заводим их таймеры заново
+    await db_write(chat_id, duel_timers_load, chat_id)
     await msg.reply("✅ Бот включён в этом чате.")
 
-@dp.message(Command("off"))
-async def cmd_off(msg: Message):
+@dp.message(Command("off"), flags={"chat": "any"})
+async def cmd_off(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    ensure_chat(chat_id)
-    set_field(chat_id, "enabled", 0)
+    await settings_set(chat_id, "enabled", 0)
     await msg.reply("⛔ Бот выключён в этом чате.")
 
 
-@dp.message(Command("tz"))
-async def cmd_tz(msg: Message, command: CommandObject):
+@dp.message(Command("tz"), flags={"chat": "any"})
+async def cmd_tz(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    ensure_chat(chat_id)
     arg = (command.args or "").strip()
     if not arg:
-        s = get_settings(chat_id)
-        await msg.reply(f"Текущий TZ: {s['tz']}")
+        await msg.reply(f"Текущий TZ: {settings['tz']}")
         return
     try:
         ZoneInfo(arg)
     except Exception:
         await msg.reply("Не понимаю TZ. Пример: /tz Europe/Moscow или /tz Europe/Amsterdam")
         return
-    set_field(chat_id, "tz", arg)
+    await settings_set(chat_id, "tz", arg)
     await msg.reply(f"✅ TZ установлен: {arg}")
 
+@dp.message(Command("retention"), flags={"chat": "any"})
+async def cmd_retention(msg: Message, command: CommandObject, settings: dict):
+    chat_id = msg.chat.id
+    arg = (command.args or "").strip()
+    if not arg:
+        await msg.reply(f"Логи для статистики храним {settings['retention_days']} дн.")
+        return
+    if not arg.isdigit() or not 1 <= int(arg) <= RETENTION_MAX_DAYS:
+        await msg.reply(f"Формат: /retention <дней>, от 1 до {RETENTION_MAX_DAYS}")
+        return
+    await settings_set(chat_id, "retention_days", int(arg))
+    await msg.reply(f"✅ Логи храним {int(arg)} дн.")
+
 
-@dp.message(Command("quiet"))
-async def cmd_quiet(msg: Message, command: CommandObject):
+@dp.message(Command("quiet"), flags={"chat": "any"})
+async def cmd_quiet(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
     arg = (command.args or "").strip().lower()
     if not arg:
-        qu = s.get("quiet_until")
+        qu = settings.get("quiet_until")
         if qu and now < qu:
             await msg.reply(f"🤫 Quiet включен до {fmt_dt(qu, tz)}")
         else:
@@ -1960,88 +4457,78 @@ async def cmd_quiet(msg: Message, command: CommandObject):
     if until is None:
         # off
         if arg in ("off", "0", "нет"):
-            set_null(chat_id, "quiet_until")
+            await settings_clear(chat_id, "quiet_until")
             await msg.reply("✅ Quiet выключен.")
             return
         await msg.reply("Формат: /quiet 30m | 2h | 1d | off")
         return
 
-    set_field(chat_id, "quiet_until", until)
+    await settings_set(chat_id, "quiet_until", until)
     await msg.reply(f"🤫 Quiet включен до {fmt_dt(until, tz)}")
 
 @dp.message(Command("betinfo"))
-async def cmd_betinfo(msg: Message):
+async def cmd_betinfo(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
     if not msg.reply_to_message:
         await msg.reply("Ответь на арену дуэли командой /betinfo")
         return
 
     arena_msg_id = msg.reply_to_message.message_id
-    active = duel_get_active_by_arena(chat_id, arena_msg_id)
-    if not active:
-        await msg.reply("Не вижу активную дуэль в этом сообщении.")
-        return
 
-    duel_id, a_id, b_id, _ = active
-    row = duel_bet_get(duel_id)
-    if not row:
-        await msg.reply("Ставок нет.")
-        return
-    _chat, bet, a_paid, b_paid = row
-    a_name = get_user_display(chat_id, a_id)
-    b_name = get_user_display(chat_id, b_id)
-    await msg.reply(f"💰 Ставка: {bet}\n{a_name} внес: {'✅' if a_paid else '❌'}\n{b_name} внес: {'✅' if b_paid else '❌'}")
+    def work() -> str:
+        active = duel_get_active_by_arena(chat_id, arena_msg_id)
+        if not active:
+            return "Не вижу активную дуэль в этом сообщении."
+
+        duel_id, a_id, b_id = active.duel_id, active.a_id, active.b_id
+        row = duel_bet_get(duel_id)
+        if not row:
+            return "Ставок нет."
+        _chat, bet, a_paid, b_paid = row
+        names = get_user_displays(chat_id, (a_id, b_id))
+        a_name, b_name = names[a_id], names[b_id]
+        return f"💰 Ставка: {bet}\n{a_name} внес: {'✅' if a_paid else '❌'}\n{b_name} внес: {'✅' if b_paid else '❌'}"
+
+    await msg.reply(await db_read(chat_id, work))
 
 # =======================
 # REPUTATION
 # =======================
 @dp.message(Command("repme"))
-async def cmd_repme(msg: Message):
+async def cmd_repme(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    update_user_cache_from_message(chat_id, msg, now)
-    score = rep_get(chat_id, msg.from_user.id)
+
+    def work() -> int:
+        update_user_cache_from_message(chat_id, msg, now)
+        return rep_get(chat_id, msg.from_user.id)
+
+    score = await db_write(chat_id, work)
     await msg.reply(f"Твоя репутация: {score}")
 
-@dp.message(Command("toprep"))
-async def cmd_toprep(msg: Message):
+@dp.message(Command("toprep"), flags={"chat": "loud"})
+async def cmd_toprep(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
-    now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    rows = rep_all(chat_id)
-    if not rows:
-        await msg.reply("Пока репутации нет.")
-        return
+    def work() -> str:
+        rows = rep_all(chat_id)
+        if not rows:
+            return "Пока репутации нет."
 
-    lines = ["🏆 Топ репутации:"]
-    for i, (uid, score) in enumerate(rows[:15], start=1):
-        name = get_user_display(chat_id, int(uid))
-        lines.append(f"{i}. {name} — {score}")
-    await msg.reply("\n".join(lines))
+        lines = ["🏆 Топ репутации:"]
+        names = get_user_displays(chat_id, [uid for uid, _ in rows[:15]])
+        for i, (uid, score) in enumerate(rows[:15], start=1):
+            lines.append(f"{i}. {names[int(uid)]} — {score}")
+        return "\n".join(lines)
+
+    await msg.reply(await db_read(chat_id, work))
 
-@dp.message(Command("rep"))
-async def cmd_rep(msg: Message, command: CommandObject):
+@dp.message(Command("rep"), flags={"chat": "loud"})
+async def cmd_rep(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
     args = (command.args or "").strip()
     if not args:
@@ -2051,9 +4538,9 @@ async def cmd_rep(msg: Message, command: CommandObject):
     parts = args.split()
     if len(parts) == 1:
         sign = parts[0]
-        target = resolve_target_user_id(chat_id, msg, None)
+        target = await db_read(chat_id, resolve_target_user_id, chat_id, msg, None)
     else:
-        target = resolve_target_user_id(chat_id, msg, parts[0])
+        target = await db_read(chat_id, resolve_target_user_id, chat_id, msg, parts[0])
         sign = parts[1] if len(parts) >= 2 else "+"
 
     if not target:
@@ -2076,90 +4563,82 @@ async def cmd_rep(msg: Message, command: CommandObject):
         await msg.reply("Знак: + или -")
         return
 
-    if not rep_can_vote(chat_id, msg.from_user.id, target, now, REP_COOLDOWN_MIN):
-        await msg.reply(f"КД на репутацию: {REP_COOLDOWN_MIN} минут.")
-        return
+    def work() -> str:
+        if not rep_can_vote(chat_id, msg.from_user.id, target, now, REP_COOLDOWN_MIN):
+            return f"КД на репутацию: {REP_COOLDOWN_MIN} минут."
 
-    rep_add(chat_id, target, delta)
-    rep_mark_vote(chat_id, msg.from_user.id, target, now)
-    score = rep_get(chat_id, target)
-    name = get_user_display(chat_id, target)
-    await msg.reply(f"{name}: {'+' if delta>0 else ''}{delta} репутации. Итог: {score}")
+        rep_add(chat_id, target, delta)
+        rep_mark_vote(chat_id, msg.from_user.id, target, now)
+        score = rep_get(chat_id, target)
+        name = get_user_display(chat_id, target)
+        return f"{name}: {'+' if delta>0 else ''}{delta} репутации. Итог: {score}"
+
+    await msg.reply(await db_write(chat_id, work))
 
 
 # =======================
 # LUCK
 # =======================
-@dp.message(Command("luck"))
-async def cmd_luck(msg: Message):
+@dp.message(Command("luck"), flags={"chat": "loud"})
+async def cmd_luck(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    update_user_cache_from_message(chat_id, msg, now)
     uid = msg.from_user.id
 
-    if not luck_can_spin(chat_id, uid, now):
-        row = db_one("SELECT ts FROM luck_cooldown WHERE chat_id=? AND user_id=?", (chat_id, uid))
-        last = datetime.fromisoformat(row[0]) if row else now
-        left = (last + timedelta(minutes=LUCK_COOLDOWN_MIN)) - now
-        mins = max(0, int(left.total_seconds() // 60))
-        secs = max(0, int(left.total_seconds() % 60))
-        await msg.reply(f"⏳ Слоты на кд. Осталось ~{mins}m {secs}s.")
-        return
+    def work() -> str:
+        update_user_cache_from_message(chat_id, msg, now)
 
-    ls = luckscore_get(chat_id, uid)
-    slots, buff, rep_win = spin_slots(ls)
+        if not luck_can_spin(chat_id, uid, now):
+            row = db_one("SELECT ts FROM luck_cooldown WHERE chat_id=? AND user_id=?", (chat_id, uid))
+            last = from_epoch(row[0]) if row else now
+            left = (last + timedelta(minutes=LUCK_COOLDOWN_MIN)) - now
+            mins = max(0, int(left.total_seconds() // 60))
+            secs = max(0, int(left.total_seconds() % 60))
+            return f"⏳ Слоты на кд. Осталось ~{mins}m {secs}s."
 
-    rep_add(chat_id, uid, rep_win)
-    luck_mark_spin(chat_id, uid, now)
+        ls = luckscore_get(chat_id, uid)
+        slots, buff, rep_win = spin_slots(ls)
 
-    if buff:
-        luckscore_add(chat_id, uid, +3)
-    else:
-        luckscore_add(chat_id, uid, +1)
+        rep_add(chat_id, uid, rep_win)
+        luck_mark_spin(chat_id, uid, now)
 
-    text = [f"🎰 {slots}", f"+{rep_win} репутации. Теперь: {rep_get(chat_id, uid)}"]
-    if buff:
-        luck_set_buff(chat_id, uid, buff)
-        text.append(buff_desc(buff))
+        if buff:
+            luckscore_add(chat_id, uid, +3)
+        else:
+            luckscore_add(chat_id, uid, +1)
+
+        text = [f"🎰 {slots}", f"+{rep_win} репутации. Теперь: {rep_get(chat_id, uid)}"]
+        if buff:
+            luck_set_buff(chat_id, uid, buff)
+            text.append(buff_desc(buff))
 
-    text.append(luck_aura(luckscore_get(chat_id, uid)))
+        text.append(luck_aura(luckscore_get(chat_id, uid)))
+        return "\n".join(text)
 
-    await msg.reply("\n".join(text))
+    await msg.reply(await db_write(chat_id, work))
 
 @dp.message(Command("balance"))
-async def cmd_balance(msg: Message):
+async def cmd_balance(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
-    update_user_cache_from_message(chat_id, msg, now)
     uid = msg.from_user.id
-    bal = wallet_get(chat_id, uid)
-    jp = pool_get(chat_id, "jackpot_pool")
+
+    def work() -> tuple[int, int]:
+        update_user_cache_from_message(chat_id, msg, now)
+        return econ_balance(chat_id, uid)
+
+    bal, jp = await db_write(chat_id, work)
     await msg.reply(f"💰 Tokens: {bal}\n👑 Jackpot: {jp}")
 
-@dp.message(Command("econ"))
-async def cmd_econ(msg: Message):
+@dp.message(Command("econ"), flags={"chat": "loud"})
+async def cmd_econ(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
-    now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    snap = econ_snapshot(chat_id)
+    snap = await db_read(chat_id, econ_snapshot, chat_id)
 
     await msg.reply(
         "📉 Экономика чата (tokens)\n"
@@ -2171,16 +4650,11 @@ async def cmd_econ(msg: Message):
     )
 
 @dp.message(Command("pay"))
-async def cmd_pay(msg: Message, command: CommandObject):
+async def cmd_pay(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
-    update_user_cache_from_message(chat_id, msg, now)
-
     args = (command.args or "").strip()
     if not args:
         await msg.reply("Пример: /pay @user 50 (или reply) 50")
@@ -2192,10 +4666,10 @@ async def cmd_pay(msg: Message, command: CommandObject):
     # вариант: /pay 50 (reply)
     if len(parts) == 1 and parts[0].isdigit():
         amount = int(parts[0])
-        target = resolve_target_user_id(chat_id, msg, None)
+        target = await db_read(chat_id, resolve_target_user_id, chat_id, msg, None)
     else:
         # /pay @user 50
-        target = resolve_target_user_id(chat_id, msg, parts[0])
+        target = await db_read(chat_id, resolve_target_user_id, chat_id, msg, parts[0])
         if len(parts) >= 2 and parts[1].isdigit():
             amount = int(parts[1])
 
@@ -2209,34 +4683,25 @@ async def cmd_pay(msg: Message, command: CommandObject):
 
     amount = max(1, amount)
     fee = max(1, (amount * PAY_FEE_PCT) // 100)
-    total = amount + fee
 
-    bal = wallet_get(chat_id, msg.from_user.id)
-    if bal < total:
-        await msg.reply(f"Не хватает tokens. Нужно {total} (включая комиссию {fee}). У тебя {bal}.")
-        return
+    def work() -> str:
+        update_user_cache_from_message(chat_id, msg, now)
 
-    wallet_add(chat_id, msg.from_user.id, -total)
-    wallet_add(chat_id, target, +amount)
-    pool_add(chat_id, "treasury", +fee)
+        alert, _ = econ_pay(chat_id, msg.from_user.id, target, amount, fee, now)
+        if alert:
+            return alert
 
-    tx_log(chat_id, now, msg.from_user.id, target, amount, "pay", meta=f"fee={fee}")
+        to_name = get_user_display(chat_id, target)
+        return f"✅ Перевод: {to_name} +{amount} tokens\nКомиссия: {fee} → казна"
 
-    to_name = get_user_display(chat_id, target)
-    await msg.reply(f"✅ Перевод: {to_name} +{amount} tokens\nКомиссия: {fee} → казна")
+    await msg.reply(await db_write_group(chat_id, work))
 
-@dp.message(Command("slot"))
-async def cmd_slot(msg: Message, command: CommandObject):
+@dp.message(Command("slot"), flags={"chat": "loud"})
+async def cmd_slot(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    update_user_cache_from_message(chat_id, msg, now)
     uid = msg.from_user.id
 
     parsed = parse_slot_args(command.args)
@@ -2246,146 +4711,57 @@ async def cmd_slot(msg: Message, command: CommandObject):
 
     mode, bet = parsed
 
-    if not slot_can_spin(chat_id, uid, now):
-        row = db_one("SELECT ts FROM slot_cooldown WHERE chat_id=? AND user_id=?", (chat_id, uid))
-        last = datetime.fromisoformat(row[0]) if row else now
-        left = (last + timedelta(minutes=SLOT_COOLDOWN_MIN)) - now
-        mins = max(0, int(left.total_seconds() // 60))
-        secs = max(0, int(left.total_seconds() % 60))
-        await msg.reply(f"⏳ Слот на кд. Осталось ~{mins}m {secs}s.")
-        return
-
-    bal = wallet_get(chat_id, uid)
-    if bal < bet:
-        await msg.reply(f"Не хватает tokens. Ставка {bet}, у тебя {bal}.")
-        return
-
-    # списали ставку
-    wallet_add(chat_id, uid, -bet)
-
-    stats_inc(chat_id, uid, "tokens_spent", bet, now)
-    stats_inc(chat_id, uid, "slot_spent", bet, now)
-
-    # распределили проценты
-    jp_add = (bet * JACKPOT_PCT) // 100
-    tr_add = (bet * TREASURY_PCT) // 100
-    pool_add(chat_id, "jackpot_pool", +jp_add)
-    pool_add(chat_id, "treasury", +tr_add)
-
-    # крутим
-    line, mult, jackpot_hit = slot_spin(mode)
+    def work() -> str:
+        update_user_cache_from_message(chat_id, msg, now)
 
-    win = 0
-    extra = []
+        alert, r = econ_slot(chat_id, uid, mode, bet, now)
+        if alert:
+            return alert
+        win = r["win"]
 
-    if jackpot_hit:
-        jp = pool_get(chat_id, "jackpot_pool")
-        win = jp
-        pool_set(chat_id, "jackpot_pool", 0)
-        extra.append(f"👑 ДЖЕКПОТ: +{jp} tokens")
-    else:
-        win = int(round(bet * mult))
-
-    if win > 0:
-        wallet_add(chat_id, uid, +win)
-
-        stats_inc(chat_id, uid, "tokens_earned", win, now)
-        stats_inc(chat_id, uid, "slot_won", win, now)
-
-    slot_mark_spin(chat_id, uid, now)
-    tx_log(chat_id, now, uid, None, bet, "slot_bet", meta=f"mode={mode}")
-    if win > 0:
-        tx_log(chat_id, now, None, uid, win, "slot_win", meta=f"mode={mode},mult={mult}")
+        res = [
+            f"🎰 {r['line']}",
+            f"Режим: {mode} • Ставка: {bet}",
+        ]
 
-    new_bal = wallet_get(chat_id, uid)
-    jp_now = pool_get(chat_id, "jackpot_pool")
-
-    res = [
-        f"🎰 {line}",
-        f"Режим: {mode} • Ставка: {bet}",
-    ]
-
-    if jackpot_hit:
-        res.append("Сорвал банк.")
-    else:
-        if win <= 0:
+        if r["jackpot_hit"]:
+            res.append("Сорвал банк.")
+            res.append(f"👑 ДЖЕКПОТ: +{win} tokens")
+        elif win <= 0:
             res.append("💀 Мимо.")
         else:
-            res.append(f"✅ Выигрыш: +{win} tokens (x{mult:g})")
+            res.append(f"✅ Выигрыш: +{win} tokens (x{r['mult']:g})")
 
-    if extra:
-        res.extend(extra)
+        res.append(f"💰 Баланс: {r['balance']}")
+        res.append(f"👑 Jackpot: {r['jackpot']}")
+        return "\n".join(res)
 
-    res.append(f"💰 Баланс: {new_bal}")
-    res.append(f"👑 Jackpot: {jp_now}")
-
-    await msg.reply("\n".join(res))
+    await msg.reply(await db_write_group(chat_id, work))
 
 @dp.message(Command("daily"))
-async def cmd_daily(msg: Message):
+async def cmd_daily(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
-    update_user_cache_from_message(chat_id, msg, now)
     uid = msg.from_user.id
 
-    day = date_key(now)
-    if daily_claimed(chat_id, uid, day):
-        await msg.reply("⏳ Ты уже забирал daily сегодня.")
-        return
-
-    # --- streak ---
-    row = daily_streak_get(chat_id, uid)
-    last = datetime.fromisoformat(row[0]) if row and row[0] else None
-    streak = int(row[1]) if row else 0
+    def work() -> str:
+        update_user_cache_from_message(chat_id, msg, now)
 
-    yesterday = (now - timedelta(days=1)).date().isoformat()
-    if last and last.date().isoformat() == yesterday:
-        streak += 1
-    else:
-        streak = 1
-
-    # базовый дроп
-    base = random.randint(25, 50)
-
-    # бонус за активность за 24ч: +0..+10
-    since = now - timedelta(hours=24)
-    row2 = db_one(
-        "SELECT COUNT(*) FROM msg_log WHERE chat_id=? AND user_id=? AND ts>=?",
-        (chat_id, uid, since.isoformat()),
-    )
-    c = int(row2[0]) if row2 else 0
-    bonus = min(10, c // 5)
-
-    # бонус за стрик
-    streak_bonus = min(20, (streak - 1) * 2)
-
-    amount = base + bonus + streak_bonus
-
-    wallet_add(chat_id, uid, amount)
-    stats_inc(chat_id, uid, "tokens_earned", amount, now)
-    daily_mark_claim(chat_id, uid, day)
-    daily_streak_set(chat_id, uid, now, streak)
-    tx_log(chat_id, now, None, uid, amount, "daily", meta=f"base={base},bonus={bonus},streak={streak},msg24h={c}")
-
-    bal = wallet_get(chat_id, uid)
+        alert, r = econ_daily(chat_id, uid, now)
+        if alert:
+            return alert
+        return (
+            f"🎁 Daily: +{r['amount']} tokens (база {r['base']} + активность {r['bonus']} + стрик {r['streak_bonus']})\n"
+            f"🔥 Стрик: {r['streak']}\n"
+            f"💰 Баланс: {r['balance']}"
+        )
 
-    await msg.reply(
-        f"🎁 Daily: +{amount} tokens (база {base} + активность {bonus} + стрик {streak_bonus})\n"
-        f"🔥 Стрик: {streak}\n"
-        f"💰 Баланс: {bal}"
-    )
+    await msg.reply(await db_write_group(chat_id, work))
 
 @dp.message(Command("shop"))
-async def cmd_shop(msg: Message):
-    chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
+async def cmd_shop(msg: Message, settings: dict):
     lines = ["🛒 Магазин:"]
     for k, v in SHOP_ITEMS.items():
         lines.append(f"• {k} — {v['price']} tokens")
@@ -2393,12 +4769,9 @@ async def cmd_shop(msg: Message):
     await msg.reply("\n".join(lines))
 
 @dp.message(Command("buy"))
-async def cmd_buy(msg: Message, command: CommandObject):
+async def cmd_buy(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
     uid = msg.from_user.id
@@ -2407,36 +4780,21 @@ async def cmd_buy(msg: Message, command: CommandObject):
         await msg.reply("Нет такого предмета. Смотри /shop")
         return
 
-    price = int(SHOP_ITEMS[item]["price"])
-    bal = wallet_get(chat_id, uid)
-    if bal < price:
-        await msg.reply(f"Не хватает tokens. Нужно {price}, у тебя {bal}.")
-        return
-
-    wallet_add(chat_id, uid, -price)
-    stats_inc(chat_id, uid, "tokens_spent", price, now)
-    pool_add(chat_id, "treasury", +price)
-    tx_log(chat_id, now, uid, None, price, "buy", meta=f"item={item}")
+    def work() -> str:
+        alert, title = econ_buy(chat_id, uid, item, now)
+        if alert:
+            return alert
+        if title is not None:
+            return f"✅ Куплено. Титул установлен: {title}"
+        return f"✅ Куплено: {item} x1"
 
-    it = SHOP_ITEMS[item]
-    if it["type"] == "title":
-        db_exec("""
-        INSERT INTO user_profile(chat_id, user_id, title) VALUES(?, ?, ?)
-        ON CONFLICT(chat_id, user_id) DO UPDATE SET title=excluded.title
-        """, (chat_id, uid, it["value"]))
-        await msg.reply(f"✅ Куплено. Титул установлен: {it['value']}")
-    else:
-        inv_add(chat_id, uid, item, 1)
-        await msg.reply(f"✅ Куплено: {item} x1")
+    await msg.reply(await db_write_group(chat_id, work))
 
 @dp.message(Command("inv"))
-async def cmd_inv(msg: Message):
+async def cmd_inv(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
     uid = msg.from_user.id
-    rows = db_all("SELECT item, qty FROM inventory WHERE chat_id=? AND user_id=? AND qty>0", (chat_id, uid))
+    rows = await adb_all("SELECT item, qty FROM inventory WHERE chat_id=? AND user_id=? AND qty>0", (chat_id, uid), chat_id=chat_id)
     if not rows:
         await msg.reply("🎒 Инвентарь пуст.")
         return
@@ -2448,60 +4806,47 @@ async def cmd_inv(msg: Message):
 # =======================
 # STATS
 # =======================
-@dp.message(Command("whereall"))
-async def cmd_whereall(msg: Message, command: CommandObject):
+@dp.message(Command("whereall"), flags={"chat": "loud"})
+async def cmd_whereall(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
 
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    if not cooldown_ok(s.get("last_where_all_at"), now, WHEREALL_COOLDOWN_MIN):
+    if not cooldown_ok(settings.get("last_where_all_at"), now, WHEREALL_COOLDOWN_MIN):
         await msg.reply(f"⏳ КД {WHEREALL_COOLDOWN_MIN} минут.")
         return
 
     label, delta = parse_period_arg(command.args)
 
-    set_field(chat_id, "last_where_all_at", now)
-    await msg.reply(build_whereall_text(chat_id, tz, now, delta, label))
+    await settings_set(chat_id, "last_where_all_at", now)
+    await msg.reply(await db_read(chat_id, build_whereall_text, chat_id, tz, now, delta, label,
+                                  settings["retention_days"]))
 
-@dp.message(Command("interesting"))
-async def cmd_interesting(msg: Message):
+@dp.message(Command("interesting"), flags={"chat": "loud"})
+async def cmd_interesting(msg: Message, settings: dict):
     # алиас на /wordweek
-    await cmd_wordweek(msg)
+    await cmd_wordweek(msg, settings)
 
 
-@dp.message(Command("wordweek"))
-async def cmd_wordweek(msg: Message):
+@dp.message(Command("wordweek"), flags={"chat": "loud"})
+async def cmd_wordweek(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
 
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    if not cooldown_ok(s.get("last_interesting_at"), now, INTERESTING_COOLDOWN_MIN):
+    if not cooldown_ok(settings.get("last_interesting_at"), now, INTERESTING_COOLDOWN_MIN):
         await msg.reply(f"⏳ КД {INTERESTING_COOLDOWN_MIN} минут.")
         return
 
-    set_field(chat_id, "last_interesting_at", now)
-    await msg.reply(build_word_of_period(chat_id, tz, now, timedelta(days=7), "🧠 Слово недели"))
+    await settings_set(chat_id, "last_interesting_at", now)
+    text = await db_read(chat_id, build_word_of_period, chat_id, tz, now, timedelta(days=7), "🧠 Слово недели")
+    await msg.reply(text)
 
 #для вывода ранка
 def spent_in_shop(chat_id: int, user_id: int) -> int:
-    row = db_one("""
-        SELECT COALESCE(SUM(amount),0)
-        FROM token_tx
-        WHERE chat_id=? AND from_user_id=? AND kind='buy'
-    """, (chat_id, user_id))
-    return int(row[0]) if row else 0
+    return token_totals_get(chat_id, user_id, "buy")[0]
 
 def rank_name(spent: int) -> str:
     cur = RANKS[0][1]
@@ -2513,53 +4858,49 @@ def rank_name(spent: int) -> str:
     return cur
 
 @dp.message(Command("rank"))
-async def cmd_rank(msg: Message):
+async def cmd_rank(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
     uid = msg.from_user.id
-    sp = spent_in_shop(chat_id, uid)
+    sp = await db_read(chat_id, spent_in_shop, chat_id, uid)
     r = rank_name(sp)
     await msg.reply(f"🏷️ Ранг: {r}\n💸 Потрачено в магазине: {sp} tokens")
 
-@dp.message(Command("profile"))
-@dp.message(Command("me"))
-async def cmd_profile(msg: Message):
+@dp.message(Command("profile"), flags={"chat": "loud"})
+@dp.message(Command("me"), flags={"chat": "loud"})
+async def cmd_profile(msg: Message, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
-
-    update_user_cache_from_message(chat_id, msg, now)
 
     uid = msg.from_user.id
-    name = get_user_display(chat_id, uid)
 
-    st = stats_get(chat_id, uid)
-    rep = rep_get(chat_id, uid)
+    def work() -> str:
+        update_user_cache_from_message(chat_id, msg, now)
 
-    earned = st["tokens_earned"]
-    spent = st["tokens_spent"]
-    profit = earned - spent
+        name = get_user_display(chat_id, uid)
 
-    bal = wallet_get(chat_id, uid)
+        st = stats_get(chat_id, uid)
+        rep = rep_get(chat_id, uid)
 
-    await msg.reply(
-        f"🎮 Профиль: {name}\n\n"
-        f"🏷️ Общий ранг: {overall_rank(chat_id, uid)}\n"
-        f"⭐ Ранг по репе: {rep_rank(chat_id, uid)} (репа {rep})\n"
-        f"💰 Ранг по выигрышам: {win_rank(chat_id, uid)} (получено {earned})\n"
-        f"💬 Ранг по активности: {chat_rank(chat_id, uid)} (сообщений {st['msg_count']})\n\n"
-        f"⚔️ Дуэли: ✅ {st['duel_wins']} / ❌ {st['duel_losses']}  | банк выигран: {st['duel_bank_won']}\n"
-        f"🎰 Слоты: потрачено {st['slot_spent']} / выиграно {st['slot_won']}\n"
-        f"📈 Профит (получено-потрачено): {profit}\n"
-        f"👛 Баланс сейчас: {bal}"
-    )
+        earned = st["tokens_earned"]
+        spent = st["tokens_spent"]
+        profit = earned - spent
+
+        bal = wallet_get(chat_id, uid)
+
+        return (
+            f"🎮 Профиль: {name}\n\n"
+            f"🏷️ Общий ранг: {overall_rank(chat_id, uid)}\n"
+            f"⭐ Ранг по репе: {rep_rank(chat_id, uid)} (репа {rep})\n"
+            f"💰 Ранг по выигрышам: {win_rank(chat_id, uid)} (получено {earned})\n"
+            f"💬 Ранг по активности: {chat_rank(chat_id, uid)} (сообщений {st['msg_count']})\n\n"
+            f"⚔️ Дуэли: ✅ {st['duel_wins']} / ❌ {st['duel_losses']}  | банк выигран: {st['duel_bank_won']}\n"
+            f"🎰 Слоты: потрачено {st['slot_spent']} / выиграно {st['slot_won']}\n"
+            f"📈 Профит (получено-потрачено): {profit}\n"
+            f"👛 Баланс сейчас: {bal}"
+        )
+
+    await msg.reply(await db_write(chat_id, work))
 
 # =======================
 # DUEL FLOW (invite / accept / decline / actions)
@@ -2571,18 +4912,13 @@ def kb_duel_invite(duel_id: str) -> InlineKeyboardMarkup:
     kb.adjust(2)
     return kb.as_markup()
 
-@dp.message(Command("duel"))
-async def cmd_duel(msg: Message, command: CommandObject):
+@dp.message(Command("duel"), flags={"chat": "loud"})
+async def cmd_duel(msg: Message, command: CommandObject, settings: dict):
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        return
 
-    update_user_cache_from_message(chat_id, msg, now)
+    await db_write(chat_id, update_user_cache_from_message, chat_id, msg, now)
     a_id = msg.from_user.id
 
     raw = (command.args or "").strip()
@@ -2598,7 +4934,7 @@ async def cmd_duel(msg: Message, command: CommandObject):
         else:
             target_arg = p
 
-    b_id = resolve_target_user_id(chat_id, msg, target_arg)
+    b_id = await db_read(chat_id, resolve_target_user_id, chat_id, msg, target_arg)
 
 
     if not b_id:
@@ -2614,114 +4950,120 @@ async def cmd_duel(msg: Message, command: CommandObject):
         await msg.reply(f"Макс ставка: {MAX_BET} tokens.")
         return
 
-    # цель уже имеет pending?
-    pending = duel_get_pending_for_b(chat_id, b_id)
-    if pending:
-        await msg.reply("У этого игрока уже висит приглашение. Пусть примет/откажет.")
-        return
-
-    if bet > 0:
-        bal = wallet_get(chat_id, a_id)
-        if bal < bet:
-            await msg.reply(f"Не хватает tokens на ставку {bet}. У тебя {bal}.")
-            return
-        wallet_add(chat_id, a_id, -bet)
-
-    duel_id = duel_create(chat_id, a_id, b_id, now)
-
-    duel_bet_create(chat_id, duel_id, bet)
-    if bet > 0:
-        duel_bet_set_paid(duel_id, a_paid=1)
-        tx_log(chat_id, now, a_id, None, bet, "duel_bet_lock", meta=f"duel_id={duel_id}")
-
-    a_name = get_user_display(chat_id, a_id)
-    b_name = get_user_display(chat_id, b_id)
-    accept_deadline = now + timedelta(minutes=DUEL_ACCEPT_MIN)
+    def work() -> tuple[str, str | None]:
+        # цель уже имеет pending?
+        pending = duel_get_pending_for_b(chat_id, b_id)
+        if pending:
+            return "У этого игрока уже висит приглашение. Пусть примет/откажет.", None
+
+        with db_tx(immediate=True):
+            # проверка до duel_create: без денег дуэль даже не заводим
+            bal = wallet_get(chat_id, a_id)
+            if bet > 0 and bal < bet:
+                return f"Не хватает tokens на ставку {bet}. У тебя {bal}.", None
+
+            duel_id = duel_create(chat_id, a_id, b_id, now)
+            duel_bet_create(chat_id, duel_id, bet)
+            if bet > 0:
+                econ_duel_lock(chat_id, duel_id, a_id, "a", bet, now)
+
+        names = get_user_displays(chat_id, (a_id, b_id))
+        a_name, b_name = names[a_id], names[b_id]
+        accept_deadline = now + timedelta(minutes=DUEL_ACCEPT_MIN)
+
+        text = (
+            f"🤠 Дуэль!\n"
+            f"{a_name} вызывает {b_name}.\n\n"
+            f"⏳ Принять до: {fmt_dt(accept_deadline, tz)}\n"
+            f"Правила: 1 минута на раунд, HP={DUEL_HP}, патроны={DUEL_AMMO_MAX}.\n"
+        )
+        if bet > 0:
+            text += f"\n💰 Ставка: {bet} tokens (банк {bet*2})"
+        return text, duel_id
 
-    text = (
-        f"🤠 Дуэль!\n"
-        f"{a_name} вызывает {b_name}.\n\n"
-        f"⏳ Принять до: {fmt_dt(accept_deadline, tz)}\n"
-        f"Правила: 1 минута на раунд, HP={DUEL_HP}, патроны={DUEL_AMMO_MAX}.\n"
-    )
-    if bet > 0:
-        text += f"\n💰 Ставка: {bet} tokens (банк {bet*2})"
+    text, duel_id = await db_write(chat_id, work)
+    if duel_id is None:
+        await msg.reply(text)
+        return
 
     await msg.reply(text, reply_markup=kb_duel_invite(duel_id))
 
 @dp.callback_query(F.data.startswith("duel:accept:"))
-async def cb_duel_accept(cb: CallbackQuery):
+async def cb_duel_accept(cb: CallbackQuery, settings: dict):
     chat_id = cb.message.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        await cb.answer("Бот выключен.", show_alert=True)
-        return
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
-    duel_id = cb.data.split(":")[-1]
-    row = duel_get(chat_id, duel_id)
-    if not row:
-        await cb.answer("Дуэль не найдена.", show_alert=True)
+    if not cb.from_user:
         return
 
-    _duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, data_json = row
+    duel_id = cb.data.split(":")[-1]
 
-    if state != "pending":
-        await cb.answer("Это приглашение уже не активно.", show_alert=True)
-        return
+    def work():
+        """-> (alert, None) при отказе, иначе (None, (a_id, b_id, data, a_note, b_note, arena_text))"""
+        duel = duel_get(chat_id, duel_id)
+        if not duel:
+            return "Дуэль не найдена.", None
 
-    if not cb.from_user:
-        return
+        a_id, b_id = duel.a_id, duel.b_id
 
-    if cb.from_user.id != b_id:
-        await cb.answer("Принять может только вызванный игрок.", show_alert=True)
-        return
+        if duel.state != "pending":
+            return "Это приглашение уже не активно.", None
 
-    try:
-        dl = datetime.fromisoformat(accept_deadline)
-    except Exception:
-        dl = None
-    if dl and now > dl:
-        duel_set_state(chat_id, duel_id, "done")
-        await cb.answer("Поздно. Приглашение истекло.", show_alert=True)
-        return
+        if cb.from_user.id != b_id:
+            return "Принять может только вызванный игрок.", None
 
-    bet_row = duel_bet_get(duel_id)
-    bet = int(bet_row[1]) if bet_row else 0
+        dl = duel.accept_deadline
+        if dl and now > dl:
+            duel_set_state(chat_id, duel_id, "done")
+            return "Поздно. Приглашение истекло.", None
 
-    if bet > 0:
-        bal = wallet_get(chat_id, b_id)
-        if bal < bet:
-            await cb.answer("Не хватает tokens на ставку.", show_alert=True)
-            return
-        wallet_add(chat_id, b_id, -bet)
-        duel_bet_set_paid(duel_id, b_paid=1)
-        tx_log(chat_id, now, b_id, None, bet, "duel_bet_lock", meta=f"duel_id={duel_id}")
+        bet_row = duel_bet_get(duel_id)
+        bet = int(bet_row[1]) if bet_row else 0
 
-    # активируем дуэль и создаём арену (новое сообщение)
-    try:
-        data = json.loads(data_json) if data_json else duel_new_data(a_id, b_id)
-    except Exception:
-        data = duel_new_data(a_id, b_id)
+        if bet > 0 and not econ_duel_lock(chat_id, duel_id, b_id, "b", bet, now):
+            return "Не хватает tokens на ставку.", None
 
-    # применяем баффы удачи (если есть) — на старте
-    a_note = duel_apply_luck_buff(chat_id, a_id, data["players"][str(a_id)])
-    b_note = duel_apply_luck_buff(chat_id, b_id, data["players"][str(b_id)])
+        # активируем дуэль и создаём арену (новое сообщение); до activate()
+        # реестр не трогаем — если арена не отправится, ставку b вернём и
+        # дуэль останется pending
+        data = duel_state_loads(duel_state_dumps(duel.data), a_id, b_id)
 
-    duel_start_round(data, now, a_id, b_id)
+        # применяем баффы удачи (если есть) — на старте
+        a_note = duel_apply_luck_buff(chat_id, a_id, data.a)
+        b_note = duel_apply_luck_buff(chat_id, b_id, data.b)
 
-    arena_text = duel_status_text(chat_id, a_id, b_id, data)
-    arena = await cb.message.answer(arena_text, reply_markup=kb_duel_actions(duel_id))
+        duel_start_round(data, now)
 
-    duel_activate(chat_id, duel_id, arena.message_id)
-    duel_update_data(chat_id, duel_id, data)
+        arena_text = duel_status_text(chat_id, a_id, b_id, data)
+        return None, (a_id, b_id, data, a_note, b_note, arena_text)
+
+    alert, res = await db_write(chat_id, work)
+    if alert:
+        await cb.answer(alert, show_alert=True)
+        return
+    a_id, b_id, data, a_note, b_note, arena_text = res
+
+    try:
+        arena = await cb.message.answer(arena_text, reply_markup=kb_duel_actions(duel_id))
+    except Exception as e:
+        log_error("duel arena send", e)
+        await db_write(chat_id, econ_duel_unlock, chat_id, duel_id, b_id, "b", now, "arena_failed")
+        await cb.answer("Не удалось начать дуэль, попробуй ещё раз.", show_alert=True)
+        return
 
-    notes = []
-    if a_note:
-        notes.append(f"{get_user_display(chat_id, a_id)}: {a_note}")
-    if b_note:
-        notes.append(f"{get_user_display(chat_id, b_id)}: {b_note}")
+    def activate() -> list[str]:
+        duel_activate(chat_id, duel_id, arena.message_id)
+        duel_update_data(chat_id, duel_id, data)
+
+        notes = []
+        if a_note:
+            notes.append(f"{get_user_display(chat_id, a_id)}: {a_note}")
+        if b_note:
+            notes.append(f"{get_user_display(chat_id, b_id)}: {b_note}")
+        return notes
+
+    notes = await db_write(chat_id, activate)
     if notes:
         await cb.message.answer("\n".join(notes))
 
@@ -2734,111 +5076,66 @@ async def cb_duel_accept(cb: CallbackQuery):
         pass
 
 @dp.callback_query(F.data.startswith("duel:decline:"))
-async def cb_duel_decline(cb: CallbackQuery):
+async def cb_duel_decline(cb: CallbackQuery, settings: dict):
     chat_id = cb.message.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        await cb.answer("Бот выключен.", show_alert=True)
+
+    if not cb.from_user:
         return
 
     duel_id = cb.data.split(":")[-1]
-    row = duel_get(chat_id, duel_id)
-    if not row:
-        await cb.answer("Дуэль не найдена.", show_alert=True)
-        return
 
-    _duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, data_json = row
-    if state != "pending":
-        await cb.answer("Уже не актуально.", show_alert=True)
-        return
+    def work() -> str | None:
+        duel = duel_get(chat_id, duel_id)
+        if not duel:
+            return "Дуэль не найдена."
 
-    if not cb.from_user:
-        return
+        a_id, b_id = duel.a_id, duel.b_id
+        if duel.state != "pending":
+            return "Уже не актуально."
 
-    if cb.from_user.id != b_id:
-        await cb.answer("Отказаться может только вызванный игрок.", show_alert=True)
-        return
+        if cb.from_user.id != b_id:
+            return "Отказаться может только вызванный игрок."
 
-    bet_row = duel_bet_get(duel_id)
-    if bet_row:
-        _chat, bet, a_paid, b_paid = bet_row
-        bet = int(bet)
-        if bet > 0 and int(a_paid) == 1:
-            wallet_add(chat_id, a_id, +bet)
-            tz = get_settings(chat_id)["tz"]
-            now = now_tz(tz)
-            tx_log(chat_id, now, None, a_id, bet, "duel_bet_refund", meta=f"duel_id={duel_id}")
-        duel_bet_delete(duel_id)
+        with db_tx(immediate=True):
+            econ_duel_refund(chat_id, duel_id, a_id, b_id, now_tz(settings["tz"]))
+            duel_set_state(chat_id, duel_id, "done")
+        return None
+
+    alert = await db_write(chat_id, work)
+    if alert:
+        await cb.answer(alert, show_alert=True)
+        return
 
-    duel_set_state(chat_id, duel_id, "done")
     await cb.answer("Отказ.")
     try:
         await cb.message.edit_text("❌ Дуэль отклонена.")
     except Exception:
         pass
 
-@dp.callback_query(F.data.startswith("duel:act:"))
-async def cb_duel_action(cb: CallbackQuery):
-    chat_id = cb.message.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        await cb.answer("Бот выключен.", show_alert=True)
-        return
-    tz = s["tz"]
-    now = now_tz(tz)
-    if chat_is_quiet(s, now):
-        await cb.answer("Quiet режим.", show_alert=True)
-        return
-
-    # duel:act:<duel_id>:<action>
-    parts = cb.data.split(":")
-    if len(parts) < 4:
-        await cb.answer("Некорректная кнопка.", show_alert=True)
-        return
-    duel_id = parts[2]
-    action = parts[3]
-
-    row = duel_get(chat_id, duel_id)
-    if not row:
-        await cb.answer("Дуэль не найдена.", show_alert=True)
-        return
+def duel_apply_action(chat_id: int, duel_id: str, uid: int, action: str, now: datetime):
+    """
+    Синхронная часть cb_duel_action (в потоке-писателе).
+    -> (alert, None) либо (None, (answer, edit_text, kb_duel_id или None))
+    """
+    duel = duel_get(chat_id, duel_id)
+    if not duel:
+        return "Дуэль не найдена.", None
 
-    _duel_id, a_id, b_id, state, accept_deadline, arena_msg_id, data_json = row
-    if state != "active":
-        await cb.answer("Дуэль уже не активна.", show_alert=True)
-        return
+    a_id, b_id = duel.a_id, duel.b_id
+    if duel.state != "active":
+        return "Дуэль уже не активна.", None
 
-    if not cb.from_user:
-        return
-    uid = cb.from_user.id
     if uid not in (a_id, b_id):
-        await cb.answer("Ты не участник этой дуэли.", show_alert=True)
-        return
+        return "Ты не участник этой дуэли.", None
 
-    if not data_json:
-        await cb.answer("Ошибка данных дуэли.", show_alert=True)
-        return
+    data = duel.data
 
-    try:
-        data = json.loads(data_json)
-    except Exception as e:
-        log_error("cb_duel_action json.loads", e)
-        await cb.answer("Ошибка данных дуэли.", show_alert=True)
-        return
-    
-    if str(uid) != data.get("turn"):
-        await cb.answer("Сейчас ход другого игрока.", show_alert=True)
-        return
+    if uid != data.turn:
+        return "Сейчас ход другого игрока.", None
 
     # дедлайн текущего раунда
-    if data.get("deadline"):
-        try:
-            dl = datetime.fromisoformat(data["deadline"])
-        except Exception:
-            dl = None
-        if dl and now > dl:
-            await cb.answer("Раунд уже закончился. Жди обновления.", show_alert=True)
-            return
+    if data.deadline and now.timestamp() > data.deadline:
+        return "Раунд уже закончился. Жди обновления.", None
 
     # сдача
     if action == "surrender":
@@ -2851,50 +5148,43 @@ async def cb_duel_action(cb: CallbackQuery):
         score = rep_get(chat_id, other)
 
         duel_set_state(chat_id, duel_id, "done")
-        try:
-            text = (
-                f"🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n"
-                f"{me_name} позорно покидает арену.\n"
-                f"Победа {other_name}. +{DUEL_REP_REWARD} репутации (итого {score})."
-            )
-            if bank > 0:
-                text += f"\n\n💰 Банк: +{bank} tokens победителю."
-            await cb.message.edit_text(text)
-        except Exception:
-            pass
-
-        await cb.answer("Ты сдался.")
-        return
+        text = (
+            f"🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n"
+            f"{me_name} позорно покидает арену.\n"
+            f"Победа {other_name}. +{DUEL_REP_REWARD} репутации (итого {score})."
+        )
+        if bank > 0:
+            text += f"\n\n💰 Банк: +{bank} tokens победителю."
+        return None, ("Ты сдался.", text, None)
 
 
     # если уже ходил
-    if data["moves"].get(str(uid)) is not None:
-        await cb.answer("Ты уже сделал ход в этом раунде.", show_alert=True)
-        return
+    me = data.player(uid)
+    if me.move is not None:
+        return "Ты уже сделал ход в этом раунде.", None
 
     # нормализуем алиасы (вдруг)
     action_norm = ACTION_ALIASES.get(action, action)
     if action_norm not in ("shoot", "aim", "dodge", "reload", "heal"):
-        await cb.answer("Неизвестное действие.", show_alert=True)
-        return
+        return "Неизвестное действие.", None
 
-    data["moves"][str(uid)] = action_norm
+    me.move = action_norm
 
     # --- переключаем ход на другого игрока ---
     other = b_id if uid == a_id else a_id
-    data["turn"] = str(other)
+    data.turn = other
 
     duel_update_data(chat_id, duel_id, data)
 
     # если второй уже походил — резолвим раунд
-    if data["moves"].get(str(a_id)) and data["moves"].get(str(b_id)):
+    if data.a.move and data.b.move:
         body, finished = duel_resolve_round(chat_id, duel_id, a_id, b_id, data)
         if finished:
             duel_set_state(chat_id, duel_id, "done")
 
             # определяем победителя по hp
-            a_hp = int(data["players"][str(a_id)]["hp"])
-            b_hp = int(data["players"][str(b_id)]["hp"])
+            a_hp = data.a.hp
+            b_hp = data.b.hp
             winner = None
             if a_hp > 0 and b_hp <= 0:
                 winner = a_id
@@ -2907,30 +5197,47 @@ async def cb_duel_action(cb: CallbackQuery):
                     body += f"\n\n💰 Банк: +{bank} tokens победителю."
 
             duel_update_data(chat_id, duel_id, data)
-            try:
-                await cb.message.edit_text("🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n" + body)
-            except Exception:
-                pass
-        else:
-            duel_start_round(data, now, a_id, b_id)
-            duel_update_data(chat_id, duel_id, data)
-            try:
-                arena_text = duel_status_text(chat_id, a_id, b_id, data)
-                await cb.message.edit_text(arena_text, reply_markup=kb_duel_actions(duel_id))
-            except Exception:
-                pass
+            return None, ("Раунд завершён.", "🤠 ДУЭЛЬ • ЗАВЕРШЕНО\n\n" + body, None)
 
-        await cb.answer("Раунд завершён.")
-        return
+        duel_start_round(data, now)
+        duel_update_data(chat_id, duel_id, data)
+        return None, ("Раунд завершён.", duel_status_text(chat_id, a_id, b_id, data), duel_id)
 
     # иначе просто обновим статус арены, чтобы было видно "походил"
+    return None, ("Ход принят.", duel_status_text(chat_id, a_id, b_id, data), duel_id)
+
+@dp.callback_query(F.data.startswith("duel:act:"))
+async def cb_duel_action(cb: CallbackQuery, settings: dict):
+    chat_id = cb.message.chat.id
+    tz = settings["tz"]
+    now = now_tz(tz)
+    if chat_is_quiet(settings, now):
+        await cb.answer("Quiet режим.", show_alert=True)
+        return
+
+    # duel:act:<duel_id>:<action>
+    parts = cb.data.split(":")
+    if len(parts) < 4:
+        await cb.answer("Некорректная кнопка.", show_alert=True)
+        return
+    duel_id = parts[2]
+    action = parts[3]
+
+    if not cb.from_user:
+        return
+
+    alert, res = await db_write(chat_id, duel_apply_action, chat_id, duel_id, cb.from_user.id, action, now)
+    if alert:
+        await cb.answer(alert, show_alert=True)
+        return
+
+    answer, text, kb_duel_id = res
     try:
-        arena_text = duel_status_text(chat_id, a_id, b_id, data)
-        await cb.message.edit_text(arena_text, reply_markup=kb_duel_actions(duel_id))
+        await cb.message.edit_text(text, reply_markup=kb_duel_actions(kb_duel_id) if kb_duel_id else None)
     except Exception:
         pass
 
-    await cb.answer("Ход принят.")
+    await cb.answer(answer)
 
 
 # =======================
@@ -2938,7 +5245,7 @@ async def cb_duel_action(cb: CallbackQuery):
 # =======================
 
 @dp.message(F.text.in_({"+", "++", "+++", "-", "--", "---"}))
-async def rep_by_reply(msg: Message):
+async def rep_by_reply(msg: Message, settings: dict):
     if not msg.text:
         return
 
@@ -2951,9 +5258,6 @@ async def rep_by_reply(msg: Message):
         return
 
     chat_id = msg.chat.id
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
 
     voter = msg.from_user
     target = msg.reply_to_message.from_user
@@ -2965,48 +5269,48 @@ async def rep_by_reply(msg: Message):
     if delta < 0 and not ALLOW_NEGATIVE_REP:
         return
 
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
-    if not rep_can_vote(chat_id, voter.id, target.id, now):
-        return
+    def work() -> str | None:
+        if not rep_can_vote(chat_id, voter.id, target.id, now):
+            return None
 
-    rep_add(chat_id, target.id, delta)
-    rep_mark_vote(chat_id, voter.id, target.id, now)
+        rep_add(chat_id, target.id, delta)
+        rep_mark_vote(chat_id, voter.id, target.id, now)
 
-    score = rep_get(chat_id, target.id)
-    name = get_user_display(chat_id, target.id)
+        score = rep_get(chat_id, target.id)
+        name = get_user_display(chat_id, target.id)
+        return f"{name}: {'+' if delta>0 else ''}{delta} репутации (итого {score})"
 
-    await msg.reply(f"{name}: {'+' if delta>0 else ''}{delta} репутации (итого {score})")
+    text = await db_write(chat_id, work)
+    if text:
+        await msg.reply(text)
 
 @dp.message()
-async def any_message(msg: Message, bot: Bot):
+async def any_message(msg: Message, bot: Bot, settings: dict):
     # логирование, триггеры, авто-приколы
     if not msg.chat:
         return
-    
+
     # не логируем ботов (включая самого бота и других ботов в чате)
     if not msg.from_user or msg.from_user.is_bot:
         return
 
     chat_id = msg.chat.id
 
-    s = get_settings(chat_id)
-    if not s["enabled"]:
-        return
-
-    tz = s["tz"]
+    tz = settings["tz"]
     now = now_tz(tz)
 
+    # слова/фразы
+    text = msg.text or msg.caption or ""
+
     # user cache
-    update_user_cache_from_message(chat_id, msg, now)
+    await db_write(chat_id, update_user_cache_from_message, chat_id, msg, now)
 
     # базовые логи
     if msg.from_user:
-        add_msg_log(chat_id, now, msg.from_user.id)
-
-    # слова/фразы
-    text = msg.text or msg.caption or ""
+        ingest_msg(chat_id, now, msg.from_user.id)
 
     # --- логируем только обычные сообщения с текстом ---
     if not text:
@@ -3019,24 +5323,15 @@ async def any_message(msg: Message, bot: Bot):
 
     print(f"[MSG] chat={msg.chat.id} from={msg.from_user.id} text={(msg.text or msg.caption or '')[:50]!r}")
 
-    if text:
-        add_words(chat_id, now, tokenize(text))
-        # как фразу логируем "нормализованную строку" (без огромных полотен)
-        phr = normalize_phrase(text)
-        if 0 < len(phr) <= 120:
-            add_phrase(chat_id, now, phr)
-
-    # чистка логов (храним 7 дней)
-    prune_logs(chat_id, now - timedelta(days=7))
+    ingest_text(chat_id, now, text)
+    ingest_last_message(chat_id, now)
 
-    set_field(chat_id, "last_message_at", now)
-
-    if chat_is_quiet(s, now):
+    if chat_is_quiet(settings, now):
         return
 
     # 💩 триггер
     if text and has_trigger(text):
-        cnt = inc_daily_trigger(chat_id, date_key(now))
+        cnt = await db_write(chat_id, inc_daily_trigger, chat_id, date_key(now))
 
         # лимит в день, дальше — редко
         if cnt <= DAILY_TRIGGER_LIMIT:
@@ -3046,27 +5341,371 @@ async def any_message(msg: Message, bot: Bot):
                 await maybe_set_poop_reaction(bot, msg)
 
     # пасхалка
-    if can_easter(s, now) and random.random() < EASTER_PROB:
+    if can_easter(settings, now) and random.random() < EASTER_PROB:
         await handle_easter(msg, chat_id, now)
 
     # авто-хайп
-    if can_autohype(s, now) and random.random() < AUTO_HYPE_PROB:
+    if can_autohype(settings, now) and random.random() < AUTO_HYPE_PROB:
         await handle_autohype(msg, chat_id, tz, now)
 
+# =======================
+# RECORD / REPLAY
+# =======================
+# Запись живого трафика, чтобы профилировать бота на настоящей нагрузке.
+#
+# RECORD_UPDATES=путь.jsonl.gz — каждый входящий апдейт (внешняя мидлварь
+# dp.update) ложится в буфер как {"t": время приёма, "update": ...}, раз в
+# RECORD_FLUSH_S буфер дописывается в файл отдельным gzip-членом (в потоке, не
+# на event loop); gzip.open читает такие файлы целиком.
+# RECORD_TEXT — что делать с текстом сообщений:
+# - scramble (по умолчанию): каждое слово -> псевдослово той же длины и
+#   алфавита, одно и то же слово -> одно и то же (ключ RECORD_SALT, по
+#   умолчанию случайный на процесс): топы слов/фраз и длины остаются живыми;
+#   слова-триггеры 💩 не трогаем;
+# - hash: текст целиком -> "#" + хеш;
+# - raw: как есть.
+# Команды ("/...") и "+"/"-" для репутации пишутся как есть — без них
+# реплей не попадёт в те же хендлеры.
+#
+# Реплей: python weirdo.py replay FILE [--speed 1|N|max] [--db PATH] [--profile OUT]
+# гонит запись через dp.feed_update с фейковым Bot (ReplaySession: вызовы API
+# только считаются) на временной базе (или --db — например, копии боевой).
+# --speed 1 — в исходном темпе, N — в N раз быстрее, max — без пауз (не
+# больше REPLAY_INFLIGHT апдейтов в работе, как пачка getUpdates). Печатает
+# время по хендлерам; --profile — ещё и cProfile event loop, потока-писателя и
+# читателя (читатель один на время профиля) в pstats-файл и топ по tottime.
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "")
+RECORD_TEXT = os.getenv("RECORD_TEXT", "scramble")
+RECORD_FLUSH_S = float(os.getenv("RECORD_FLUSH_S", "2"))
+REPLAY_INFLIGHT = int(os.getenv("REPLAY_INFLIGHT", "100"))
+
+_record_key = os.getenv("RECORD_SALT", "").encode() or os.urandom(16)
+_record_buf = []  # [(ts, dict апдейта)], трогаем только из event loop
+_SCRAMBLE_ABC = ("abcdefghijklmnopqrstuvwxyz", "абвгдежзийклмнопрстуфхцчшщыэюя")
+_REP_TEXTS = {"+", "++", "+++", "-", "--", "---"}
+
+def _scramble_word(m: re.Match) -> str:
+    w = m.group(0)
+    if w.isdigit() or RE_TRIGGER.fullmatch(w):
+        return w
+    h = hashlib.blake2b(w.lower().encode(), key=_record_key, digest_size=32).digest()
+    abc = _SCRAMBLE_ABC[1] if re.search("[А-Яа-яЁё]", w) else _SCRAMBLE_ABC[0]
+    out = "".join(abc[h[i % len(h)] % len(abc)] for i in range(len(w)))
+    return out.capitalize() if w[:1].isupper() else out
+
+def record_text(text: str) -> str:
+    if RECORD_TEXT == "raw" or text.lstrip().startswith("/") or text.strip() in _REP_TEXTS:
+        return text
+    if RECORD_TEXT == "hash":
+        return "#" + hashlib.blake2b(text.encode(), key=_record_key, digest_size=8).hexdigest()
+    return RE_WORD.sub(_scramble_word, text)
+
+def record_privacy(obj):
+    """text/caption на любой глубине (reply_to_message, message у callback) — через record_text."""
+    if isinstance(obj, list):
+        return [record_privacy(x) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k in ("text", "caption") and isinstance(v, str):
+            out[k] = record_text(v)
+        elif k in ("entities", "caption_entities") and RECORD_TEXT != "raw":
+            continue  # смещения сущностей — про исходный текст
+        else:
+            out[k] = record_privacy(v)
+    return out
+
+class UpdateRecorder(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        _record_buf.append((time.time(), event.model_dump(mode="json", exclude_none=True, by_alias=True)))
+        return await handler(event, data)
+
+def record_write(path: str, items: list[tuple]):
+    lines = "".join(
+        json.dumps({"t": round(t, 3), "update": record_privacy(u)}, ensure_ascii=False) + "\n" for t, u in items
+    )
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        f.write(lines)
+
+def record_take() -> list[tuple]:
+    global _record_buf
+    items, _record_buf = _record_buf, []
+    return items
+
+async def background_recorder(path: str, interval: float = RECORD_FLUSH_S):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        items = record_take()
+        if not items:
+            continue
+        try:
+            await loop.run_in_executor(None, record_write, path, items)
+        except Exception as e:
+            log_error("record_write", e)
+
+class ReplaySession(BaseSession):
+    """Сессия без сети: считает вызовы API и отвечает правдоподобно (Message на send*, иначе True)."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = {}
+        self._ids = iter(range(1 << 40, 1 << 41))
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if method.__returning__ is Message:
+            return Message(
+                message_id=next(self._ids), date=int(time.time()),
+                chat=Chat(id=method.chat_id, type="supergroup"),
+                from_user=User(id=bot.id, is_bot=True, first_name="replay"),
+                text=getattr(method, "text", None), reply_markup=getattr(method, "reply_markup", None),
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+class HandlerTimer(BaseMiddleware):
+    """Внутренняя мидлварь реплея: время хендлера (после фильтров и настроек чата) по имени."""
+
+    def __init__(self, timings: dict):
+        self.timings = timings
+
+    async def __call__(self, handler, event, data):
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = data["handler"].callback.__name__
+            self.timings.setdefault(name, []).append((time.perf_counter() - t0) * 1000)
+
+def replay_read(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                yield rec["t"], rec["update"]
+
+def _replay_chat(raw: dict):
+    for v in raw.values():
+        if isinstance(v, dict):
+            chat = v.get("chat") or (v.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+    return None
+
+def _replay_duel_id(raw: dict, ids: dict):
+    """duel_id — uuid4, в реплее дуэли новые: "duel:*:<старый id>" -> id дуэли, заведённой реплеем.
+    Связь ставим на accept: висящее приглашение в этом чате тому, кто жмёт."""
+    cq = raw.get("callback_query")
+    parts = ((cq or {}).get("data") or "").split(":")
+    if len(parts) < 3 or parts[0] != "duel":
+        return
+    new = ids.get(parts[2])
+    if new is None and parts[1] == "accept":
+        chat_id, uid = _replay_chat(raw), cq["from"]["id"]
+        taken = set(ids.values())
+        new = next((d.duel_id for d in list(_duels.values())
+                    if d.chat_id == chat_id and d.b_id == uid and d.state == "pending" and d.duel_id not in taken), None)
+        if new:
+            ids[parts[2]] = new
+    if new:
+        parts[2] = new
+        cq["data"] = ":".join(parts)
+
+def _ms_stats(lat: list[float]) -> str:
+    lat = sorted(lat)
+    p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]  # noqa: E731
+    return f"n={len(lat):<7} total={sum(lat) / 1000:8.2f}s mean={sum(lat) / len(lat):7.2f} p50={p(0.5):7.2f} p99={p(0.99):7.2f} ms"
+
+async def replay_run(path: str, speed: float, profiles: list | None) -> dict:
+    bot = Bot(TOKEN or "1:replay", session=ReplaySession())
+    handlers = {}
+    timer = HandlerTimer(handlers)
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+    await app_start(bot)
+    loop = asyncio.get_running_loop()
+    if profiles is not None:
+        # cProfile в 3.11 — на поток: включаем в самом писателе и в (единственном) читателе
+        prof_w, prof_r = cProfile.Profile(), cProfile.Profile()
+        await db_write(None, prof_w.enable)
+        await loop.run_in_executor(_db_reader_pool, prof_r.enable)
+        prof_main = cProfile.Profile()
+        profiles += [prof_main, prof_w, prof_r]
+        prof_main.enable()
+
+    feed = []
+    unhandled = 0
+    inflight = asyncio.Semaphore(REPLAY_INFLIGHT)
+    # чаты параллельно, внутри чата — по порядку записи (Lock в asyncio честный),
+    # иначе на --speed max accept дуэли обгоняет сам /duel
+    chat_locks = {}
+    duel_ids = {}
+
+    async def one(raw: dict):
+        nonlocal unhandled
+        chat_id = _replay_chat(raw)
+        lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                _replay_duel_id(raw, duel_ids)
+                upd = Update.model_validate(raw, context={"bot": bot})
+                t0 = time.perf_counter()
+                try:
+                    res = await dp.feed_update(bot, upd)
+                    unhandled += res is UNHANDLED
+                except Exception as e:
+                    log_error("replay", e)
+                feed.append((time.perf_counter() - t0) * 1000)
+        finally:
+            inflight.release()
+
+    tasks = set()
+    first = None
+    start = loop.time()
+    for t, raw in replay_read(path):
+        if first is None:
+            first = t
+        if speed:
+            delay = (t - first) / speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await inflight.acquire()
+        task = asyncio.create_task(one(raw))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    if profiles is not None:
+        prof_main.disable()
+        await db_write(None, prof_w.disable)
+        await loop.run_in_executor(_db_reader_pool, prof_r.disable)
+    await app_stop()
+    await bot.session.close()
+    return {"updates": len(feed), "unhandled": unhandled, "elapsed": elapsed, "feed": feed,
+            "handlers": handlers, "api": bot.session.calls}
+
+def replay_cli(argv: list[str]) -> int:
+    global DB_PATH, DB_READERS, RECORD_UPDATES
+    ap = argparse.ArgumentParser(prog="weirdo.py replay")
+    ap.add_argument("path", help="запись RECORD_UPDATES (.jsonl.gz)")
+    ap.add_argument("--speed", default="1", help="1 — исходный темп, N — в N раз быстрее, max — без пауз")
+    ap.add_argument("--db", help="база для реплея (по умолчанию — новая временная)")
+    ap.add_argument("--profile", metavar="OUT", help="записать cProfile (pstats) в OUT")
+    ap.add_argument("--top", type=int, default=25, help="строк профиля в выводе")
+    args = ap.parse_args(argv)
+
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+    RECORD_UPDATES = ""  # реплей не пишет сам себя
+    tmp = None
+    if args.db:
+        DB_PATH = args.db
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        DB_PATH = os.path.join(tmp.name, "replay.db")
+    profiles = None
+    if args.profile:
+        DB_READERS = 1
+        profiles = []
+    try:
+        res = asyncio.run(replay_run(args.path, speed, profiles))
+    finally:
+        if tmp:
+            tmp.cleanup()
+
+    print(f"[REPLAY] {res['updates']} updates in {res['elapsed']:.2f}s "
+          f"({res['updates'] / max(res['elapsed'], 1e-9):.0f}/s, speed={args.speed}), unhandled={res['unhandled']}")
+    if res["feed"]:
+        print(f"  {'feed_update':<24} {_ms_stats(res['feed'])}")
+    for name, lat in sorted(res["handlers"].items(), key=lambda kv: -sum(kv[1])):
+        print(f"  {name:<24} {_ms_stats(lat)}")
+    print("  api: " + " ".join(f"{k}={v}" for k, v in sorted(res["api"].items())))
+    if profiles:
+        st = pstats.Stats(profiles[0])
+        for p in profiles[1:]:
+            st.add(p)
+        # простой потоков БД (ждут задачу в очереди) — не работа, выкидываем
+        for key in [k for k in st.stats if k[2] == "<method 'get' of '_queue.SimpleQueue' objects>"]:
+            st.total_tt -= st.stats.pop(key)[2]
+        st.dump_stats(args.profile)
+        print(f"[REPLAY] profile -> {args.profile} (event loop + db-writer + db-reader)")
+        st.sort_stats("tottime").print_stats(args.top)
+    return 0
+
 # =======================
 # MAIN
 # =======================
+async def app_start(bot: Bot):
+    """Всё, что нужно боту до первого апдейта (и main, и replay)."""
+    await db_write(None, init_db)
+    await db_write(None, duel_registry_load)
+    if TOPK_ENGINE == "spacesaving":
+        await db_write(None, topk_load)
+
+    # Запускаем watcher, сброс буфера логов, чистку логов и замер лагов event loop
+    asyncio.create_task(background_duel_watcher(bot))
+    asyncio.create_task(background_ingest_flusher())
+    asyncio.create_task(background_retention())
+    if migrate_pending():
+        asyncio.create_task(background_migrate())
+    asyncio.create_task(background_loop_lag_monitor())
+    if RECONCILE_INTERVAL_S > 0:
+        asyncio.create_task(background_reconcile())
+    if TOPK_ENGINE == "spacesaving":
+        asyncio.create_task(background_topk_persist())
+    if METRICS_PORT:
+        metrics_install(bot)
+        await metrics_serve()
+    if RECORD_UPDATES:
+        dp.update.outer_middleware(UpdateRecorder())
+        asyncio.create_task(background_recorder(RECORD_UPDATES))
+        print(f"[RECORD] updates -> {RECORD_UPDATES} (text: {RECORD_TEXT})")
+
+async def app_stop():
+    try:
+        await ingest_flush()
+    except Exception as e:
+        log_error("ingest_flush on shutdown", e)
+    if TOPK_ENGINE == "spacesaving":
+        try:
+            await topk_persist()
+        except Exception as e:
+            log_error("topk_persist on shutdown", e)
+    if RECORD_UPDATES and _record_buf:
+        try:
+            record_write(RECORD_UPDATES, record_take())
+        except Exception as e:
+            log_error("record_write on shutdown", e)
+    db_stop()
+
 async def main():
     if not TOKEN:
         raise RuntimeError("BOT_TOKEN is not set in environment.")
 
-    init_db()
+    for mode, st in slot_tables_check().items():
+        print(f"[SLOT] {mode}: EV={st['ev']:.4f} sd={st['sd']:.2f} hit={st['hit']:.2%} "
+              f"profit={st['profit']:.2%} jackpot={st['jackpot']:.2%} rtp={st['rtp']:.4f} mint={st['mint']:+.4f}")
 
     bot = Bot(TOKEN)
-    # Запускаем watcher
-    asyncio.create_task(background_duel_watcher(bot))
-
-    await dp.start_polling(bot)
+    await app_start(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await app_stop()
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["reconcile"]:
+        sys.exit(reconcile_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ["migrate"]:
+        sys.exit(migrate_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ["replay"]:
+        sys.exit(replay_cli(sys.argv[2:]))
     asyncio.run(main())